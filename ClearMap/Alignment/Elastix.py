@@ -57,6 +57,8 @@ import re
 import ClearMap.Settings as settings
 import ClearMap.IO as io
 
+from ClearMap.Utils.Progress import createProgress
+
 ##############################################################################
 ### Initialization and Enviroment Settings
 ##############################################################################
@@ -682,7 +684,7 @@ def writePoints(filename, points, indices = True):
 
 
 
-def transformPoints(source, sink = None, transformParameterFile = None, transformDirectory = None, indices = True, resultDirectory = None, tmpFile = None):
+def transformPoints(source, sink = None, transformParameterFile = None, transformDirectory = None, indices = True, resultDirectory = None, tmpFile = None, progress = False):
     """Transform coordinates math:`x` via elastix estimated transformation to :math:`T(x)`
 
     Note the transformation is from the fixed image coorindates to the moving image coordiantes.
@@ -695,9 +697,15 @@ def transformPoints(source, sink = None, transformParameterFile = None, transfor
         indices (bool): if True use points as pixel coordinates otherwise spatial coordinates.
         resultDirectory (str or None): elastic result directory
         tmpFile (str or None): file name for the elastix point file.
+        progress (bool or str): if True report the finished steps, i.e. writing, transforming and reading the points,
+                                if a file name write the status also to this file, see :mod:`~ClearMap.Utils.Progress`
         
     Returns:
         array or str: array or file name of transformed points
+    
+    Note:
+        transformix transforms all points in a single call, thus the progress 
+        is reported per step and not per point.
     """
         
     global TransformixBinary;    
@@ -707,6 +715,8 @@ def transformPoints(source, sink = None, transformParameterFile = None, transfor
 
     if tmpFile == None:
         tmpFile = os.path.join(tempfile.tempdir, 'elastix_input.txt');
+    
+    prg = createProgress(progress, 'transformPoints', 3, unit = 'steps');
 
     # write text file
     if isinstance(source, basestring):
@@ -732,6 +742,8 @@ def transformPoints(source, sink = None, transformParameterFile = None, transfor
     else:
         raise RuntimeError('transformPoints: source not string or array!');
     
+    prg.update();
+    
     
     if resultDirectory == None:
         outdirname = os.path.join(tempfile.tempdir, 'elastix_output');
@@ -763,9 +775,13 @@ def transformPoints(source, sink = None, transformParameterFile = None, transfor
     if res != 0:
         raise RuntimeError('failed executing ' + cmd);
     
+    prg.update();
+    
     
     #read data / file 
     if sink == []:
+        prg.update();
+        prg.finish();
         return io.path.join(outdirname, 'outputpoints.txt')
     
     else:
@@ -780,6 +796,9 @@ def transformPoints(source, sink = None, transformParameterFile = None, transfor
             os.remove(os.path.join(outdirname, f));
         os.rmdir(outdirname)
         
+        prg.update(items = transpoints.shape[0]);
+        prg.finish();
+        
         return io.writePoints(sink, transpoints);
 
         
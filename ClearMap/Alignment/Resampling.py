@@ -68,7 +68,6 @@ import os
 import math
 import numpy
 
-import multiprocessing  
 import tempfile
 
 import shutil
@@ -80,6 +79,8 @@ import ClearMap.IO.IO as io
 import ClearMap.IO.FileList as fl
 
 from ClearMap.Utils.ProcessWriter import ProcessWriter;
+from ClearMap.Utils.Executor import imapUnordered
+from ClearMap.Utils.Progress import createProgress
 
 
 def fixOrientation(orientation):
@@ -387,7 +388,7 @@ def _resampleXYParallel(arg):
 
 
 def resampleData(source, sink = None,  orientation = None, dataSizeSink = None, resolutionSource = (4.0625, 4.0625, 3), resolutionSink = (25, 25, 25), 
-                 processingDirectory = None, processes = 1, cleanup = True, verbose = True, interpolation = 'linear', **args):
+                 processingDirectory = None, processes = 1, cleanup = True, verbose = True, interpolation = 'linear', progress = False, **args):
     """Resample data of source in resolution and orientation
     
     Arguments:
@@ -402,6 +403,7 @@ def resampleData(source, sink = None,  orientation = None, dataSizeSink = None,
         cleanup (bool): remove temporary files
         verbose (bool): display progress information
         interpolation (str): method to use for interpolating to the resmapled image
+        progress (bool or str): if True report the planes resampled, throughput and ETA, if a file name write the status also to this file, see :mod:`~ClearMap.Utils.Progress`
     
     Returns:
         (array or str): data or file name of resampled image
@@ -439,12 +441,14 @@ def resampleData(source, sink = None,  orientation = None, dataSizeSink = None,
     interpolation = fixInterpolation(interpolation);
      
     nZ = dataSizeSource[2];
-    pool = multiprocessing.Pool(processes=processes);
     argdata = [];
     for i in range(nZ):
         argdata.append( (source, os.path.join(processingDirectory, 'resample_%04d.tif' % i), dataSizeSinkI, interpolation, i, nZ, verbose) );  
         #print argdata[i]
-    pool.map(_resampleXYParallel, argdata);
+    prg = createProgress(progress, 'resampleData: resampling in XY', nZ, unit = 'planes');
+    for r in imapUnordered(_resampleXYParallel, argdata, processes = processes):
+        prg.update(voxels = dataSizeSource[0] * dataSizeSource[1]);
+    prg.finish();
     
     #rescale in z
     fn = os.path.join(processingDirectory, 'resample_%04d.tif' % 0);
@@ -459,12 +463,15 @@ def resampleData(source, sink = None,  orientation = None, dataSizeSink = None,
     
     resampledData = numpy.zeros(dataSizeSinkI, dtype = zImage.dtype);
 
+    prg = createProgress(progress, 'resampleData: resampling in Z', dataSizeSinkI[0], unit = 'planes');
     for i in range(dataSizeSinkI[0]):
         if verbose and i % 25 == 0:
             print "resampleData: processing %d/%d" % (i, dataSizeSinkI[0])
         #resampledImage[:, iImage ,:] =  scipy.misc.imresize(zImage[:,iImage,:], [resizedZAxisSize, sagittalImageSize[1]] , interp = 'bilinear'); 
         #cv2.resize takes reverse order of sizes !
         resampledData[i ,:, :] =  cv2.resize(zImage[i,:,:], (dataSizeSinkI[2], dataSizeSinkI[1]), interpolation = interpolation);
+        prg.update(voxels = zImage.shape[1] * zImage.shape[2]);
+    prg.finish();
         #resampledData[i ,:, :] =  cv2.resize(zImage[i,:, :], (dataSize[1], resizedZSize));
     
 
@@ -510,7 +517,7 @@ def resampleData(source, sink = None,  orientation = None, dataSizeSink = None,
 
 
 def resampleDataInverse(sink, source = None, dataSizeSource = None, orientation = None, resolutionSource = (4.0625, 4.0625, 3), resolutionSink = (25, 25, 25), 
-                        processingDirectory = None, processes = 1, cleanup = True, verbose = True, interpolation = 'linear', **args):
+                        processingDirectory = None, processes = 1, cleanup = True, verbose = True, interpolation = 'linear', progress = False, **args):
     """Resample data inversely to :func:`resampleData` routine
     
     Arguments:
@@ -525,6 +532,7 @@ def resampleDataInverse(sink, source = None, dataSizeSource = None, orientation
         cleanup (bool): remove temporary files
         verbose (bool): display progress information
         interpolation (str): method to use for interpolating to the resmapled image
+        progress (bool or str): if True report the planes resampled, throughput and ETA, if a file name write the status also to this file, see :mod:`~ClearMap.Utils.Progress`
     
     Returns:
         (array or str): data or file name of resampled image
@@ -579,12 +587,15 @@ def resampleDataInverse(sink, source = None, dataSizeSource = None, orientation
     
     resampledDataXY = numpy.zeros((dataSizeSinkI[0], dataSizeSinkI[1], dataSizeSource[2]), dtype = resampledData.dtype);    
     
+    prg = createProgress(progress, 'resampleDataInverse: resampling in Z', dataSizeSinkI[0], unit = 'planes');
     for i in range(dataSizeSinkI[0]):
         if verbose and i % 25 == 0:
             print "resampleDataInverse: processing %d/%d" % (i, dataSizeSinkI[0])
 
         #cv2.resize takes reverse order of sizes !
         resampledDataXY[i ,:, :] =  cv2.resize(resampledData[i,:,:], (dataSizeSource[2], dataSizeSinkI[1]), interpolation = interpolation);
+        prg.update(voxels = resampledDataXY.shape[1] * resampledDataXY.shape[2]);
+    prg.finish();
 
     # upscale x, y in parallel
     
@@ -598,11 +609,13 @@ def resampleDataInverse(sink, source = None, dataSizeSource = None, orientation
     io.writeData(files, resampledDataXY);
     
     nZ = dataSizeSource[2];
-    pool = multiprocessing.Pool(processes=processes);
     argdata = [];
     for i in range(nZ):
-        argdata.append( (source, fl.fileExpressionToFileName(files, i), dataSizeSource, interpolation, i, nZ) );  
-    pool.map(_resampleXYParallel, argdata);
+        argdata.append( (source, fl.fileExpressionToFileName(files, i), dataSizeSource, interpolation, i, nZ, verbose) );  
+    prg = createProgress(progress, 'resampleDataInverse: resampling in XY', nZ, unit = 'planes');
+    for r in imapUnordered(_resampleXYParallel, argdata, processes = processes):
+        prg.update(voxels = dataSizeSource[0] * dataSizeSource[1]);
+    prg.finish();
     
     if io.isFileExpression(source):
         return source;
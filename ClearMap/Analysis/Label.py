@@ -192,6 +192,34 @@ def labelAtCollapse(label):
         return Label.toLabelAtCollapse(label);
 
 
+def labelInRegions(label, regions):
+    """Checks if labels are in any of the given regions or their sub-regions
+    
+    Arguments:
+        label (int or array): labels to check
+        regions (list): ids of the regions
+        
+    Returns:
+        bool or array: True for labels in the regions
+    """
+    global Label;
+    
+    regions = set(regions);
+    
+    def inRegions(i):
+        while i >= 0:
+            if i in regions:
+                return True;
+            if not i in Label.parents:
+                return False;
+            i = Label.parents[i];
+        return False;
+    
+    if isinstance(label, numpy.ndarray) or isinstance(label, list):
+        return numpy.array([inRegions(x) for x in label], dtype = bool);
+    else:
+        return inRegions(label);
+
 
 def labelPoints(points, labeledImage = DefaultLabeledImageFile, level = None, collapse = None):
     
@@ -18,6 +18,7 @@ import re
 import numpy
 import importlib
 import shutil
+import tempfile
 
 pointFileExtensions = ["csv", "txt", "npy", "vtk", "ims"];
 """list of extensions supported as a point data file"""
@@ -165,6 +166,44 @@ def createDirectory(filename):
     return dirname;
 
 
+def _umask():
+    """Helper to read the umask of the process without changing it if possible"""
+    
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8);
+    except (IOError, OSError, ValueError):
+        pass;
+    
+    umask = os.umask(0);
+    os.umask(umask);
+    return umask;
+
+
+def createTemporaryFile(directory = None, prefix = 'tmp', suffix = ''):
+    """Creates a temporary file with the permissions of a newly created file
+    
+    Files created by :func:`tempfile.mkstemp` are only accessible by the owner,
+    here the permissions follow the umask as for :func:`open`, so the file can 
+    be renamed or linked to its final name.
+     
+    Arguments:
+        directory (str or None): directory of the file, if None the default temporary directory
+        prefix (str): prefix of the file name
+        suffix (str): suffix of the file name
+        
+    Returns:
+        tuple: open file descriptor and file name
+    """
+    
+    fd, filename = tempfile.mkstemp(dir = directory, prefix = prefix, suffix = suffix);
+    os.fchmod(fd, 0666 & ~_umask());
+    
+    return fd, filename;
+
+
 def pointFileNameToType(filename):
     """Returns type of a point file
     
@@ -17,6 +17,7 @@ Example:
 #:license: GNU, see LICENSE.txt for details.
 
 import os
+import time
 import numpy
 
 import vtk
@@ -114,6 +115,52 @@ def readData(filename, x = all, y = all, z = all):
     return io.dataToRange(img, x = x, y = y, z = z);
 
 
+numpyToDataType = {numpy.dtype('int8')    : "MET_CHAR",
+                   numpy.dtype('uint8')   : "MET_UCHAR",
+                   numpy.dtype('int16')   : "MET_SHORT", 
+                   numpy.dtype('uint16')  : "MET_USHORT",
+                   numpy.dtype('int32')   : "MET_INT",
+                   numpy.dtype('uint32')  : "MET_UINT",
+                   numpy.dtype('int64')   : "MET_LONG",
+                   numpy.dtype('uint64')  : "MET_ULONG",
+                   numpy.dtype('float32') : "MET_FLOAT", 
+                   numpy.dtype('float64') : "MET_DOUBLE",
+                   };
+"""dict: map from numpy data types to the element types of the mhd header"""
+
+dataTypeToNumpy = dict((v,k) for k,v in numpyToDataType.items());
+"""dict: map from the element types of the mhd header to numpy data types"""
+
+
+def headerFileName(filename):
+    """Returns the name of the mhd header file for a raw or mhd file name"""
+    
+    if io.fileExtension(filename) == "raw":
+        return filename[:-3] + 'mhd';
+    else:
+        return filename;
+
+
+def readHeader(filename):
+    """Read raw header mhd file
+    
+    Arguments:
+        filename (str): file name of header
+    
+    Returns:
+        dict: dictionary of meta data
+    """
+    
+    meta_dict = {};
+    with open(filename, 'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1);
+                meta_dict[key.strip()] = value.strip();
+    
+    return meta_dict;
+
+
 def writeHeader(filename, meta_dict):
     """Write raw header mhd file
     
@@ -203,20 +250,8 @@ def writeData(filename, data, **args):
     meta_dict['BinaryData'] = 'True'
     meta_dict['BinaryDataByteOrderMSB'] = 'False'
 
-    numpy_to_datatype   = {numpy.dtype('int8')    : "MET_CHAR",
-                           numpy.dtype('uint8')   : "MET_UCHAR",
-                           numpy.dtype('int16')   : "MET_SHORT", 
-                           numpy.dtype('uint16')  : "MET_USHORT",
-                           numpy.dtype('int32')   : "MET_INT",
-                           numpy.dtype('uint32')  : "MET_UINT",
-                           numpy.dtype('int64')   : "MET_LONG",
-                           numpy.dtype('uint64')  : "MET_ULONG",
-                           numpy.dtype('float32') : "MET_FLOAT", 
-                           numpy.dtype('float64') : "MET_DOUBLE",
-                           }    
-                           
     dtype = data.dtype;    
-    meta_dict['ElementType'] = numpy_to_datatype[dtype];
+    meta_dict['ElementType'] = numpyToDataType[dtype];
     
     dsize = list(data.shape);    
     #dsize[0:2] = [dsize[1],dsize[0]];  #fix arrays represented as (y,x,z)
@@ -237,6 +272,182 @@ def writeData(filename, data, **args):
     return fname;
 
 
+def _volumeMetaData(fname, shape, dtype):
+    """Helper to create the header meta data of a volume"""
+    
+    meta_dict = {};
+    meta_dict['ObjectType'] = 'Image';
+    meta_dict['BinaryData'] = 'True';
+    meta_dict['BinaryDataByteOrderMSB'] = 'False';
+    meta_dict['ElementType'] = numpyToDataType[numpy.dtype(dtype)];
+    meta_dict['NDims'] = str(len(shape));
+    meta_dict['DimSize'] = ' '.join([str(i) for i in shape]);
+    meta_dict['ElementDataFile'] = os.path.split(fname)[1].replace('.mhd','.raw');
+    return meta_dict;
+
+
+def _linkFile(source, sink):
+    """Helper to atomically create sink from source, returns False if sink exists"""
+    
+    try:
+        os.link(source, sink);
+        return True;
+    except OSError:
+        if os.path.exists(sink):
+            return False;
+        raise;
+    finally:
+        os.remove(source);
+
+
+def openVolume(filename, mode = 'r+'):
+    """Open a raw/mhd file pair as memory map
+    
+    The memory map has the same x,y,z axes order as the data returned by :func:`readData`.
+    
+    Arguments:
+        filename (str): file name of raw or mhd file
+        mode (str): mode of the memory map, see :class:`numpy.memmap`
+    
+    Returns:
+        array: memory map of the volume
+    """
+    
+    fname = headerFileName(filename);
+    meta_dict = readHeader(fname);
+    
+    if meta_dict.get('CompressedData', 'False') == 'True':
+        raise RuntimeError('openVolume: compressed data in %s cannot be memory mapped!' % fname);
+    
+    shape = tuple(int(i) for i in meta_dict['DimSize'].split());
+    dtype = dataTypeToNumpy[meta_dict['ElementType']];
+    if meta_dict.get('BinaryDataByteOrderMSB', 'False') == 'True':
+        dtype = dtype.newbyteorder('>');
+    
+    data_file = os.path.join(os.path.split(fname)[0], meta_dict['ElementDataFile']);
+    
+    #raw data is written with x as fastest index
+    return numpy.memmap(data_file, dtype = dtype, mode = mode, shape = shape, order = 'F');
+
+
+def _runFileName(fname):
+    """Helper returning the name of the file with the run id of a volume"""
+    return fname + '.run';
+
+
+def _readRunId(fname):
+    """Helper to read the run id of a volume, None if not available"""
+    
+    try:
+        with open(_runFileName(fname), 'r') as f:
+            return f.read();
+    except (IOError, OSError):
+        return None;
+
+
+def _createVolumeFiles(fname, data_file, meta_dict, shape, dtype, runId):
+    """Helper to atomically create the files of a volume if they do not exist"""
+    
+    path = os.path.split(fname)[0];
+    io.createDirectory(fname);
+    
+    #allocate the data and write the header to temporary files and link them to their final names
+    fd, tmp = io.createTemporaryFile(directory = path if path else None, suffix = '.tmp');
+    with os.fdopen(fd, 'wb') as f:
+        f.truncate(int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize);
+    
+    if _linkFile(tmp, data_file):
+        if runId is not None:
+            fd, tmp = io.createTemporaryFile(directory = path if path else None, suffix = '.tmp');
+            with os.fdopen(fd, 'w') as f:
+                f.write(runId);
+            os.rename(tmp, _runFileName(fname));
+        
+        fd, tmp = io.createTemporaryFile(directory = path if path else None, suffix = '.tmp');
+        os.close(fd);
+        writeHeader(tmp, meta_dict);
+        _linkFile(tmp, fname);
+
+
+def _waitForVolume(fname, data_file, runId, timeout):
+    """Helper to wait for a volume that is being created by another process"""
+    
+    t = time.time();
+    while not os.path.exists(fname) or (runId is not None and _readRunId(fname) != runId):
+        if time.time() - t > timeout:
+            raise RuntimeError('createVolume: header %s not created, remove the incomplete volume %s and %s.lock!' % (fname, data_file, fname));
+        time.sleep(0.05);
+
+
+def _replaceVolume(fname, data_file, meta_dict, shape, dtype, runId, timeout):
+    """Helper to replace a volume of another run by an empty one, only the first process of the run replaces it"""
+    
+    lock = fname + '.lock';
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY);
+    except OSError:
+        #another process of this run replaces the volume
+        _waitForVolume(fname, data_file, runId, timeout);
+        return;
+    
+    try:
+        #the volume may have been replaced before the lock was acquired
+        if _readRunId(fname) != runId:
+            for f in [fname, _runFileName(fname), data_file]:
+                if os.path.exists(f):
+                    os.remove(f);
+            _createVolumeFiles(fname, data_file, meta_dict, shape, dtype, runId);
+    finally:
+        os.close(fd);
+        os.remove(lock);
+
+
+def createVolume(filename, shape, dtype, runId = None, timeout = 60):
+    """Create or open a raw/mhd file pair of given size as memory map
+    
+    The volume is created atomically, i.e. when several processes try to create
+    the same volume concurrently only the first one creates it and all 
+    processes obtain a memory map into the same file. 
+    
+    If *runId* is given, a volume left by a different run, e.g. with a different
+    crop or with data of sub-stacks that are skipped in this run, is replaced
+    by an empty volume by the first process of this run, while the other 
+    processes of the run wait for it and reuse it. Without a *runId* an 
+    existing volume is reused if its size and type match.
+    
+    Arguments:
+        filename (str): file name of raw or mhd file
+        shape (tuple): size of the volume
+        dtype (dtype): data type of the volume
+        runId (str or None): id of the run writing into the volume
+        timeout (float): time in seconds to wait for a volume that is being created by another process
+    
+    Returns:
+        array: memory map of the volume
+    """
+    
+    fname = headerFileName(filename);
+    meta_dict = _volumeMetaData(fname, shape, dtype);
+    
+    path = os.path.split(fname)[0];
+    data_file = os.path.join(path, meta_dict['ElementDataFile']);
+    
+    if runId is not None and os.path.exists(fname) and _readRunId(fname) != runId:
+        _replaceVolume(fname, data_file, meta_dict, shape, dtype, runId, timeout);
+    
+    if not os.path.exists(fname):
+        _createVolumeFiles(fname, data_file, meta_dict, shape, dtype, runId);
+    
+    #the header is written last, wait for other processes creating the volume
+    _waitForVolume(fname, data_file, runId, timeout);
+    
+    volume = openVolume(fname, mode = 'r+');
+    if volume.shape != tuple(shape) or volume.dtype != numpy.dtype(dtype):
+        raise RuntimeError('createVolume: existing volume %s has size %s and type %s, expected %s and %s!' % (fname, str(volume.shape), str(volume.dtype), str(tuple(shape)), str(numpy.dtype(dtype))));
+    
+    return volume;
+
+
 def copyData(source, sink):
     """Copy a raw/mhd file pair from source to sink
     
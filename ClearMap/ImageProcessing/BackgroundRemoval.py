@@ -4,20 +4,33 @@ Functions to remove background in images
 
 The main routine subtracts a morphological opening from the original image 
 for background removal.
+
+For large structure elements the opening with a disk can be replaced by the
+fast opening with an octagon in :mod:`~ClearMap.ImageProcessing.Morphology`.
+
+Smooth backgrounds can be estimated on downsampled slices: each slice is 
+reduced by the minimum over blocks of pixels, opened with a proportionally 
+smaller structure element and the background is linearly interpolated back to 
+full resolution. :func:`benchmarkRemoveBackground` compares this to the 
+exact background.
     
 """
 #:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
 #:license: GNU, see LICENSE.txt for details.
 
 import sys
+import time
 import numpy
 
 import cv2 
 
-from ClearMap.ImageProcessing.Filter.StructureElement import structureElement
+from ClearMap.ImageProcessing.Filter.StructureElement import structureElement, structureElementFootprint
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
+from ClearMap.ImageProcessing.DataType import convertType, isUnsignedType
+from ClearMap.ImageProcessing.Morphology import openLines
 
 from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.Executor import mapSlices
 from ClearMap.Utils.ParameterTools import getParameter, writeParameter
 
 from ClearMap.Visualization.Plot import plotTiling
@@ -25,11 +38,12 @@ from ClearMap.Visualization.Plot import plotTiling
 import ClearMap.IO as io
 
 
-def removeBackground(img, removeBackgroundParameter = None, size = None, save = None, verbose = False,
-                     subStack = None, out = sys.stdout, **parameter):
+def removeBackground(img, removeBackgroundParameter = None, size = None, method = 'disk', downsample = None, save = None, verbose = False,
+                     dtype = None, inPlace = False, threads = None, subStack = None, out = sys.stdout, **parameter):
     """Remove background via subtracting a morphological opening from the original image 
     
-    Background removal is done z-slice by z-slice.
+    Background removal is done z-slice by z-slice, the slices are processed in 
+    parallel threads, see :func:`~ClearMap.Utils.Executor.mapSlices`.
     
     Arguments:
         img (array): image data
@@ -39,10 +53,21 @@ def removeBackground(img, removeBackgroundParameter = None, size = None, save =
             ========= ==================== ===========================================================
             *size*    (tuple or None)      size for the structure element of the morphological opening
                                            if None, do not correct for any background
+            *method*  (str)                'disk' for the opening with a disk via cv2 or 
+                                           'lines' for the fast opening with an octagon made of line segments, 
+                                           which costs the same for all sizes, see :mod:`~ClearMap.ImageProcessing.Morphology`
+            *downsample* (int, tuple or None) estimate the background on slices downsampled by this factor (x,y),
+                                           if None estimate it at full resolution
             *save*    (str or None)        file name to save result of this operation
                                            if None dont save to file
+            *dtype*   (str or None)        type in which the opening is calculated and of the result, 
+                                           one of the types supported by cv2, e.g. 'uint16' or 'float32', 
+                                           if None use float64 and convert back to the type of the image
+            *threads* (int or None)        number of threads processing the slices, see :func:`~ClearMap.Utils.Executor.sliceThreads`
             *verbose* (bool or int)        print / plot information about this step                                 
             ========= ==================== ===========================================================
+        inPlace (bool): subtract the background from the float image in place instead of 
+                        from a copy, *dtype* is ignored
         subStack (dict or None): sub-stack information 
         verbose (bool): print progress info 
         out (object): object to write progress info to
@@ -52,11 +77,15 @@ def removeBackground(img, removeBackgroundParameter = None, size = None, save =
     """
     
     size = getParameter(removeBackgroundParameter, "size", size);
+    method = getParameter(removeBackgroundParameter, "method", method);
+    downsample = getParameter(removeBackgroundParameter, "downsample", downsample);
     save = getParameter(removeBackgroundParameter, "save", save);    
+    dtype = getParameter(removeBackgroundParameter, "dtype", dtype);    
+    threads = getParameter(removeBackgroundParameter, "threads", threads);    
     verbose = getParameter(removeBackgroundParameter, "verbose", verbose);   
     
     if verbose:
-        writeParameter(out = out, head = 'Background Removal:', size = size, save = save);    
+        writeParameter(out = out, head = 'Background Removal:', size = size, method = method, downsample = downsample, save = save, dtype = dtype);    
     
     if size is None:    
         return img;
@@ -64,19 +93,41 @@ def removeBackground(img, removeBackgroundParameter = None, size = None, save =
     img = io.readData(img);
     
     # change type to float in order to prevent 
-    dtype = img.dtype;
-    img = numpy.array(img, dtype = float);
+    inputType = img.dtype;
+    if inPlace:
+        if not img.dtype in (numpy.float32, numpy.float64):
+            raise RuntimeError("removeBackground: in place background removal requires a float image, got %s!" % str(img.dtype));
+    elif dtype is None:
+        img = numpy.array(img, dtype = float);
+    else:
+        # the opening is smaller than the image, thus the subtraction is exact in integer types
+        img = convertType(img, dtype, out = numpy.empty(img.shape, dtype = dtype));
     
     timer = Timer();
     # background subtraction in each slice
-    se = structureElement('Disk', size).astype('uint8');
-    for z in range(img.shape[2]):
-         #img[:,:,z] = img[:,:,z] - grey_opening(img[:,:,z], structure = structureElement('Disk', (30,30)));
-         #img[:,:,z] = img[:,:,z] - morph.grey_opening(img[:,:,z], structure = self.structureELement('Disk', (150,150)));
-         img[:,:,z] = img[:,:,z] - cv2.morphologyEx(img[:,:,z], cv2.MORPH_OPEN, se)
+    if not downsample is None:
+        def background(slc):
+            return backgroundDownsampled(slc, size = size, method = method, downsample = downsample);
+    elif method == 'lines':
+        def background(slc):
+            return openLines(slc, size);
+    elif method == 'disk':
+        se = structureElement('Disk', size).astype('uint8');
+        def background(slc):
+            #return grey_opening(slc, structure = structureElement('Disk', (30,30)));
+            return cv2.morphologyEx(slc, cv2.MORPH_OPEN, se);
+    else:
+        raise RuntimeError("removeBackground: unknown method %s, expected 'disk' or 'lines'!" % str(method));
+    
+    def removeSlice(z):
+        img[:,:,z] -= background(img[:,:,z]);
     
-    img[img < 0] = 0;
-    img = numpy.array(img, dtype = dtype);
+    mapSlices(removeSlice, img.shape[2], threads = threads);
+    
+    if not isUnsignedType(img.dtype):
+        numpy.maximum(img, 0, out = img);
+    if not inPlace and dtype is None:
+        img = numpy.array(img, dtype = inputType);
     
     if not save is None:
         writeSubStack(save, img, subStack = subStack)
@@ -88,3 +139,119 @@ def removeBackground(img, removeBackgroundParameter = None, size = None, save =
         out.write(timer.elapsedTime(head = 'Background') + '\n');
     
     return img
+
+
+def _downsampleFactor(downsample):
+    """Returns the downsampling factor as (x,y) tuple"""
+    if isinstance(downsample, int):
+        return (downsample, downsample);
+    return tuple(int(d) for d in downsample[:2]);
+
+
+def backgroundDownsampled(img, size, method = 'disk', downsample = 4):
+    """Estimates the background of a 2d slice as the opening of the downsampled slice
+    
+    The slice is downsampled by the minimum over blocks of pixels, which keeps the
+    lower envelope the opening is taken of. The opening uses a structure element 
+    reduced by the downsampling factor and is linearly interpolated back to the 
+    full resolution. The background is clipped to the slice, thus the background
+    corrected slice is non-negative.
+    
+    Arguments:
+        img (array): 2d image
+        size (tuple): size of the structure element at full resolution
+        method (str): 'disk' or 'lines', see :func:`removeBackground`
+        downsample (int or tuple): downsampling factor (x,y)
+    
+    Returns:
+        array: the background of the slice
+    """
+    
+    fx, fy = _downsampleFactor(downsample);
+    nx, ny = img.shape;
+    
+    # minimum over blocks, the slice is padded by its edge values to full blocks
+    sx, sy = -(-nx // fx), -(-ny // fy);
+    small = numpy.pad(img, ((0, sx * fx - nx), (0, sy * fy - ny)), mode = 'edge');
+    small = small.reshape(sx, fx, sy, fy).min(axis = 3).min(axis = 1);
+    
+    ssize = (max(1, int(round(float(size[0]) / fx))), max(1, int(round(float(size[1]) / fy))));
+    if method == 'lines':
+        small = openLines(small, ssize);
+    elif method == 'disk':
+        small = cv2.morphologyEx(small, cv2.MORPH_OPEN, structureElement('Disk', ssize).astype('uint8'));
+    else:
+        raise RuntimeError("backgroundDownsampled: unknown method %s, expected 'disk' or 'lines'!" % str(method));
+    
+    # cv2 sizes are (width, height) = (y, x)
+    bkg = cv2.resize(small, (sy * fy, sx * fx), interpolation = cv2.INTER_LINEAR)[:nx,:ny];
+    
+    return numpy.minimum(bkg, img, out = bkg);
+
+
+def benchmarkRemoveBackground(img, removeBackgroundParameter = None, downsample = (2, 4, 8), out = sys.stdout, **parameter):
+    """Compares the downsampled background estimation to the exact background removal
+    
+    Arguments:
+        img (array): image data
+        removeBackgroundParameter (dict): parameter as in :func:`removeBackground`, 
+                                          the downsample entry is replaced
+        downsample (list): downsampling factors to compare to the exact mode
+        out (object): object to write the results to
+    
+    Returns:
+        list: list of dicts with the downsampling factor, the time in seconds and the mean and 
+              maximal absolute difference to the exact background corrected image
+    """
+    
+    img = io.readData(img);
+    removeBackgroundParameter = dict(removeBackgroundParameter or {}, verbose = False, save = None);
+    
+    results = [];
+    exact = None;
+    for factor in [None] + list(downsample):
+        start = time.time();
+        res = removeBackground(img, removeBackgroundParameter = dict(removeBackgroundParameter, downsample = factor), **parameter);
+        duration = time.time() - start;
+        
+        if exact is None:
+            exact = res.astype('float64');
+            mean, maxd = 0., 0.;
+        else:
+            diff = numpy.abs(res.astype('float64') - exact);
+            mean, maxd = diff.mean(), diff.max();
+        
+        results.append({"downsample" : factor, "time" : duration, "mean" : mean, "max" : maxd});
+        out.write('Background Removal: downsample: %s time: %.3f s speedup: %.1f mean difference: %.3f max difference: %.3f\n' % 
+                  (str(factor), duration, results[0]["time"] / max(duration, 1e-9), mean, maxd));
+    
+    return results;
+
+
+def removeBackgroundFootprint(removeBackgroundParameter = None, size = None, downsample = None, **parameter):
+    """Spatial footprint of the background removal
+    
+    The opening is an erosion followed by a dilation and thus depends on pixels
+    up to twice the radius of the structure element away. Estimating the 
+    background on downsampled slices adds the blocks of the minimum and the 
+    interpolation.
+    
+    Arguments:
+        removeBackGroundParameter (dict): parameter as in :func:`removeBackground`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the result
+    """
+    
+    size = getParameter(removeBackgroundParameter, "size", size);
+    downsample = getParameter(removeBackgroundParameter, "downsample", downsample);
+    
+    if size is None:
+        return (0, 0, 0);
+    
+    footprint = tuple(2 * f for f in structureElementFootprint(size));
+    if not downsample is None:
+        fx, fy = _downsampleFactor(downsample);
+        footprint = (footprint[0] + 3 * fx, footprint[1] + 3 * fy, footprint[2]);
+    
+    return footprint;
@@ -39,8 +39,10 @@ import ClearMap.ImageProcessing.SpotDetection
 import ClearMap.ImageProcessing.IlastikClassification
 
 from ClearMap.ImageProcessing.StackProcessing import parallelProcessStack, sequentiallyProcessStack
+from ClearMap.ImageProcessing.TissueDetection import detectTissue, detectRegions
 
 from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.ParameterTools import getParameter
     
 
 def detectCells(source, sink = None, method ="SpotDetection", processMethod = all, verbose = False, **parameter):
@@ -59,19 +61,31 @@ def detectCells(source, sink = None, method ="SpotDetection", processMethod = al
             "Ilastik"        uses predefined pipline with cell classification via Ilastik
             function         a user defined function
             ================ ============================================================
-        processMethod (str or all): 'sequential' or 'parallel'. if all its choosen 
-                                     automatically
+        processMethod (str or all): 'sequential', 'parallel' or 'threads'. if all its choosen 
+                                     automatically, 'threads' processes the sub-stacks
+                                     in parallel threads sharing the memory of this process
         verbose (bool): print info
         **parameter (dict): parameter for the image procesing sub-routines
     
     Returns:
         
+    Note:
+        If a *detectTissueParameter* dictionary is given, the processing is 
+        restricted to the bounding box of the tissue and sub-stacks without 
+        tissue are skipped, see :func:`~ClearMap.ImageProcessing.TissueDetection.detectTissue`.
+        Similarly, a *detectRegionsParameter* dictionary restricts the processing
+        to regions of the annotated atlas, 
+        see :func:`~ClearMap.ImageProcessing.TissueDetection.detectRegions`.
     """
     timer = Timer();
-        
+    
     # run segmentation
     if method == "SpotDetection":
         detectCells = ClearMap.ImageProcessing.SpotDetection.detectSpots;
+        if getParameter(parameter.get("detectSpotsParameter", None), "inPlace", parameter.get("inPlace", False)):
+            parameter.setdefault("memoryFactor", ClearMap.ImageProcessing.SpotDetection.DetectSpotsInPlaceMemoryFactor);
+        else:
+            parameter.setdefault("memoryFactor", ClearMap.ImageProcessing.SpotDetection.DetectSpotsMemoryFactor);
     elif method == 'Ilastik':
         if ClearMap.ImageProcessing.Ilastik.Initialized:
             detectCells = ClearMap.ImageProcessing.IlastikClassification.classifyCells;
@@ -81,10 +95,32 @@ def detectCells(source, sink = None, method ="SpotDetection", processMethod = al
     else:
         raise RuntimeError("detectCells: invalid method %s" % str(method));
     
+    # restrict the processing to the tissue and the atlas regions
+    masks = [];
+    for detectMask, name in ((detectTissue, "detectTissueParameter"), (detectRegions, "detectRegionsParameter")):
+        detectMaskParameter = parameter.pop(name, None);
+        if detectMaskParameter is None:
+            continue;
+        
+        footprint = getattr(detectCells, 'footprint', None);
+        if footprint is not None:
+            footprint = footprint(**parameter);
+        mask = detectMask(source, parameter.get("x", all), parameter.get("y", all), parameter.get("z", all), 
+                          detectMaskParameter, footprint = footprint, verbose = verbose);
+        parameter["x"], parameter["y"], parameter["z"] = mask.ranges;
+        if getParameter(detectMaskParameter, "skipEmpty", True):
+            masks.append(mask);
+    
+    if len(masks) > 0:
+        parameter["skipSubStack"] = lambda subStack: any([m.isEmpty(subStack) for m in masks]);
+        
     if processMethod == 'sequential':
         result = sequentiallyProcessStack(source, sink = sink, function = detectCells, verbose = verbose, **parameter);  
     elif processMethod is all or processMethod == 'parallel':
         result = parallelProcessStack(source, sink = sink, function = detectCells, verbose = verbose, **parameter);  
+    elif processMethod == 'threads':
+        parameter["executor"] = 'threads';
+        result = parallelProcessStack(source, sink = sink, function = detectCells, verbose = verbose, **parameter);  
     else:
         raise RuntimeError("detectCells: invalid processMethod %s" % str(processMethod));
     
@@ -44,6 +44,8 @@ def detectCellShape(img, peaks, detectCellShapeParameter = None, threshold = Non
             *threshold*  (float or None)     threshold to determine mask, pixel below this are background
                                              if None no mask is generated
             *save*       (tuple)             size of the box on which to perform the *method*
+            *extent*     (tuple)             maximal radius of a cell in pixel, only used to determine
+                                             the overlap of sub-stacks, see :func:`detectCellShapeFootprint`
             *verbose*    (bool or int)       print / plot information about this step 
             ============ =================== ===========================================================
         verbose (bool): print progress info 
@@ -89,6 +91,35 @@ def detectCellShape(img, peaks, detectCellShapeParameter = None, threshold = Non
     return imgws
 
 
+DefaultCellShapeExtent = (5, 5, 5);
+"""tuple: default maximal radius of a cell in pixel along x,y,z"""
+
+
+def detectCellShapeFootprint(detectCellShapeParameter = None, threshold = None, extent = DefaultCellShapeExtent, **parameter):
+    """Spatial footprint of the cell shape detection and measurements
+    
+    The watershed is not limited in extent, the footprint is thus given by the
+    maximal radius of a cell.
+    
+    Arguments:
+        detectCellShapeParameter (dict): parameter as in :func:`detectCellShape`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the result
+    """
+    
+    threshold = getParameter(detectCellShapeParameter, "threshold", threshold);
+    extent    = getParameter(detectCellShapeParameter, "extent", extent);
+    
+    if threshold is None:
+        return (0, 0, 0);
+    
+    if not isinstance(extent, tuple):
+        extent = (extent, extent, extent);
+    
+    return tuple(extent);
+
+
 def findCellSize(imglabel, findCelSizeParameter = None, maxLabel = None, verbose = False, 
                  out = sys.stdout, **parameter):
     """Find cell size given cell shapes as labled image
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Data type policy of the image processing steps
+
+The image processing steps accept a *dtype* parameter that sets the type of
+the images they work on and return:
+
+    ============= =================================================================
+    dtype         Description
+    ============= =================================================================
+    None          the default type of each step, e.g. float64 for the background
+                  removal and float32 for the DoG filter
+    'float64'     double precision
+    'float32'     single precision, halves the memory of double precision
+    'uint16'      integer path, morphological operations are done natively
+                  (e.g. by cv2) and images are a quarter of the size of float64
+    ============= =================================================================
+
+Integer types are only used by steps that do not need fractional values, the
+DoG filter works in float32 for integer types.
+
+Converting an image to an integer type truncates the values as numpy does
+and clips them to the range of the type.
+
+Example:
+    >>> import ClearMap.ImageProcessing.DataType as dt
+    >>> img = dt.convertType(numpy.array([-1.2, 3.7, 70000]), 'uint16');
+    >>> print img
+    [    0     3 65535]
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import numpy
+
+
+def dataType(dtype, default = None):
+    """Returns the data type for a processing step
+
+    Arguments:
+        dtype (str, dtype or None): data type of the policy
+        default (str, dtype or None): default type of the step if *dtype* is None
+
+    Returns:
+        dtype or None: the data type
+    """
+
+    if dtype is None:
+        dtype = default;
+    if dtype is None:
+        return None;
+    return numpy.dtype(dtype);
+
+
+def isIntegerType(dtype):
+    """Checks if a data type is an integer type
+
+    Arguments:
+        dtype (str, dtype or None): data type
+
+    Returns:
+        bool: True if integer type
+    """
+
+    return dtype is not None and numpy.issubdtype(numpy.dtype(dtype), numpy.integer);
+
+
+def isUnsignedType(dtype):
+    """Checks if a data type is an unsigned integer type
+
+    Arguments:
+        dtype (str, dtype or None): data type
+
+    Returns:
+        bool: True if unsigned integer type
+    """
+
+    return dtype is not None and numpy.issubdtype(numpy.dtype(dtype), numpy.unsignedinteger);
+
+
+def floatType(dtype, default = 'float32'):
+    """Returns the float type to use for computations that need fractional values
+
+    Arguments:
+        dtype (str, dtype or None): data type of the policy
+        default (str or dtype): float type used for None or integer types
+
+    Returns:
+        dtype: the float data type
+    """
+
+    if dtype is None or not numpy.issubdtype(numpy.dtype(dtype), numpy.floating):
+        return numpy.dtype(default);
+    return numpy.dtype(dtype);
+
+
+def clipType(img, dtype):
+    """Truncates and clips a float image in place to the values of a data type
+
+    Arguments:
+        img (array): float image
+        dtype (str, dtype or None): data type, if None or not an integer type the image is not changed
+
+    Returns:
+        array: the image
+    """
+
+    if isIntegerType(dtype):
+        info = numpy.iinfo(dtype);
+        numpy.trunc(img, out = img);
+        numpy.clip(img, info.min, info.max, out = img);
+    return img;
+
+
+def convertType(img, dtype, out = None):
+    """Converts an image to a data type
+
+    Images converted to integer types are clipped to the range of the type 
+    and truncated. The conversion is done slice by slice to avoid large
+    temporary arrays.
+
+    Arguments:
+        img (array): image
+        dtype (str, dtype or None): data type, if None return the image
+        out (array or None): array to write the result to
+
+    Returns:
+        array: the converted image, the image itself if it is already of this type
+    """
+
+    if dtype is None:
+        return img;
+
+    dtype = numpy.dtype(dtype);
+    if img.dtype == dtype and out is None:
+        return img;
+
+    if out is None:
+        out = numpy.empty(img.shape, dtype = dtype);
+
+    if isIntegerType(dtype):
+        info = numpy.iinfo(dtype);
+        if img.ndim < 3:
+            out[:] = numpy.clip(img, info.min, info.max);
+        else:
+            for z in range(img.shape[2]):
+                out[:,:,z] = numpy.clip(img[:,:,z], info.min, info.max);
+    else:
+        out[:] = img;
+
+    return out;
+
+
+
+def test():
+    """Test DataType module"""
+    import ClearMap.ImageProcessing.DataType as self
+    reload(self)
+
+    img = numpy.array([[-1.2, 3.7, 70000]]);
+    print self.convertType(img, 'uint16')
+    print self.dataType(None, 'float32'), self.floatType('uint16'), self.isIntegerType('uint16')
+
+
+if __name__ == "__main__":
+    test();
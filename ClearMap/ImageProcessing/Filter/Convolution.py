@@ -11,11 +11,53 @@ Author
 
     Modified by Chirstoph Kirst to optimize memory and sped and integration into ClearMap.
     The Rockefeller University, New York City, 2015
+
+Caching
+-------
+    Sub-stacks of a data set usually have the same shape and are convolved with 
+    the same kernel. The padded FFT shapes and the kernel spectra are therefore 
+    cached, so only the data is transformed on each call. The caches keep the 
+    :const:`FFTCacheSize` most recently used entries, see :func:`kernelSpectrum`
+    and :func:`clearCache`. The caches are shared by all threads and guarded 
+    by a lock.
+    
+    The transforms are real to complex, float32 data is transformed in 
+    float32 / complex64.
+
+Blockwise convolution
+---------------------
+    For large volumes the padded transforms of the whole data need several
+    times its memory. :func:`convolveBlockwise` tiles the output into blocks 
+    and convolves each with the cached kernel spectrum using overlap-save, 
+    so the memory is bounded by the block size.
 """
 
 import numpy
+import hashlib
+import threading
 import scipy.fftpack as fft
 
+from collections import OrderedDict
+
+
+FFTCacheSize = 8;
+"""Maximal number of kernel spectra and FFT shapes kept in the caches
+
+See Also:
+    :func:`kernelSpectrum`
+"""
+
+DefaultBlockSize = (256, 256, 128);
+"""Default size of the output blocks of the blockwise convolution
+
+See Also:
+    :func:`convolveBlockwise`
+"""
+
+_fftShapes = OrderedDict();
+_kernelSpectra = OrderedDict();
+_cacheLock = threading.Lock();
+
 
 def _next_regular(target):
     """
@@ -96,51 +138,163 @@ def _centered(arr, newsize):
     return arr[tuple(myslice)]
 
 
-#def _rfftn(a, s=None, axes=None):
-#    s, axes = _cook_nd_args(a, s, axes);
-#    a = fft.rfft(a, s[-1], axes[-1], overwrite_x = True)
-#    for ii in range(len(axes)-1):
-#        a = fft.fft(a, s[ii], axes[ii], overwrite_x = True)
-#    return a
+def _rfftn(a, s):
+    """Real to complex fft returning the half spectrum along the last axis
+    
+    Scipy's fftpack keeps float32 but only has a packed real transform, which
+    is unpacked into the complex half spectrum before the remaining axes are 
+    transformed.
+    """
+    n = s[-1];
+    r = fft.rfft(a, n, axis = -1);
+    c = numpy.empty(r.shape[:-1] + (n // 2 + 1,), dtype = numpy.result_type(r.dtype, numpy.complex64));
+    m = (n - 1) // 2;
+    c[...,0] = r[...,0];
+    c[...,1:m+1].real = r[...,1:2*m:2];
+    c[...,1:m+1].imag = r[...,2:2*m+1:2];
+    if n % 2 == 0:
+        c[...,-1] = r[...,-1];
+    del r;
+    
+    for ii in range(len(s)-1):
+        c = fft.fft(c, s[ii], ii, overwrite_x = True);
+    return c;
 
-#def _irfftn(a, s=None, axes=None):   
-#    #a = asarray(a).astype('complex64')
-#    s, axes = _cook_nd_args(a, s, axes, invreal=1)
-#    for ii in range(len(axes)-1):
-#        a = fft.ifft(a, s[ii], axes[ii], overwrite_x = True);
-#    a = fft.ifft(a, s[-1], axes[-1], overwrite_x = True);
-#    a = a.real;
-#    return a
 
-def _rfftn(a, s=None, axes=None):
-    return fft.fftn(a, shape = s, axes = axes);
+def _irfftn(c, s):
+    """Inverse of :func:`_rfftn`"""
+    for ii in range(len(s)-1):
+        c = fft.ifft(c, s[ii], ii, overwrite_x = True);
+    
+    n = s[-1];
+    r = numpy.empty(c.shape[:-1] + (n,), dtype = c.real.dtype);
+    m = (n - 1) // 2;
+    r[...,0] = c[...,0].real;
+    r[...,1:2*m:2] = c[...,1:m+1].real;
+    r[...,2:2*m+1:2] = c[...,1:m+1].imag;
+    if n % 2 == 0:
+        r[...,-1] = c[...,-1].real;
+    del c;
+    
+    return fft.irfft(r, n, axis = -1, overwrite_x = True);
 
-def _irfftn(a, s=None, axes=None):
-    return fft.ifftn(a, shape = s, axes = axes).real;
 
+def _cached(cache, key, create):
+    """Returns a cached value moving it to the end of the cache, creates it if not cached"""
+    with _cacheLock:
+        value = cache.pop(key, None);
+        if value is not None:
+            cache[key] = value;
+            return value;
+    
+    # create outside of the lock to not serialize threads on different keys
+    value = create();
+    
+    with _cacheLock:
+        cache.pop(key, None);
+        while len(cache) >= FFTCacheSize:
+            cache.popitem(last = False);
+        cache[key] = value;
+    return value;
 
 
-def convolve(x, k, mode = 'same'):
+def fftShape(shape):
+    """Returns the padded shape for fast ffts
+    
+    Arguments:
+        shape (tuple): shape of the data
+    
+    Returns:
+        tuple: shape with each dimension increased to the next regular number
+    """
+    
+    shape = tuple([int(d) for d in shape]);
+    return _cached(_fftShapes, shape, lambda: tuple([_next_regular(d) for d in shape]));
+
+
+def fftType(dtype):
+    """Returns the float type of the transforms of data of a given type
+    
+    Arguments:
+        dtype (dtype): type of the data
+    
+    Returns:
+        dtype: float64 for float64 data and float32 otherwise
+    """
+    
+    if numpy.dtype(dtype) == numpy.float64:
+        return numpy.dtype(numpy.float64);
+    else:
+        return numpy.dtype(numpy.float32);
+
+
+def kernelSpectrum(k, fshape, dtype = numpy.float32):
+    """Returns the spectrum of a kernel, the spectra are cached
+    
+    The cache is keyed by the padded shape, the data type and the content of 
+    the kernel, so kernels recreated for each sub-stack share their spectrum.
+    
+    Arguments:
+        k (array): filter kernel
+        fshape (tuple): padded shape of the transform
+        dtype (dtype): float type of the transform
+        
+    Returns:
+        array: read only half spectrum of the kernel as returned by :func:`_rfftn`
+    """
+    
+    k = numpy.ascontiguousarray(k, dtype = dtype);
+    key = (tuple(fshape), k.shape, k.dtype.str, hashlib.sha1(k).hexdigest());
+    
+    def create():
+        spectrum = _rfftn(k, list(fshape));
+        spectrum.flags.writeable = False;
+        return spectrum;
+    
+    return _cached(_kernelSpectra, key, create);
+
+
+def clearCache():
+    """Clears the caches of kernel spectra and FFT shapes"""
+    with _cacheLock:
+        _fftShapes.clear();
+        _kernelSpectra.clear();
+
+
+def convolve(x, k, mode = 'same', blockSize = None):
     """Convolve array with kernel using float32 / complex64, optimized for memory consumption and speed
     
     Arguments:
         x (array): data to be convolved
         k (array): filter kernel
+        mode (str): 'same' or 'full'
+        blockSize (tuple or None): if not None convolve blockwise with this output block size, 
+                                   see :func:`convolveBlockwise`
         
     Returns:
         array: convolution
+        
+    Note:
+        The spectrum of the kernel is cached, see :func:`kernelSpectrum`.
     """
     
+    if not blockSize is None:
+        return convolveBlockwise(x, k, mode = mode, blockSize = blockSize);
+    
     s1 = numpy.array(x.shape)
     s2 = numpy.array(k.shape)      
     shape =  s1 + s2 - 1;
     
-    fshape = [_next_regular(int(d)) for d in shape];
+    fshape = list(fftShape(shape));
     fslice = tuple([slice(0, int(sz)) for sz in shape]);
     
+    dtype = fftType(x.dtype);
+    
     #scipys fftpack keeps float32    
     #ret = irfftn(rfftn(in1, fshape) * rfftn(in2, fshape), fshape)[fslice].copy()
-    ret = _irfftn(_rfftn(x, fshape) * _rfftn(k, fshape), fshape)[fslice];
+    ret = _rfftn(x.astype(dtype, copy = False), fshape);
+    ret *= kernelSpectrum(k, fshape, dtype = dtype);
+    ret = _irfftn(ret, fshape)[fslice];
     
     if mode == "full":
         return ret
@@ -149,6 +303,85 @@ def convolve(x, k, mode = 'same'):
     else:
         raise ValueError("Acceptable mode flags are 'same' or 'full'.")
    
+
+
+def convolveBlockwise(x, k, mode = 'same', blockSize = DefaultBlockSize, output = None):
+    """Convolve array with kernel blockwise using overlap-save
+    
+    The output is tiled into blocks, the input of each block including the
+    kernel overlap is transformed in a zero padded buffer of a fixed FFT shape 
+    and multiplied with the cached kernel spectrum.
+    
+    Arguments:
+        x (array): data to be convolved
+        k (array): filter kernel
+        mode (str): 'same' or 'full'
+        blockSize (tuple or None): maximal size of the output blocks, the data is split evenly 
+                                   into blocks, if None use :const:`DefaultBlockSize`
+        output (array or None): array to write the result to, if None a new array is allocated
+        
+    Returns:
+        array: convolution
+    """
+    
+    s1 = numpy.array(x.shape);
+    s2 = numpy.array(k.shape);
+    
+    if mode == "full":
+        shape = s1 + s2 - 1;
+        offset = numpy.zeros(len(s1), dtype = int);
+    elif mode == "same":
+        shape = s1;
+        offset = (s2 - 1) // 2;
+    else:
+        raise ValueError("Acceptable mode flags are 'same' or 'full'.")
+    
+    if blockSize is None:
+        blockSize = DefaultBlockSize;
+    blockSize = numpy.array(blockSize[:len(shape)]);
+    blockSize = numpy.minimum(blockSize, shape);
+    
+    # split evenly into blocks with a fixed fft shape
+    nblocks = [int(numpy.ceil(float(s) / b)) for s,b in zip(shape, blockSize)];
+    blockSize = numpy.array([int(numpy.ceil(float(s) / n)) for s,n in zip(shape, nblocks)]);
+    fshape = list(fftShape(blockSize + s2 - 1));
+    
+    dtype = fftType(x.dtype);
+    spectrum = kernelSpectrum(k, fshape, dtype = dtype);
+    
+    if output is None:
+        output = numpy.empty(tuple(shape), dtype = dtype);
+    elif tuple(output.shape) != tuple(shape):
+        raise RuntimeError("convolveBlockwise: output shape %s does not match the convolution shape %s!" % (str(output.shape), str(tuple(shape))));
+    
+    buf = numpy.zeros(fshape, dtype = dtype);
+    
+    for index in numpy.ndindex(*nblocks):
+        lo = numpy.array(index) * blockSize;
+        hi = numpy.minimum(lo + blockSize, shape);
+        
+        # input range of the block, zero outside the data
+        ilo = lo + offset - s2 + 1;
+        ihi = hi + offset;
+        clo = numpy.maximum(ilo, 0);
+        chi = numpy.minimum(ihi, s1);
+        
+        buf[:] = 0;
+        bslice = tuple([slice(l - il, h - il) for l,h,il in zip(clo, chi, ilo)]);
+        xslice = tuple([slice(l, h) for l,h in zip(clo, chi)]);
+        buf[bslice] = x[xslice];
+        
+        ret = _rfftn(buf, fshape);
+        ret *= spectrum;
+        ret = _irfftn(ret, fshape);
+        
+        # the first s2 - 1 values are affected by the circular boundary
+        rslice = tuple([slice(d - 1, d - 1 + h - l) for d,l,h in zip(s2, lo, hi)]);
+        oslice = tuple([slice(l, h) for l,h in zip(lo, hi)]);
+        output[oslice] = ret[rslice];
+    
+    return output;
+
         
 def _test():
     """Test for Convolution module"""
@@ -177,6 +410,14 @@ def _test():
     diff = numpy.abs(cs-co);
     print diff.max()
     
+    print 'cached spectra:'
+    co = convolve(x,k);
+    print len(_kernelSpectra)
+    
+    print 'blockwise difference:'
+    cb = convolveBlockwise(x, k, blockSize = (20,20,20));
+    print numpy.abs(cb-co).max()
+    
 if __name__ == "__main__":
     _test()
     
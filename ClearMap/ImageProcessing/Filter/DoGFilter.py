@@ -7,13 +7,15 @@ DoG filter module
 #:license: GNU, see LICENSE.txt for details.
 
 import sys
+import numpy
 
-from scipy.ndimage.filters import correlate
 #from scipy.signal import fftconvolve
 
-from ClearMap.ImageProcessing.Filter.FilterKernel import filterKernel
+from ClearMap.ImageProcessing.Filter.SeparableFilter import correlateFilterKernel
+from ClearMap.ImageProcessing.Filter.StructureElement import structureElementFootprint
 
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
+from ClearMap.ImageProcessing.DataType import floatType
 
 from ClearMap.Utils.Timer import Timer
 from ClearMap.Utils.ParameterTools import getParameter, writeParameter
@@ -26,7 +28,7 @@ from ClearMap.Visualization.Plot import plotTiling
 
 
 def filterDoG(img, filterDoGParameter = None,  size = None, sigma = None, sigma2 = None, save = None, verbose = None,
-              subStack = None, out = sys.stdout, **parameter):
+              dtype = None, separable = True, buffer = None, subStack = None, out = sys.stdout, **parameter):
     """Difference of Gaussians (DoG) filter step
     
     Arguments:
@@ -41,8 +43,14 @@ def filterDoG(img, filterDoGParameter = None,  size = None, sigma = None, sigma2
             *sigma2*  (tuple or None)      std of inner Guassian, if None autmatically determined from size
             *save*    (str or None)        file name to save result of this operation
                                            if None dont save to file 
+            *dtype*   (str or None)        float type of the result, float32 if None or an integer type, 
+                                           see :mod:`~ClearMap.ImageProcessing.DataType`
+            *separable* (bool)             filter as the difference of two separable Gaussians, 
+                                           see :mod:`~ClearMap.ImageProcessing.Filter.SeparableFilter`
             *verbose* (bool or int)        print progress information                            
             ========= ==================== ================================================================
+        buffer (array or None): float array of the image size to write the result to, 
+                                if None a new array is allocated
         subStack (dict or None): sub-stack information 
         out (object): object to write progress info to
         
@@ -56,21 +64,30 @@ def filterDoG(img, filterDoGParameter = None,  size = None, sigma = None, sigma2
     dogSigma = getParameter(filterDoGParameter, "sigma", sigma);
     dogSigma2= getParameter(filterDoGParameter, "sigma2",sigma2);
     dogSave  = getParameter(filterDoGParameter, "save",  save);
+    dtype    = getParameter(filterDoGParameter, "dtype",  dtype);
+    separable= getParameter(filterDoGParameter, "separable",  separable);
     verbose  = getParameter(filterDoGParameter, "verbose",  verbose);
     
     if verbose:
-        writeParameter(out = out, head = 'DoG:', size = dogSize, sigma = dogSigma, sigma2 = dogSigma2, save = dogSave);
+        writeParameter(out = out, head = 'DoG:', size = dogSize, sigma = dogSigma, sigma2 = dogSigma2, save = dogSave, dtype = dtype, separable = separable);
     #DoG filter
-    img = img.astype('float32'); # always convert to float for downstream processing
+    dtype = floatType(dtype);
+    if buffer is None:
+        buffer = dtype.type;
         
     if not dogSize is None:
-        fdog = filterKernel(ftype = 'DoG', size = dogSize, sigma = dogSigma, sigma2 = dogSigma2);
-        fdog = fdog.astype('float32');
         #img = correlate(img, fdog);
         #img = scipy.signal.correlate(img, fdog);
-        img = correlate(img, fdog);
+        # correlate directly into the float result, the input is converted on the fly
+        img = correlateFilterKernel(img, ftype = 'DoG', size = dogSize, sigma = dogSigma, sigma2 = dogSigma2, 
+                                    separable = separable, output = buffer, dtype = dtype);
         #img = convolve(img, fdog, mode = 'same');
-        img[img < 0] = 0;
+        numpy.maximum(img, 0, out = img);
+    elif isinstance(buffer, numpy.ndarray):
+        buffer[:] = img;
+        img = buffer;
+    else:
+        img = img.astype(dtype, copy = False); # always convert to float for downstream processing
     
     if verbose > 1:
         plotTiling(img);
@@ -82,3 +99,21 @@ def filterDoG(img, filterDoGParameter = None,  size = None, sigma = None, sigma2
         out.write(timer.elapsedTime(head = 'DoG') + '\n');
     
     return img
+
+
+def filterDoGFootprint(filterDoGParameter = None, size = None, **parameter):
+    """Spatial footprint of the DoG filter
+    
+    Arguments:
+        filterDoGParameter (dict): parameter as in :func:`filterDoG`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the result
+    """
+    
+    dogSize = getParameter(filterDoGParameter, "size", size);
+    
+    if dogSize is None:
+        return (0, 0, 0);
+    
+    return structureElementFootprint(dogSize);
@@ -8,10 +8,9 @@ Linear filter module
 
 import sys
 
-from scipy.ndimage.filters import correlate
 #from scipy.signal import fftconvolve
 
-from ClearMap.ImageProcessing.Filter.FilterKernel import filterKernel
+from ClearMap.ImageProcessing.Filter.SeparableFilter import correlateFilterKernel
 
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
 
@@ -21,7 +20,7 @@ from ClearMap.Visualization.Plot import plotTiling
 
 
 def filterLinear(img, filterLinearParameter = None, ftype = None, size = None, sigma = None, sigma2 = None, save = None, 
-                 subStack = None, verbose = False, out = sys.stdout, **parameter):
+                 separable = True, subStack = None, verbose = False, out = sys.stdout, **parameter):
     """Applies a linear filter to the image
     
     Arguments:
@@ -38,6 +37,8 @@ def filterLinear(img, filterLinearParameter = None, ftype = None, size = None, s
             *sigma2*  (tuple or None)      std of inner Guassian, if None autmatically determined from size
             *save*    (str or None)        file name to save result of this operation
                                            if None dont save to file 
+            *separable* (bool)             filter by successive 1d correlations if faster, 
+                                           see :mod:`~ClearMap.ImageProcessing.Filter.SeparableFilter`
             *verbose* (bool or int)        print progress information       
             ========= ==================== ================================================================
         subStack (dict or None): sub-stack information 
@@ -58,10 +59,11 @@ def filterLinear(img, filterLinearParameter = None, ftype = None, size = None, s
     sigma   = getParameter(filterLinearParameter, "sigma",  sigma);
     sigma2  = getParameter(filterLinearParameter, "sigma2", sigma2);
     save    = getParameter(filterLinearParameter, "save",   save);
+    separable = getParameter(filterLinearParameter, "separable", separable);
     verbose = getParameter(filterLinearParameter, "verbose",verbose);
 
     if verbose:
-        writeParameter(out = out, head = 'Linear Filter:', ftype = ftype, size = size, sigma = sigma, sigma2 = sigma2, save = save);
+        writeParameter(out = out, head = 'Linear Filter:', ftype = ftype, size = size, sigma = sigma, sigma2 = sigma2, save = save, separable = separable);
 
     if ftype is None:
         return img;
@@ -70,11 +72,9 @@ def filterLinear(img, filterLinearParameter = None, ftype = None, size = None, s
     img = img.astype('float32'); # always convert to float for downstream processing
         
     if not size is None:
-        fil = filterKernel(ftype = ftype, size = size, sigma = sigma, sigma2 = sigma2);
-        fil = fil.astype('float32');
         #img = correlate(img, fdog);
         #img = scipy.signal.correlate(img, fdog);
-        img = correlate(img, fil);
+        img = correlateFilterKernel(img, ftype = ftype, size = size, sigma = sigma, sigma2 = sigma2, separable = separable);
         #img = convolve(img, fdog, mode = 'same');
         img[img < 0] = 0;
     
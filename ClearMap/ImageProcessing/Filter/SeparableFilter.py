@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Separable filter module
+
+Correlating an image with a dense 3d kernel of size :math:`k_x k_y k_z` costs
+:math:`k_x k_y k_z` operations per voxel. Many of the kernels in
+:mod:`~ClearMap.ImageProcessing.Filter.FilterKernel` are sums of a few outer
+products of 1d kernels:
+
+.. math:
+   K = \\sum_t k^t_x \\otimes k^t_y \\otimes k^t_z
+
+and the correlation is done as successive 1d correlations along the axes with
+:math:`\\sum_t (k_x + k_y + k_z)` operations per voxel.
+
+=============== ==================================================================
+Type            Decomposition
+=============== ==================================================================
+``gaussian``    exact, a single term
+``dog``         exact, the difference of two Gaussians, two terms
+``mean``        exact, a single term
+others          low rank approximation via singular value decompositions
+=============== ==================================================================
+
+The separable correlation is only used if it needs fewer operations than the
+dense one, see :func:`correlateFilterKernel`.
+
+Example:
+    >>> import ClearMap.ImageProcessing.Filter.SeparableFilter as sf
+    >>> kernels = sf.separableFilterKernel(ftype = 'DoG', size = (7,7,4));
+    >>> print len(kernels), [len(k) for k in kernels[0]]
+    2 [7, 7, 4]
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import numpy
+import math
+
+from scipy.ndimage.filters import correlate, correlate1d
+
+from ClearMap.ImageProcessing.Filter.FilterKernel import filterKernel
+
+
+def separateKernel(kernel, tolerance = 1e-6):
+    """Decomposes a kernel into a sum of outer products of 1d kernels
+
+    The kernel is decomposed recursively by singular value decompositions of
+    its unfoldings along the first axis.
+
+    Arguments:
+        kernel (array): the kernel
+        tolerance (float): relative error of the decomposition in the Frobenius norm
+
+    Returns:
+        list: list of tuples of 1d kernels, one for each axis
+    """
+
+    kernel = numpy.asarray(kernel, dtype = float);
+    return _separateKernel(kernel, tolerance * numpy.sqrt((kernel * kernel).sum()));
+
+
+def _separateKernel(kernel, tolerance):
+    """Decomposes a kernel up to an absolute error, see :func:`separateKernel`"""
+
+    if kernel.ndim == 1:
+        return [(kernel,)];
+
+    u, s, v = numpy.linalg.svd(kernel.reshape(kernel.shape[0], -1), full_matrices = False);
+
+    # smallest rank with a residual below the tolerance
+    residual = numpy.sqrt(numpy.cumsum((s * s)[::-1])[::-1]);
+    rank = max(1, numpy.sum(residual > tolerance));
+
+    kernels = [];
+    for r in range(rank):
+        for k in _separateKernel(v[r].reshape(kernel.shape[1:]), tolerance / math.sqrt(rank)):
+            kernels.append((u[:,r] * s[r],) + k);
+
+    return kernels;
+
+
+def separableFilterKernel(ftype = 'Gaussian', size = (5,5,5), sigma = None, radius = None, sigma2 = None, tolerance = 1e-6):
+    """Creates a filter kernel of a special type as a sum of outer products of 1d kernels
+
+    Arguments:
+        ftype (str): filter type, see :ref:`FilterTypes`
+        size (array or tuple): size of the filter kernel
+        sigma (tuple or float): std for the first gaussian (if present)
+        radius (tuple or float): radius of the kernel (if applicable)
+        sigma2 (tuple or float): std of a second gaussian (if present)
+        tolerance (float): relative error of the decomposition of kernels that are not separable
+
+    Returns:
+        list: list of tuples of 1d kernels, one for each axis
+
+    See Also:
+        :func:`~ClearMap.ImageProcessing.Filter.FilterKernel.filterKernel`
+    """
+
+    if ftype.lower() == 'dog':
+        # difference of two normalized Gaussians, see filterKernel3D
+        if sigma2 is None:
+            sigma2 = numpy.array(size) / 2. / math.sqrt(2 * math.log(2));
+        if sigma is None:
+            sigma = numpy.array(sigma2) / 1.5;
+
+        ker = filterKernel(ftype = 'Gaussian', size = size, sigma = tuple(sigma));
+        sub = filterKernel(ftype = 'Gaussian', size = size, sigma = tuple(sigma2));
+        kernels = separateKernel(ker, tolerance = tolerance);
+        kernels += [(-k[0],) + k[1:] for k in separateKernel(sub, tolerance = tolerance)];
+        return kernels;
+
+    else:
+        ker = filterKernel(ftype = ftype, size = size, sigma = sigma, radius = radius, sigma2 = sigma2);
+        return separateKernel(ker, tolerance = tolerance);
+
+
+def isSeparable(kernels, size):
+    """Checks if the separable correlation needs fewer operations than the dense one
+
+    Arguments:
+        kernels (list): list of tuples of 1d kernels as returned by :func:`separateKernel`
+        size (tuple): size of the dense kernel
+
+    Returns:
+        bool: True if the separable correlation is faster
+    """
+
+    return len(kernels) * numpy.sum(size) < numpy.prod(size);
+
+
+def correlateSeparable(img, kernels, output = None):
+    """Correlates an image with a sum of outer products of 1d kernels
+
+    Each term is correlated by successive 1d correlations along the axes, the
+    passes after the first are done in place. The boundary condition is the
+    same as for :func:`scipy.ndimage.filters.correlate`.
+
+    Arguments:
+        img (array): image data
+        kernels (list): list of tuples of 1d kernels as returned by :func:`separateKernel`
+        output (array, dtype or None): array or type of the result, if None float32
+
+    Returns:
+        array: correlated image
+    """
+
+    if output is None:
+        output = numpy.float32;
+
+    tmp = None;
+    for t, kernel in enumerate(kernels):
+        res = correlate1d(img, kernel[0], axis = 0, output = output if t == 0 else tmp);
+        for d in range(1, len(kernel)):
+            correlate1d(res, kernel[d], axis = d, output = res);
+
+        if t == 0:
+            output = res;
+            if len(kernels) > 1:
+                tmp = numpy.empty(output.shape, dtype = output.dtype);
+        else:
+            output += res;
+
+    return output;
+
+
+def correlateFilterKernel(img, ftype = 'Gaussian', size = (5,5,5), sigma = None, radius = None, sigma2 = None,
+                          separable = True, output = None, dtype = numpy.float32):
+    """Correlates an image with a filter kernel of a special type
+
+    Arguments:
+        img (array): image data
+        ftype (str): filter type, see :ref:`FilterTypes`
+        size (array or tuple): size of the filter kernel
+        sigma (tuple or float): std for the first gaussian (if present)
+        radius (tuple or float): radius of the kernel (if applicable)
+        sigma2 (tuple or float): std of a second gaussian (if present)
+        separable (bool): use successive 1d correlations if they need fewer operations
+        output (array or None): array to write the result to, if None a new array is allocated
+        dtype (dtype): float type of the kernel and the result
+
+    Returns:
+        array: correlated image
+    """
+
+    if output is None:
+        output = dtype;
+
+    if separable:
+        kernels = separableFilterKernel(ftype = ftype, size = size, sigma = sigma, radius = radius, sigma2 = sigma2);
+        if isSeparable(kernels, size):
+            return correlateSeparable(img, kernels, output = output);
+
+    ker = filterKernel(ftype = ftype, size = size, sigma = sigma, radius = radius, sigma2 = sigma2);
+    ker = ker.astype(dtype);
+    return correlate(img, ker, output = output);
+
+
+
+def test():
+    """Test SeparableFilter module"""
+    import ClearMap.ImageProcessing.Filter.SeparableFilter as self
+    reload(self)
+
+    from ClearMap.Utils.Timer import Timer
+
+    img = numpy.random.rand(200, 200, 50).astype('float32');
+    for ftype, size in [('Gaussian', (7,7,4)), ('DoG', (7,7,4)), ('Mean', (5,5,5)), ('Sphere', (7,7,4))]:
+        kernels = self.separableFilterKernel(ftype = ftype, size = size);
+        print ftype, size, 'terms:', len(kernels), 'separable:', self.isSeparable(kernels, size)
+
+        timer = Timer();
+        dense = self.correlateFilterKernel(img, ftype = ftype, size = size, separable = False);
+        print timer.elapsedTime(head = 'dense')
+        timer = Timer();
+        sep = self.correlateSeparable(img, kernels);
+        print timer.elapsedTime(head = 'separable')
+        print 'max error:', numpy.abs(dense - sep).max()
+
+
+if __name__ == "__main__":
+    test();
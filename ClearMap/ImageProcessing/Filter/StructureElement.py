@@ -28,8 +28,13 @@ Note:
 import numpy
 
 
+_structureElements = {};
+
+
 def structureElement(setype = 'Disk', sesize = (3,3)):
     """Creates specific 2d and 3d structuring elements
+    
+    Structure elements are cached and returned as read-only arrays.
       
     Arguments:
         setype (str): structure element type, see :ref:`StructureElementTypes`
@@ -39,11 +44,20 @@ def structureElement(setype = 'Disk', sesize = (3,3)):
         array: structure element
     """
     
+    key = (setype, tuple(sesize));
+    if key in _structureElements:
+        return _structureElements[key];
+    
     ndim = len(sesize); 
     if ndim == 2:
-        return structureElement2D(setype, sesize);
+        se = structureElement2D(setype, sesize);
     else:
-        return structureElement3D(setype, sesize);
+        se = structureElement3D(setype, sesize);
+    
+    se.flags.writeable = False;
+    _structureElements[key] = se;
+    
+    return se;
 
 
 
@@ -73,6 +87,21 @@ def structureElementOffsets(sesize):
     return o.astype('int');
 
 
+def structureElementFootprint(sesize):
+    """Calculates the maximal distance of the pixels of a structure element to its center
+    
+    Arguments:
+        sesize (array or tuple): size of the structure element
+    
+    Returns:
+        tuple: maximal distance to the center in pixel along the x,y,z axes
+    """
+    
+    o = structureElementOffsets(sesize);
+    # the upper offset is exclusive
+    return tuple(int(max(o[i,0], o[i,1] - 1)) for i in range(3));
+
+
 def structureElement2D(setype = 'Disk', sesize = (3,3)):
     """Creates specific 2d structuring elements
     
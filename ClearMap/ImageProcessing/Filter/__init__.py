@@ -7,6 +7,9 @@ A set of linear filters can be applied to the data using
 Because its utility for cell detection the difference of Gaussians filter
 is implemented directly in :mod:`~ClearMap.ImageProcessing.Filter.DoGFilter`.
 
+Both filter separable kernels by successive 1d correlations via 
+:mod:`~ClearMap.ImageProcessing.Filter.SeparableFilter`.
+
 The fitler kernels defined in :mod:`~ClearMap.ImageProcessing.Filter.FilterKernel` 
 can be used in combination with the :mod:`~ClearMap.ImageProcessing.Convolution` 
 module.
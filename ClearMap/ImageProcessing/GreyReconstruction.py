@@ -22,8 +22,10 @@ import sys
 
 from ClearMap.ImageProcessing.Filter.StructureElement import structureElement
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
+from ClearMap.ImageProcessing.DataType import convertType
 
 from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.Executor import mapSlices
 from ClearMap.Utils.ParameterTools import getParameter, writeParameter
 
 from ClearMap.Visualization.Plot import plotTiling
@@ -149,10 +151,11 @@ def reconstruct(seed, mask, method = 'dilation', selem = None, offset = None):
 
 
 def greyReconstruction(img, mask, greyReconstructionParameter = None, method = None, size = 3, save = None, verbose = False,
-                       subStack = None, out = sys.stdout, **parameter):
+                       dtype = None, threads = None, subStack = None, out = sys.stdout, **parameter):
     """Calculates the grey reconstruction of the image 
     
-    Reconstruction is done z-slice by z-slice.
+    Reconstruction is done z-slice by z-slice, the slices are processed in 
+    parallel threads, see :func:`~ClearMap.Utils.Executor.mapSlices`.
     
     Arguments:
         img (array): image data
@@ -164,6 +167,9 @@ def greyReconstruction(img, mask, greyReconstructionParameter = None, method = N
             *size*    (int or tuple)       size of structuring element
             *save*    (str or None)        file name to save result of this operation
                                            if None dont save to file 
+            *dtype*   (str or None)        type of the reconstruction, see :mod:`~ClearMap.ImageProcessing.DataType`
+                                           if None use the type of the image
+            *threads* (int or None)        number of threads processing the slices, see :func:`~ClearMap.Utils.Executor.sliceThreads`
             *verbose* (bool or int)        print / plot information about this step 
             ========= ==================== ===========================================================
         subStack (dict or None): sub-stack information 
@@ -177,23 +183,30 @@ def greyReconstruction(img, mask, greyReconstructionParameter = None, method = N
     method = getParameter(greyReconstructionParameter, "method", method);
     size   = getParameter(greyReconstructionParameter, "size", size);
     save   = getParameter(greyReconstructionParameter, "save", save);    
+    dtype  = getParameter(greyReconstructionParameter, "dtype", dtype);    
+    threads= getParameter(greyReconstructionParameter, "threads", threads);    
     verbose= getParameter(greyReconstructionParameter, "verbose", verbose);   
     
     if verbose:
-        writeParameter(out = out, head = 'Grey reconstruction:', method = method, size = size, save = save);
+        writeParameter(out = out, head = 'Grey reconstruction:', method = method, size = size, save = save, dtype = dtype);
     
     if method is None:
         return img;
     
+    img = convertType(img, dtype);
+    mask = convertType(mask, dtype);
+    
     timer = Timer();
     
     # background subtraction in each slice
     se = structureElement('Disk', size).astype('uint8');
-    for z in range(img.shape[2]):
+    def reconstructSlice(z):
          #img[:,:,z] = img[:,:,z] - grey_opening(img[:,:,z], structure = structureElement('Disk', (30,30)));
          #img[:,:,z] = img[:,:,z] - morph.grey_opening(img[:,:,z], structure = self.structureELement('Disk', (150,150)));
          img[:,:,z] = img[:,:,z] - reconstruct(img[:,:,z], method = method, selem = se)
     
+    mapSlices(reconstructSlice, img.shape[2], threads = threads);
+    
     if not save is None:
         writeSubStack(save, img, subStack = subStack)
 
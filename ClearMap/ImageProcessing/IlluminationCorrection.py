@@ -33,8 +33,10 @@ from scipy.optimize import curve_fit
 import ClearMap.IO as io
 
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
+from ClearMap.ImageProcessing.DataType import floatType, clipType, convertType
 
 from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.Executor import mapSlices
 from ClearMap.Utils.ParameterTools import getParameter, writeParameter
 
 from ClearMap.Visualization.Plot import plotTiling
@@ -51,7 +53,7 @@ See Also:
 
 
 def correctIllumination(img, correctIlluminationParameter = None, flatfield = None, background = None, scaling = None, save = None, verbose = False, 
-                        subStack = None, out = sys.stdout, **parameter):
+                        inPlace = False, dtype = None, threads = None, subStack = None, out = sys.stdout, **parameter):
     """Correct illumination variations
     
      The intensity image :math:`I(x)` given a flat field :math:`F(x)` and 
@@ -63,7 +65,8 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
      If the background is not given :math:`B(x) = 0`. 
      
      The correction is done slice by slice assuming the data was collected with 
-     a light sheet microscope.
+     a light sheet microscope. The slices are processed in parallel threads, 
+     see :func:`~ClearMap.Utils.Executor.mapSlices`.
      
      The image is finally optionally scaled.
   
@@ -80,8 +83,14 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
             *scaling*    (str or None)        scale the corrected result by this factor
                                               if 'max'/'mean' scale to keep max/mean invariant
             *save*       (str or None)        save the corrected image to file
+            *dtype*      (str or None)        type of the corrected image, see :mod:`~ClearMap.ImageProcessing.DataType`
+                                              if None the type of the image if scaled and float32 otherwise
+            *threads*    (int or None)        number of threads processing the slices, see :func:`~ClearMap.Utils.Executor.sliceThreads`
             *verbose*    (bool or int)        print / plot information about this step 
             ============ ==================== ===========================================================
+        inPlace (bool): correct the float32 image in place instead of a float32 copy, 
+                        the result is truncated to the values of an integer *dtype*, 
+                        see :func:`correctIlluminationType`
         subStack (dict or None): sub-stack information 
         verbose (bool): print progress info 
         out (object): object to write progress info to
@@ -101,6 +110,8 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
     background = getParameter(correctIlluminationParameter, "background", background);
     scaling    = getParameter(correctIlluminationParameter, "scaling",    scaling);
     save       = getParameter(correctIlluminationParameter, "save",       save);
+    dtype      = getParameter(correctIlluminationParameter, "dtype",      dtype);
+    threads    = getParameter(correctIlluminationParameter, "threads",    threads);
     verbose    = getParameter(correctIlluminationParameter, "verbose",    verbose);
 
     if verbose:    
@@ -114,7 +125,7 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
         else:
             bkg = "image of size %s" % str(background.shape);
         
-        writeParameter(out = out, head = 'Illumination correction:', flatfield = fld, background = bkg, scaling = scaling, save = save);  
+        writeParameter(out = out, head = 'Illumination correction:', flatfield = fld, background = bkg, scaling = scaling, save = save, dtype = dtype);  
     
     
     print subStack;
@@ -133,7 +144,9 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
     timer = Timer(); 
  
     if flatfield is None:
-        return img;
+        if inPlace:
+            return img;
+        return convertType(img, dtype);
         
     elif flatfield is True:
         # default flatfield correction
@@ -167,22 +180,29 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
         raise RuntimeError("correctIllumination: flatfield does not match image size: %s vs %s" % (flatfield.shape,  img[:,:,0].shape));
     
     #convert to float for scaling
-    dtype = img.dtype;
-    img = img.astype('float32');
+    if inPlace:
+        if img.dtype != numpy.float32:
+            raise RuntimeError("correctIllumination: in place correction requires a float32 image, got %s!" % str(img.dtype));
+    else:
+        inputType = img.dtype;
+        img = img.astype(floatType(dtype));
     flatfield = flatfield.astype('float32');
     
     # illumination correction in each slice
     if background is None:
-        for z in range(img.shape[2]):
-            img[:,:,z] = img[:,:,z] / flatfield;
+        def correctSlice(z):
+            img[:,:,z] /= flatfield;
     else:
         if background.shape != flatfield.shape:
             raise RuntimeError("correctIllumination: background does not match image size: %s vs %s" % (background.shape,  img[:,:,0].shape));        
         background = background.astype('float32');
 
         flatfield = (flatfield - background);
-        for z in range(img.shape[2]):
-            img[:,:,z] = (img[:,:,z] - background) / flatfield;
+        def correctSlice(z):
+            img[:,:,z] -= background;
+            img[:,:,z] /= flatfield;
+    
+    mapSlices(correctSlice, img.shape[2], threads = threads);
     
         
     # rescale
@@ -205,9 +225,17 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
     
         
     
-    if not sf is None:
+    if inPlace:
+        if not sf is None:
+            img *= sf;
+        clipType(img, dtype);
+    elif not sf is None:
         img = img * sf;
-        img = img.astype(dtype);
+        if dtype is None:
+            img = img.astype(inputType);
+    
+    if not inPlace:
+        img = convertType(img, dtype);
     
     
     #write result for inspection
@@ -222,7 +250,53 @@ def correctIllumination(img, correctIlluminationParameter = None, flatfield = No
         out.write(timer.elapsedTime(head = 'Illumination correction') + '\n');    
     
     return img 
+
+
+def correctIlluminationType(inputType, correctIlluminationParameter = None, flatfield = None, scaling = None, dtype = None, **parameter):
+    """Returns the type of the image corrected by :func:`correctIllumination`
+    
+    Arguments:
+        inputType (dtype): type of the image to correct
+        correctIlluminationParameter (dict): parameter as in :func:`correctIllumination`
+    
+    Returns:
+        dtype: type of the corrected image without *inPlace*
+    """
+    
+    flatfield = getParameter(correctIlluminationParameter, "flatfield", flatfield);
+    scaling   = getParameter(correctIlluminationParameter, "scaling",   scaling);
+    dtype     = getParameter(correctIlluminationParameter, "dtype",     dtype);
+    
+    if not dtype is None:
+        return numpy.dtype(dtype);
+    if flatfield is None or not scaling is None:
+        return numpy.dtype(inputType);
+    return floatType(None);
+    
+
+
+_flatfieldLines = {};
+
+
+def flatfieldLine(line):
+    """Reads a 1d line of estimated intensities, lines read from files are cached
+    
+    Arguments:
+        line (str or array): file name or array of intensities along y axis
+    
+    Returns:
+        array: the intensities along the y axis
+    """
+    
+    if not isinstance(line, str):
+        return io.readPoints(line);
+    
+    if not line in _flatfieldLines:
+        data = io.readPoints(line);
+        data.flags.writeable = False;
+        _flatfieldLines[line] = data;
     
+    return _flatfieldLines[line];
 
 
 def flatfieldFromLine(line, xsize):
@@ -236,7 +310,7 @@ def flatfieldFromLine(line, xsize):
         array: full 2d flat field 
     """
     
-    line = io.readPoints(line);
+    line = flatfieldLine(line);
 
     flatfield = numpy.zeros((xsize, line.size));
     for i in range(xsize):
@@ -11,7 +11,7 @@ the maximum or mean.
 import sys
 import numpy
 
-from ClearMap.ImageProcessing.StackProcessing import parallelProcessStack, sequentiallyProcessStack, writeSubStack
+from ClearMap.ImageProcessing.StackProcessing import parallelProcessStack, sequentiallyProcessStack, writeSubStack, subStackDataRange
 
 from ClearMap.Utils.Timer import Timer
 from ClearMap.Utils.ParameterTools import getParameter, writeParameter, joinParameter
@@ -38,7 +38,8 @@ def calculateStatistics(source, sink = None, calculateStatisticsParameter = None
             *verbose* (bool or int)        print / plot information about this step                                 
             ========= ==================== ===========================================================
         method (str or function): 
-        processMethod (str or all): 'sequential' or 'parallel'. if all its choosen automatically
+        processMethod (str or all): 'sequential', 'parallel' or 'threads'. if all its choosen automatically,
+                                    'threads' processes the sub-stacks in parallel threads sharing the memory of this process
         verbose (bool): print info
         **parameter (dict): parameter for the image processing sub-routines
     
@@ -59,6 +60,9 @@ def calculateStatistics(source, sink = None, calculateStatisticsParameter = None
         result = sequentiallyProcessStack(source, sink = sink, function = calculateStatisticsOnStack, join = joinStatistics, method = method, remove= remove, verbose = verbose, **parameter);  
     elif processMethod is all or processMethod == 'parallel':
         result = parallelProcessStack(source, sink = sink, function = calculateStatisticsOnStack, join = joinStatistics, method = method, remove= remove, verbose = verbose, **parameter);  
+    elif processMethod == 'threads':
+        parameter["executor"] = 'threads';
+        result = parallelProcessStack(source, sink = sink, function = calculateStatisticsOnStack, join = joinStatistics, method = method, remove= remove, verbose = verbose, **parameter);  
     else:
         raise RuntimeError("calculateStatistics: invalid processMethod %s" % str(processMethod));
     
@@ -176,8 +180,9 @@ def joinStatistics(results, calculateStatisticsParameter = None, method = 'Max',
         if f == _methodToFunction('mean'):
             #weight by chunk size:
             if not subStacks is None:
-                r = [r[i] * (subStacks[i]['z'][1] - subStacks[i]['z'][0]) for i in range(nchunks)];
-                tot = numpy.sum([(subStacks[i]['z'][1] - subStacks[i]['z'][0]) for i in range(nchunks)]);
+                w = [numpy.prod([d[1] - d[0] for d in subStackDataRange(subStacks[i])]) for i in range(nchunks)];
+                r = [r[i] * w[i] for i in range(nchunks)];
+                tot = numpy.sum(w);
                 r = f(r);
                 r = r / float(tot);
             else:
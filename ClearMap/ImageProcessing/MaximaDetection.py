@@ -22,8 +22,9 @@ import scipy.ndimage.measurements as sm;
 from scipy.ndimage.filters import maximum_filter
 
 from ClearMap.ImageProcessing.GreyReconstruction import reconstruct
-from ClearMap.ImageProcessing.Filter.StructureElement import structureElementOffsets
+from ClearMap.ImageProcessing.Filter.StructureElement import structureElementOffsets, structureElementFootprint
 from ClearMap.ImageProcessing.StackProcessing import writeSubStack
+from ClearMap.ImageProcessing.DataType import convertType, isUnsignedType
 #from ClearMap.ImageProcessing.Convolution import convolve
 
 from ClearMap.Utils.Timer import Timer
@@ -53,6 +54,10 @@ def hMaxTransform(img, hMax):
     #seed[seed < h] = h; # catch errors for uint subtraction !
     #img = img.astype('float16'); # float32 ? 
     if not hMax is None:
+        if isUnsignedType(img.dtype):
+            # saturate at zero to catch errors for uint subtraction
+            h = img.dtype.type(hMax);
+            return reconstruct(numpy.maximum(img, h) - h, img);
         return reconstruct(img - hMax, img);
     else:
         return img;
@@ -116,7 +121,7 @@ def extendedMax(img, hMax = 0):
 
 
 def findExtendedMaxima(img, findExtendedMaximaParameter = None, hMax = None, size = 5, threshold = None, save = None, verbose = None,
-                       subStack = None,  out = sys.stdout, **parameter):
+                       dtype = None, subStack = None,  out = sys.stdout, **parameter):
     """Find extended maxima in an image 
     
     Effectively this routine performs a h-max transfrom, followed by a local maxima search and 
@@ -135,6 +140,9 @@ def findExtendedMaxima(img, findExtendedMaximaParameter = None, hMax = None, siz
                                             if None keep all localmaxima
             *save*      (str or None)       file name to save result of this operation
                                             if None do not save result to file
+            *dtype*     (str or None)       type in which the maxima are detected, if None the type of the image
+                                            integer types truncate the image and can give plateaus with 
+                                            several maxima, see :mod:`~ClearMap.ImageProcessing.DataType`
             *verbose*   (bool or int)        print / plot information about this step                                             
             =========== =================== ===========================================================
         subStack (dict or None): sub-stack information 
@@ -152,13 +160,16 @@ def findExtendedMaxima(img, findExtendedMaximaParameter = None, hMax = None, siz
     size      = getParameter(findExtendedMaximaParameter, "size", size);
     threshold = getParameter(findExtendedMaximaParameter, "threshold", threshold);
     save      = getParameter(findExtendedMaximaParameter, "save", save);
+    dtype     = getParameter(findExtendedMaximaParameter, "dtype", dtype);
     verbose   = getParameter(findExtendedMaximaParameter, "verbose", verbose);
 
     if verbose:
-        writeParameter(out = out, head = 'Extended Max:', hMax = hMax, size = size, threshold = threshold, save = save);
+        writeParameter(out = out, head = 'Extended Max:', hMax = hMax, size = size, threshold = threshold, save = save, dtype = dtype);
     
     timer = Timer();
     
+    img = convertType(img, dtype);
+    
     ## extended maxima    
     imgmax = hMaxTransform(img, hMax);
         
@@ -183,6 +194,31 @@ def findExtendedMaxima(img, findExtendedMaximaParameter = None, hMax = None, siz
     return imgmax
 
 
+def findExtendedMaximaFootprint(findExtendedMaximaParameter = None, size = 5, **parameter):
+    """Spatial footprint of the extended maxima detection
+    
+    Arguments:
+        findExtendedMaximaParameter (dict): parameter as in :func:`findExtendedMaxima`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the result
+    
+    Note:
+        The h-max transform is a reconstruction that can propagate over 
+        arbitrary distances and is not included in the footprint.
+    """
+    
+    size = getParameter(findExtendedMaximaParameter, "size", size);
+    
+    if size is None:
+        return (0, 0, 0);
+    
+    if not isinstance(size, tuple):
+       size = (size, size, size);
+    
+    return structureElementFootprint(size);
+
+
 
 def findCenterOfMaxima(img, imgmax = None, label = None, findCenterOfMaximaParameter = None, save = None, verbose = False,
                        subStack = None, out = sys.stdout, **parameter):
@@ -363,3 +399,22 @@ def findIntensity(img, centers, findIntensityParameter = None, method = None, si
     
     return intensities;
 
+
+def findIntensityFootprint(findIntensityParameter = None, size = (3,3,3), **parameter):
+    """Spatial footprint of the intensity measurement
+    
+    Arguments:
+        findIntensityParameter (dict): parameter as in :func:`findIntensity`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the result
+    """
+    
+    method  = getParameter(findIntensityParameter, "method", "Max"); 
+    size    = getParameter(findIntensityParameter, "size", size); 
+    
+    if method is None:
+        return (0, 0, 0);
+    
+    return structureElementFootprint(size);
+
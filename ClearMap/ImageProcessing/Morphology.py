@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Fast morphological operations with large structure elements
+
+The morphological opening with a disk of radius :math:`r` costs
+:math:`O(r^2)` operations per pixel. Here the disk is approximated by an
+octagon, the Minkowski sum of line segments along the axes and the two
+diagonals:
+
+.. math:
+   B = L_x \\oplus L_y \\oplus L_{(1,1)} \\oplus L_{(1,-1)}
+
+The erosion and dilation with each line segment are calculated with the
+van Herk / Gil-Werman algorithm, which needs three comparisons per pixel
+independent of the length of the segment. The opening thus costs
+:math:`O(1)` operations per pixel.
+
+The diagonal segments are chosen such that the octagon touches the circle
+along the axes and the diagonals. Borders are treated as in cv2, i.e. pixels
+outside the image are ignored.
+
+References:
+    van Herk, "A fast algorithm for local minimum and maximum filters on
+    rectangular and octagonal kernels", Pattern Recognition Letters 13 (1992) 517-521
+
+    Gil and Werman, "Computing 2-D min, median, and max filters",
+    IEEE Transactions on Pattern Analysis and Machine Intelligence 15 (1993) 504-507
+
+Example:
+    >>> import ClearMap.ImageProcessing.Morphology as morph
+    >>> print morph.lineDecomposition((101,101))
+    [(41, (1, 0)), (41, (0, 1)), (31, (1, 1)), (31, (1, -1))]
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import numpy
+import math
+
+
+def lineDecomposition(size):
+    """Decomposes the octagon approximating a disk into line segments
+
+    Arguments:
+        size (tuple): size of the disk (x,y)
+
+    Returns:
+        list: list of (length, direction) tuples of the line segments
+    """
+
+    if len(size) != 2:
+        raise RuntimeError("lineDecomposition: expected 2d size, got %s!" % str(size));
+
+    # diagonals cover a fraction 1 - 1/sqrt(2) of the radius, the axes the rest
+    radius = min(size[0] - 1, size[1] - 1) / 2.;
+    hdiag = int(round(radius * (1 - 1 / math.sqrt(2))));
+    ldiag = 2 * hdiag + 1;
+
+    return [(int(size[0]) - 2 * (ldiag - 1), (1, 0)),
+            (int(size[1]) - 2 * (ldiag - 1), (0, 1)),
+            (ldiag, (1, 1)), (ldiag, (1, -1))];
+
+
+def _lineExtremum(flat, length, step, fun, neutral):
+    """Running minimum or maximum along a line in a flattened image
+
+    Calculates the extremum of flat[q + t * step] for t in -c,...,length - 1 - c with
+    c = (length - 1) // 2 using the van Herk / Gil-Werman algorithm.
+
+    Arguments:
+        flat (array): flattened image
+        length (int): number of pixels of the line segment
+        step (int): step in the flattened image between pixels on the line
+        fun (ufunc): numpy.minimum or numpy.maximum
+        neutral (number): value of pixels outside the image
+
+    Returns:
+        array: the flattened result
+    """
+
+    n = flat.shape[0];
+    c = (length - 1) // 2 * step;
+
+    # view with the line pixels along the first axis padded to full blocks of the segment length
+    m = -(-(n + c) // step);
+    mb = -(-(m + length - 1) // length) * length;
+    a = numpy.empty(mb * step, dtype = flat.dtype);
+    a[:c] = neutral;
+    a[c:c+n] = flat;
+    a[c+n:] = neutral;
+    a = a.reshape(mb // length, length, step);
+
+    # prefix and suffix extrema within the blocks
+    g = fun.accumulate(a, axis = 1).reshape(mb, step);
+    h = fun.accumulate(a[:,::-1], axis = 1)[:,::-1].reshape(mb, step);
+
+    return fun(h[:m], g[length-1:m+length-1]).reshape(-1)[:n];
+
+
+def _morphLines(img, lines, fun, neutral, reflect):
+    """Erosion or dilation of a 2d image by a Minkowski sum of line segments"""
+
+    margin = sum([(l - 1) for l,d in lines]) + 1;
+    nx, ny = img.shape;
+    width = ny + 2 * margin;
+
+    # the margin is wider than the structure element thus lines do not wrap
+    p = numpy.empty((nx + 2 * margin, width), dtype = img.dtype);
+    p[:] = neutral;
+    p[margin:margin+nx, margin:margin+ny] = img;
+
+    flat = p.reshape(-1);
+    if reflect:
+        flat = flat[::-1];
+    for length, direction in lines:
+        if length > 1:
+            flat = _lineExtremum(flat, length, direction[0] * width + direction[1], fun, neutral);
+    if reflect:
+        flat = flat[::-1];
+
+    return flat.reshape(p.shape)[margin:margin+nx, margin:margin+ny];
+
+
+def _typeRange(dtype):
+    """Returns minimal and maximal value of a data type"""
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype);
+    else:
+        info = numpy.finfo(dtype);
+    return info.min, info.max;
+
+
+def erodeLines(img, size):
+    """Erosion of a 2d image with the octagon approximating a disk
+
+    Arguments:
+        img (array): 2d image
+        size (tuple): size of the disk (x,y)
+
+    Returns:
+        array: eroded image
+    """
+
+    vmin, vmax = _typeRange(img.dtype);
+    return _morphLines(img, lineDecomposition(size), numpy.minimum, vmax, False);
+
+
+def dilateLines(img, size):
+    """Dilation of a 2d image with the octagon approximating a disk
+
+    Arguments:
+        img (array): 2d image
+        size (tuple): size of the disk (x,y)
+
+    Returns:
+        array: dilated image
+    """
+
+    vmin, vmax = _typeRange(img.dtype);
+    return _morphLines(img, lineDecomposition(size), numpy.maximum, vmin, True);
+
+
+def openLines(img, size):
+    """Morphological opening of a 2d image with the octagon approximating a disk
+
+    Arguments:
+        img (array): 2d image
+        size (tuple): size of the disk (x,y)
+
+    Returns:
+        array: opened image
+
+    Note:
+        For odd sizes the result is identical to cv2.morphologyEx with the
+        octagon as structure element.
+    """
+
+    return dilateLines(erodeLines(img, size), size);
+
+
+
+def test():
+    """Test Morphology module"""
+    import ClearMap.ImageProcessing.Morphology as self
+    reload(self)
+
+    import cv2
+    from ClearMap.ImageProcessing.Filter.StructureElement import structureElement
+    from ClearMap.Utils.Timer import Timer
+
+    img = (numpy.random.rand(1000, 1000) * 1000).astype('float32');
+
+    for size in [(15,15), (51,51), (101,101)]:
+        timer = Timer();
+        for i in range(5):
+            res = self.openLines(img, size);
+        print timer.elapsedTime(head = 'lines %s' % str(size))
+
+        timer = Timer();
+        for i in range(5):
+            ref = cv2.morphologyEx(img, cv2.MORPH_OPEN, structureElement('Disk', size).astype('uint8'));
+        print timer.elapsedTime(head = 'disk  %s' % str(size))
+
+        print 'mean difference to disk opening:', numpy.abs(res - ref).mean()
+
+
+if __name__ == "__main__":
+    test();
@@ -49,13 +49,15 @@ import sys
 import numpy
 
 
-from ClearMap.ImageProcessing.IlluminationCorrection import correctIllumination
-from ClearMap.ImageProcessing.BackgroundRemoval import removeBackground
-from ClearMap.ImageProcessing.Filter.DoGFilter import filterDoG
-from ClearMap.ImageProcessing.MaximaDetection import findExtendedMaxima, findPixelCoordinates, findIntensity, findCenterOfMaxima
-from ClearMap.ImageProcessing.CellSizeDetection import detectCellShape, findCellSize, findCellIntensity
+from ClearMap.ImageProcessing.IlluminationCorrection import correctIllumination, correctIlluminationType
+from ClearMap.ImageProcessing.BackgroundRemoval import removeBackground, removeBackgroundFootprint
+from ClearMap.ImageProcessing.Filter.DoGFilter import filterDoG, filterDoGFootprint
+from ClearMap.ImageProcessing.MaximaDetection import findExtendedMaxima, findPixelCoordinates, findIntensity, findCenterOfMaxima, findExtendedMaximaFootprint, findIntensityFootprint
+from ClearMap.ImageProcessing.CellSizeDetection import detectCellShape, findCellSize, findCellIntensity, detectCellShapeFootprint
+from ClearMap.ImageProcessing.DataType import isIntegerType
 
 from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.Profiler import span
 from ClearMap.Utils.ParameterTools import getParameter
 
 
@@ -63,9 +65,26 @@ from ClearMap.Utils.ParameterTools import getParameter
 # Spot detection
 ##############################################################################
 
+DetectSpotsMemoryFactor = 8;
+"""float: estimated peak number of float32 copies of a sub-stack held by :func:`detectSpots`
+
+The copy of the input, the float64 background removal, the DoG filter result and 
+the maxima, label and shape images are alive at the same time, see
+:func:`~ClearMap.ImageProcessing.StackProcessing.calculateMemoryLimits`.
+"""
+
+DetectSpotsInPlaceMemoryFactor = 6.5;
+"""float: estimated peak number of float32 copies of a sub-stack held by :func:`detectSpots` with *inPlace*
+
+The copy of the input and the float64 background removal are replaced by a
+single float32 working buffer that holds the DoG filter result. The background
+corrected image is kept in float32 if a flat field is used without scaling.
+"""
+
+
 def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter = None, removeBackgroundParameter = None,
                 filterDoGParameter = None, findExtendedMaximaParameter = None, detectCellShapeParameter = None,
-                verbose = False, out = sys.stdout, **parameter):
+                inPlace = False, dtype = None, threads = None, verbose = False, out = sys.stdout, **parameter):
     """Detect Cells in 3d grayscale image using DoG filtering and maxima detection
     
     Effectively this function performs the following steps:
@@ -80,9 +99,24 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
     Note: 
         Processing steps are done in place to save memory.
         
+        With *inPlace* the illumination correction and background removal 
+        work on a single float32 copy of the image, which is then reused as 
+        the result of the DoG filter. Besides the input only the background
+        corrected image is kept for the intensity measurements in the type
+        it has without *inPlace*, see 
+        :func:`~ClearMap.ImageProcessing.IlluminationCorrection.correctIlluminationType`.
+        This reduces the peak memory, see :const:`DetectSpotsInPlaceMemoryFactor`,
+        and gives the same results.
+        
     Arguments:
         img (array): image data
         detectSpotParameter: image processing parameter as described in the individual sub-routines
+        inPlace (bool): process the image in a single float32 working buffer
+        dtype (str or None): data type policy for the processing steps, integer types are used for the 
+                             illumination correction and background removal, 
+                             see :mod:`~ClearMap.ImageProcessing.DataType`
+        threads (int or None): number of threads processing the slices in the illumination correction
+                               and background removal, see :func:`~ClearMap.Utils.Executor.sliceThreads`
         verbose (bool): print progress information
         out (object): object to print progress information to
         
@@ -92,6 +126,10 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
 
     timer = Timer();
     
+    inPlace = getParameter(detectSpotsParameter, "inPlace", inPlace);
+    dtype   = getParameter(detectSpotsParameter, "dtype", dtype);
+    threads = getParameter(detectSpotsParameter, "threads", threads);
+    
     # normalize data -> to check
     #img = img.astype('float');
     #dmax = 0.075 * 65535;
@@ -104,13 +142,25 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
     
     # correct illumination
     correctIlluminationParameter = getParameter(detectSpotsParameter, "correctIlluminationParameter", correctIlluminationParameter);
-    img1 = img.copy();
-    img1 = correctIllumination(img1, correctIlluminationParameter = correctIlluminationParameter, verbose = verbose, out = out, **parameter)   
+    with span('correctIllumination', voxels = img.size) as s:
+        if inPlace:
+            # working buffer, the input is kept for the intensity measurements
+            # the correction is truncated to the type of the correction without inPlace
+            work = img.astype('float32');
+            correctedType = correctIlluminationType(img.dtype, correctIlluminationParameter = correctIlluminationParameter, dtype = dtype, **parameter);
+            img1 = correctIllumination(work, correctIlluminationParameter = correctIlluminationParameter, inPlace = True, dtype = correctedType, 
+                                       threads = threads, verbose = verbose, out = out, **parameter)   
+        else:
+            img1 = img.copy();
+            img1 = correctIllumination(img1, correctIlluminationParameter = correctIlluminationParameter, dtype = dtype, threads = threads, verbose = verbose, out = out, **parameter)   
+        s.track(img1);
 
     # background subtraction in each slice
     #img2 = img.copy();
     removeBackgroundParameter = getParameter(detectSpotsParameter, "removeBackgroundParameter", removeBackgroundParameter);
-    img2 = removeBackground(img1, removeBackgroundParameter = removeBackgroundParameter, verbose = verbose, out = out, **parameter)   
+    with span('removeBackground', voxels = img.size) as s:
+        img2 = removeBackground(img1, removeBackgroundParameter = removeBackgroundParameter, inPlace = inPlace, dtype = dtype, threads = threads, verbose = verbose, out = out, **parameter)   
+        s.track(img2);
     
     # mask
     #timer.reset();
@@ -124,7 +174,14 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
     filterDoGParameter = getParameter(detectSpotsParameter, "filterDoGParameter", filterDoGParameter);
     dogSize = getParameter(filterDoGParameter, "size", None);
     #img3 = img2.copy();    
-    img3 = filterDoG(img2, filterDoGParameter = filterDoGParameter, verbose = verbose, out = out, **parameter);
+    with span('filterDoG', voxels = img.size) as s:
+        if inPlace and not dogSize is None:
+            # keep the background corrected image for the measurements and filter into the working buffer
+            img2 = img2.astype(correctedType);
+            img3 = filterDoG(img2, filterDoGParameter = filterDoGParameter, buffer = work, dtype = dtype, verbose = verbose, out = out, **parameter);
+        else:
+            img3 = filterDoG(img2, filterDoGParameter = filterDoGParameter, dtype = dtype, verbose = verbose, out = out, **parameter);
+        s.track(img3);
     
     # normalize    
     #    imax = img.max();
@@ -135,13 +192,19 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
     # extended maxima
     findExtendedMaximaParameter = getParameter(detectSpotsParameter, "findExtendedMaximaParameter", findExtendedMaximaParameter);
     hMax = getParameter(findExtendedMaximaParameter, "hMax", None);
-    imgmax = findExtendedMaxima(img3, findExtendedMaximaParameter = findExtendedMaximaParameter, verbose = verbose, out = out, **parameter);
+    with span('findExtendedMaxima', voxels = img.size) as s:
+        # integer types would give plateaus of maxima in the DoG filtered image
+        imgmax = findExtendedMaxima(img3, findExtendedMaximaParameter = findExtendedMaximaParameter, dtype = None if isIntegerType(dtype) else dtype, 
+                                    verbose = verbose, out = out, **parameter);
+        s.track(imgmax);
     
     #center of maxima
-    if not hMax is None:
-        centers = findCenterOfMaxima(img, imgmax, verbose = verbose, out = out, **parameter);
-    else:
-        centers = findPixelCoordinates(imgmax, verbose = verbose, out = out, **parameter);
+    with span('findCenters', voxels = img.size):
+        if not hMax is None:
+            centers = findCenterOfMaxima(img, imgmax, verbose = verbose, out = out, **parameter);
+        else:
+            centers = findPixelCoordinates(imgmax, verbose = verbose, out = out, **parameter);
+    del imgmax;
     
     #cell size detection
     detectCellShapeParameter = getParameter(detectSpotsParameter, "detectCellShapeParameter", detectCellShapeParameter);
@@ -149,22 +212,25 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
     if not cellShapeThreshold is None:
         
         # cell shape via watershed
-        imgshape = detectCellShape(img2, centers, detectCellShapeParameter = detectCellShapeParameter, verbose = verbose, out = out, **parameter);
+        with span('detectCellShape', voxels = img.size) as s:
+            imgshape = detectCellShape(img2, centers, detectCellShapeParameter = detectCellShapeParameter, verbose = verbose, out = out, **parameter);
+            s.track(imgshape);
         
-        #size of cells        
-        csize = findCellSize(imgshape, maxLabel = centers.shape[0], out = out, **parameter);
-        
-        #intensity of cells
-        cintensity = findCellIntensity(img, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
-
-        #intensity of cells in background image
-        cintensity2 = findCellIntensity(img2, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
+        with span('findCellIntensity', voxels = img.size):
+            #size of cells        
+            csize = findCellSize(imgshape, maxLabel = centers.shape[0], out = out, **parameter);
+            
+            #intensity of cells
+            cintensity = findCellIntensity(img, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
     
-        #intensity of cells in dog filtered image
-        if dogSize is None:
-            cintensity3 = cintensity2;
-        else:
-            cintensity3 = findCellIntensity(img3, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
+            #intensity of cells in background image
+            cintensity2 = findCellIntensity(img2, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
+        
+            #intensity of cells in dog filtered image
+            if dogSize is None:
+                cintensity3 = cintensity2;
+            else:
+                cintensity3 = findCellIntensity(img3, imgshape,  maxLabel = centers.shape[0], verbose = verbose, out = out, **parameter);
         
         if verbose:
             out.write(timer.elapsedTime(head = 'Spot Detection') + '\n');
@@ -176,22 +242,59 @@ def detectSpots(img, detectSpotsParameter = None, correctIlluminationParameter =
         
     
     else:
-        #intensity of cells
-        cintensity = findIntensity(img, centers, verbose = verbose, out = out, **parameter);
-
-        #intensity of cells in background image
-        cintensity2 = findIntensity(img2, centers, verbose = verbose, out = out, **parameter);
+        with span('findIntensity', voxels = img.size):
+            #intensity of cells
+            cintensity = findIntensity(img, centers, verbose = verbose, out = out, **parameter);
     
-        #intensity of cells in dog filtered image
-        if dogSize is None:
-            cintensity3 = cintensity2;
-        else:
-            cintensity3 = findIntensity(img3, centers, verbose = verbose, out = out, **parameter);
+            #intensity of cells in background image
+            cintensity2 = findIntensity(img2, centers, verbose = verbose, out = out, **parameter);
+        
+            #intensity of cells in dog filtered image
+            if dogSize is None:
+                cintensity3 = cintensity2;
+            else:
+                cintensity3 = findIntensity(img3, centers, verbose = verbose, out = out, **parameter);
 
         if verbose:
             out.write(timer.elapsedTime(head = 'Spot Detection') + '\n');
     
         return ( centers, numpy.vstack((cintensity, cintensity3, cintensity2)).transpose());
+
+
+def detectSpotsFootprint(detectSpotsParameter = None, correctIlluminationParameter = None, removeBackgroundParameter = None,
+                         filterDoGParameter = None, findExtendedMaximaParameter = None, detectCellShapeParameter = None, **parameter):
+    """Spatial footprint of the spot detection
+    
+    The footprints of the consecutive filter steps add up. The maxima detection 
+    and the intensity and shape measurements act on the filtered images, thus 
+    the largest of their footprints is added to the ones of the background 
+    removal and the DoG filter. The illumination correction acts pixel-wise.
+    
+    Arguments:
+        detectSpotParameter: image processing parameter as for :func:`detectSpots`
+    
+    Returns:
+        tuple: maximal distance in pixel along x,y,z of pixels influencing the detected spots
+    
+    See Also:
+        :func:`~ClearMap.ImageProcessing.StackProcessing.calculateChunkOverlap`
+    """
+    
+    removeBackgroundParameter = getParameter(detectSpotsParameter, "removeBackgroundParameter", removeBackgroundParameter);
+    filterDoGParameter = getParameter(detectSpotsParameter, "filterDoGParameter", filterDoGParameter);
+    findExtendedMaximaParameter = getParameter(detectSpotsParameter, "findExtendedMaximaParameter", findExtendedMaximaParameter);
+    detectCellShapeParameter = getParameter(detectSpotsParameter, "detectCellShapeParameter", detectCellShapeParameter);
+    
+    filters = [removeBackgroundFootprint(removeBackgroundParameter = removeBackgroundParameter, **parameter),
+               filterDoGFootprint(filterDoGParameter = filterDoGParameter, **parameter)];
+    
+    measures = [findExtendedMaximaFootprint(findExtendedMaximaParameter = findExtendedMaximaParameter, **parameter),
+                findIntensityFootprint(**parameter),
+                detectCellShapeFootprint(detectCellShapeParameter = detectCellShapeParameter, **parameter)];
+    
+    return tuple(sum(f[d] for f in filters) + max(m[d] for m in measures) for d in range(3));
+
+detectSpots.footprint = detectSpotsFootprint;
         
 
 
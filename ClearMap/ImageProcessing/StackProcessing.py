@@ -3,7 +3,8 @@
 Process a image stack in parallel or sequentially
 
 In this toolbox image processing is parallized via splitting a volumetric
-image stack into several sub-stacks, typically in z-direction. As most of 
+image stack into several sub-stacks, typically in z-direction or into 3d 
+blocks. As most of 
 the image processig steps are non-local sub-stacks are created with overlaps 
 and the results rejoined accordingly to minimize boundary effects.
 
@@ -24,11 +25,26 @@ Key                        Description
 ``nStacks``                total number of sub-stacks
 ``source``                 source file/folder/pattern of the stack
 ``x``, ``y``, ``z``        the range of the sub-stack with in the full image
+``stackRange``             tuple of the absolute x,y,z ranges of the full
+                           region that is processed
 ``zCenters``               tuple of the centers of the overlaps
 ``zCenterIndices``         tuple of the original indices of the centers of 
                            the overlaps
 ``zSubStackCenterIndices`` tuple of the indices of the sub-stack that
                            correspond to the overlap centers
+``xCenters``, ...          corresponding information for the x and y axes
+                           (only if the stack is split along these axes)
+``sharedSource``           file name of the memory mapped buffer holding the
+                           source data (only when processing with
+                           ``sharedMemory = True``)
+``sharedRange``            x,y,z ranges of the sub-stack within the shared
+                           buffer (only when processing with 
+                           ``sharedMemory = True``)
+``runId``                  id of the processing run, volumes written by 
+                           :func:`writeSubStack` in a previous run are 
+                           replaced (only when processing via
+                           :func:`parallelProcessStack` or 
+                           :func:`sequentiallyProcessStack`)
 ========================== ==================================================
 
 For exmaple the :func:`writeSubStack` routine makes uses of this information
@@ -39,16 +55,28 @@ final total image.
 #:license: GNU, see LICENSE.txt for details.
 
 import sys
+import os
 import math
 import numpy
-
-from multiprocessing import Pool
+import tempfile
+import fractions
+import hashlib
+import binascii
+import functools
+import shutil
+import cPickle as pickle
+import threading
+import Queue
+import time
 
 import ClearMap.IO as io
 
 from ClearMap.Utils.ParameterTools import writeParameter
 from ClearMap.Utils.ProcessWriter import ProcessWriter;
 from ClearMap.Utils.Timer import Timer;
+from ClearMap.Utils.Executor import createExecutor, Executor
+import ClearMap.Utils.Profiler as prof
+from ClearMap.Utils.Progress import createProgress, workerName
 
    
 def printSubStackInfo(subStack, out = sys.stdout):
@@ -62,36 +90,422 @@ def printSubStackInfo(subStack, out = sys.stdout):
     out.write('\n');
 
 
+def _readSubStack(sub):
+    """Helper to read the image data of a sub-stack
+    
+    If the sub-stack refers to a shared buffer the data is returned as a 
+    copy-on-write view into the memory map, otherwise it is read from the source.
+    """
+    
+    if "sharedSource" in sub:
+        shared = numpy.load(sub["sharedSource"], mmap_mode = 'c');
+        r = sub["sharedRange"];
+        return shared[r[0][0]:r[0][1], r[1][0]:r[1][1], r[2][0]:r[2][1]];
+    else:
+        return io.readData(sub["source"], x = sub["x"], y = sub["y"], z = sub["z"]);
+
+
 #define the subroutine for the processing
-def _processSubStack(dsr):
-    """Helper to process stack in parallel"""
+def _processSubStack(dsr, img = None, events = None):
+    """Helper to process stack in parallel
+    
+    Arguments:
+        dsr (tuple): processing function, parameter, sub-stack, verbose and profiling options or None
+        img (array or None): data of a prefetched sub-stack
+        events (list or None): profiling events of prefetching the sub-stack
+    
+    Returns:
+        tuple: sub-stack id, result and dictionary of further information, e.g. the worker, processing time and profiling events
+    """
 
     sf  = dsr[0];
     pp  = dsr[1];
     sub = dsr[2];
     verbose = dsr[3];
+    profile = dsr[4] if len(dsr) > 4 else None;
 
     timer = Timer();
     pw = ProcessWriter(sub["stackId"]);
     
+    if profile is not None:
+        prof.startRecording(stackId = sub["stackId"], **profile);
+    
     if verbose:
         pw.write("processing substack " + str(sub["stackId"]) + "/" + str(sub["nStacks"]));
-        pw.write("file          = " + sub["source"]);
+        pw.write("file          = " + str(sub["source"]));
         pw.write("segmentation  = " + str(sf));
         pw.write("ranges: x,y,z = " + str(sub["x"]) +  "," + str(sub["y"]) + "," + str(sub["z"])); 
     
-    img = io.readData(sub["source"], x = sub["x"], y = sub["y"], z = sub["z"]);
+    if img is None:
+        with prof.span('read') as s:
+            img = _readSubStack(sub);
+            s.args["voxels"] = img.size;
+            s.track(img);
     
-    if verbose:
-        pw.write(timer.elapsedTime(head = 'Reading data of size ' + str(img.shape)));
+        if verbose:
+            pw.write(timer.elapsedTime(head = 'Reading data of size ' + str(img.shape)));
+    elif verbose:
+        pw.write('Using prefetched data of size ' + str(img.shape));
     
     timer.reset();
-    seg = sf(img, subStack = sub, out = pw, **pp);    
+    with prof.span('process', voxels = img.size):
+        seg = sf(img, subStack = sub, out = pw, **pp);    
+    duration = timer.elapsedTime(asstring = False);
 
     if verbose:    
         pw.write(timer.elapsedTime(head = 'Processing substack of size ' + str(img.shape)));
     
-    return seg;
+    if "checkpoint" in sub:
+        with prof.span('checkpoint'):
+            _writeCheckpoint(sub["checkpoint"], seg);
+    
+    info = {"worker" : workerName(), "voxels" : img.size, "time" : duration};
+    if profile is not None:
+        info["trace"] = (events or []) + prof.stopRecording();
+    
+    return (sub["stackId"], seg, info);
+
+
+def _prefetchSubStacks(argdata, prefetch = 1):
+    """Generator reading sub-stacks ahead of their processing in a background thread
+    
+    Arguments:
+        argdata (list): list of the arguments passed to :func:`_processSubStack`
+        prefetch (int): maximal number of sub-stacks read in advance
+    
+    Returns:
+        generator: the arguments together with the image data and profiling events of each sub-stack
+    """
+    
+    queue = Queue.Queue(maxsize = prefetch);
+    stop = threading.Event();
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout = 0.1);
+                return True;
+            except Queue.Full:
+                pass;
+        return False;
+    
+    def read():
+        try:
+            for dsr in argdata:
+                start = time.time();
+                img = _readSubStack(dsr[2]);
+                events = [];
+                if len(dsr) > 4 and dsr[4] is not None:
+                    events.append(prof.event('read', start, time.time() - start, stackId = dsr[2]["stackId"], voxels = img.size, nbytes = img.nbytes));
+                if not put((dsr, img, events, None)):
+                    return;
+        except:
+            put((None, None, None, sys.exc_info()));
+    
+    reader = threading.Thread(target = read, name = 'SubStackReader');
+    reader.daemon = True;
+    reader.start();
+    
+    try:
+        for i in range(len(argdata)):
+            dsr, img, events, error = queue.get();
+            if error is not None:
+                raise error[0], error[1], error[2];
+            yield dsr, img, events;
+    finally:
+        stop.set();
+        reader.join();
+
+
+def _countResult(result):
+    """Helper to determine the number of points in the result of a sub-stack"""
+    
+    if isinstance(result, tuple) and len(result) > 0:
+        result = result[0];
+    if isinstance(result, numpy.ndarray) and result.ndim == 2:
+        return result.shape[0];
+    else:
+        return 0;
+
+
+def _reportProgress(processed, progress):
+    """Helper to update the progress with the sub-stacks as they are processed
+    
+    Arguments:
+        processed (iterable): (stackId, result, info) tuples in any order
+        progress (Progress): the progress to update
+    
+    Returns:
+        generator: the processed sub-stacks
+    """
+    
+    for stackId, result, info in processed:
+        progress.update(voxels = info.get("voxels", 0), items = _countResult(result), worker = info.get("worker"), duration = info.get("time"));
+        yield stackId, result, info;
+    
+    progress.finish();
+
+
+def _joinResults(processed, subStacks, checkpoints, sink, join, streaming, processingDirectory, parameter, infos = None):
+    """Helper to join the results of the sub-stacks as they are processed
+    
+    Arguments:
+        processed (iterable): (stackId, result, info) tuples in any order
+        subStacks (list): list of all sub-stacks
+        checkpoints (dict): results of sub-stacks restored from checkpoints
+        sink (str or None): destination for the result
+        join (function or class): join function or streaming join class
+        streaming (bool): if True pass the results to the streaming join as they arrive
+        processingDirectory (str or None): directory for temporary files of the streaming join
+        parameter (dict): parameter passed to the join
+        infos (list or None): list to add the further information of each processed sub-stack to
+    
+    Returns:
+        str or array: results of the image processing
+    """
+    
+    if infos is None:
+        infos = [];
+    
+    if not streaming:
+        for stackId, result, info in processed:
+            checkpoints[stackId] = result;
+            infos.append(info);
+        results = [checkpoints[sub["stackId"]] for sub in subStacks];
+        
+        #join the results
+        results = join(results, subStacks = subStacks, **parameter);
+    
+        #write / or return 
+        return io.writePoints(sink, results);
+    
+    if join is joinPoints:
+        join = PointSink;
+    if not isinstance(join, type):
+        raise RuntimeError('streaming join expects a class with append and close methods, got %r!' % join);
+    
+    joiner = join(sink = sink, subStacks = subStacks, processingDirectory = processingDirectory, **parameter);
+    
+    for sub in subStacks:
+        if sub["stackId"] in checkpoints:
+            joiner.append(checkpoints.pop(sub["stackId"]), sub);
+    
+    for stackId, result, info in processed:
+        joiner.append(result, subStacks[stackId]);
+        infos.append(info);
+    
+    return joiner.close();
+
+
+def _hashObject(h, obj):
+    """Helper to update a hash with a parameter object in a reproducible way
+    
+    Only values that are the same in every interpreter are hashed, i.e. numbers, 
+    strings, arrays, functions and containers of them. Of other objects, e.g. 
+    open files such as sys.stdout, only the type is hashed as their 
+    representation may contain a memory address.
+    """
+    
+    if obj is None or isinstance(obj, (bool, int, long, float, complex, basestring, numpy.number, numpy.bool_, numpy.dtype)):
+        h.update(type(obj).__name__ + repr(obj));
+    elif isinstance(obj, dict):
+        h.update('dict');
+        for k in sorted(obj.keys()):
+            _hashObject(h, k);
+            _hashObject(h, obj[k]);
+    elif isinstance(obj, list) or isinstance(obj, tuple):
+        h.update(type(obj).__name__ + str(len(obj)));
+        for o in obj:
+            _hashObject(h, o);
+    elif isinstance(obj, set) or isinstance(obj, frozenset):
+        h.update(type(obj).__name__ + str(len(obj)));
+        for o in sorted(obj, key = repr):
+            _hashObject(h, o);
+    elif isinstance(obj, numpy.ndarray):
+        h.update('array' + str(obj.dtype) + str(obj.shape));
+        if obj.ndim > 1:
+            #hash slice by slice to not copy large arrays
+            for o in obj:
+                h.update(numpy.ascontiguousarray(o).data);
+        else:
+            h.update(numpy.ascontiguousarray(obj).data);
+    elif isinstance(obj, functools.partial):
+        h.update('partial');
+        _hashObject(h, obj.func);
+        _hashObject(h, obj.args);
+        _hashObject(h, obj.keywords);
+    elif callable(obj) and hasattr(obj, '__name__'):
+        h.update('function' + str(getattr(obj, '__module__', '')) + '.' + obj.__name__);
+        code = getattr(obj, 'func_code', None);
+        if code is not None:
+            _hashCode(h, code);
+            _hashObject(h, obj.func_defaults);
+    else:
+        h.update('object' + type(obj).__module__ + '.' + type(obj).__name__);
+
+
+def _hashCode(h, code):
+    """Helper to update a hash with the byte code, constants and names of a code object"""
+    
+    h.update(code.co_code);
+    h.update(repr(code.co_names));
+    for c in code.co_consts:
+        if isinstance(c, type(code)):
+            _hashCode(h, c);
+        else:
+            _hashObject(h, c);
+
+
+def _hashSource(h, subStack):
+    """Helper to update a hash with the source data of a sub-stack"""
+    
+    source = subStack["source"];
+    if isinstance(source, numpy.ndarray):
+        _hashObject(h, io.readData(source, x = subStack["x"], y = subStack["y"], z = subStack["z"]));
+    else:
+        _hashObject(h, source);
+        if isinstance(source, basestring) and os.path.isfile(source):
+            s = os.stat(source);
+            _hashObject(h, (s.st_size, s.st_mtime));
+
+
+def checkpointFileName(checkpointDirectory, subStack, function = None, parameter = None):
+    """Returns the file name of the checkpoint of a sub-stack
+    
+    The name contains the sub-stack id and a hash of the processing function, 
+    the parameter and the sub-stack data so that checkpoints of runs with 
+    different settings are not confused. The hash covers:
+    
+    * the module, name, byte code, constants and default arguments of the 
+      processing function, but not the code of the functions it calls
+    * the parameter, including the content of arrays and the code of functions;
+      of other objects, e.g. open files such as *out*, only the type
+    * the sub-stack information, i.e. its ranges and overlaps
+    * for array sources the content of the sub-stack, for file sources the 
+      file name and, for single files, their size and modification time
+    
+    Arguments:
+        checkpointDirectory (str): directory for the checkpoint files
+        subStack (dict): sub-stack information, see :ref:`SubStack`
+        function (function): the image processing function
+        parameter (dict or None): parameter passed to the processing function
+        
+    Returns:
+        str: file name of the checkpoint
+    """
+    
+    h = hashlib.md5();
+    _hashObject(h, function);
+    _hashObject(h, parameter);
+    
+    _hashSource(h, subStack);
+    _hashObject(h, dict((k, v) for k, v in subStack.items() if k != "source"));
+    
+    return os.path.join(checkpointDirectory, 'checkpoint_%04d_%s.pkl' % (subStack["stackId"], h.hexdigest()));
+
+
+def _writeCheckpoint(filename, result):
+    """Helper to write a checkpoint file atomically"""
+    
+    tmpname = filename + '.%d.tmp' % os.getpid();
+    with open(tmpname, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL);
+    os.rename(tmpname, filename);
+
+
+def _readCheckpoint(filename):
+    """Helper to read a checkpoint file, returns (valid, result)"""
+    
+    if not os.path.exists(filename):
+        return (False, None);
+    
+    try:
+        with open(filename, 'rb') as f:
+            return (True, pickle.load(f));
+    except Exception:
+        return (False, None);
+
+
+def _checkpointSubStacks(subStacks, checkpointDirectory, resume, function, parameter, verbose = False):
+    """Helper to load valid checkpoints and mark the remaining sub-stacks for checkpointing
+    
+    Returns:
+        tuple: dictionary of results from valid checkpoints, list of sub-stacks to process
+    """
+    
+    results = {};
+    todo = [];
+    
+    if checkpointDirectory is None:
+        return results, subStacks;
+    
+    if not os.path.exists(checkpointDirectory):
+        os.makedirs(checkpointDirectory);
+    
+    for sub in subStacks:
+        filename = checkpointFileName(checkpointDirectory, sub, function = function, parameter = parameter);
+        
+        if resume:
+            valid, result = _readCheckpoint(filename);
+            if valid:
+                results[sub["stackId"]] = result;
+                continue;
+        
+        sub = sub.copy();
+        sub["checkpoint"] = filename;
+        todo.append(sub);
+    
+    if verbose and resume:
+        print "Checkpoints: resuming with %d of %d sub-stacks already processed" % (len(results), len(subStacks));
+    
+    return results, todo;
+
+
+def _runSubStacks(subStacks, checkpointDirectory, resume):
+    """Helper to mark the sub-stacks to process with the id of the run
+    
+    A resumed run continues the run of the checkpoints so that the data of the 
+    sub-stacks processed before is kept in the volumes written by :func:`writeSubStack`.
+    """
+    
+    runId = None;
+    if checkpointDirectory is not None:
+        filename = os.path.join(checkpointDirectory, 'run_id');
+        if resume and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                runId = f.read().strip();
+    
+    if not runId:
+        runId = '%s_%d' % (binascii.hexlify(os.urandom(8)), os.getpid());
+        if checkpointDirectory is not None:
+            with open(filename, 'w') as f:
+                f.write(runId);
+    
+    return [dict(sub, runId = runId) for sub in subStacks];
+
+
+def _writeSubStackToVolume(filename, img, subStack):
+    """Helper to write the non-redundant part of a sub-stack into a volume of the size of the processed region"""
+    
+    import ClearMap.IO.RAW as raw
+    
+    stackRange = subStack["stackRange"];
+    shape = tuple(r[1] - r[0] for r in stackRange);
+    
+    sl = [];
+    for d,a in enumerate('xyz'):
+        if a + "CenterIndices" in subStack:
+            c = subStack[a + "CenterIndices"];
+            sl.append(slice(c[0] - stackRange[d][0], c[1] - stackRange[d][0]));
+        else:
+            sl.append(slice(None));
+    
+    volume = raw.createVolume(filename, shape, img.dtype, runId = subStack.get("runId", None));
+    volume[tuple(sl)] = img;
+    volume.flush();
+    del volume;
+    
+    return filename;
 
 
 def writeSubStack(filename, img, subStack = None):
@@ -100,6 +514,16 @@ def writeSubStack(filename, img, subStack = None):
     The routine is used to write out images when porcessed in parallel.
     It assumes that the filename is a patterned file name.
     
+    For sub-stacks that are split in x or y the block position is inserted 
+    into the file name, i.e. each block is written into its own file list
+    ``<header>x<xstart>_y<ystart>_<z-pattern>``.
+    
+    If the file name is a raw/mhd file a single volume of the size of the 
+    processed region is created and each sub-stack writes its non-redundant
+    part into it via a memory map, see :func:`~ClearMap.IO.RAW.createVolume`.
+    This is safe for concurrent processes on a single host. A volume left by
+    a previous run is replaced by an empty one, see ``runId`` in :ref:`SubStack`.
+    
     Arguments:
         filename (str or None): file name pattern as described in 
                         :mod:`~ClearMap.Io.FileList`, if None return as array
@@ -111,22 +535,84 @@ def writeSubStack(filename, img, subStack = None):
        str or array: the file name pattern or image
     """
     
-    if not subStack is None:
-        ii = subStack["zSubStackCenterIndices"][0];
-        ee = subStack["zSubStackCenterIndices"][1];
-        si = subStack["zCenterIndices"][0];
-    else:
-        si = 0;
-        ii = 0;
-        ee = -1;
+    if subStack is None:
+        return io.writeData(filename, img, startIndex = 0);
+    
+    sl = [];
+    for a in 'xyz':
+        if a + "SubStackCenterIndices" in subStack:
+            c = subStack[a + "SubStackCenterIndices"];
+            sl.append(slice(c[0], c[1]));
+        else:
+            sl.append(slice(None));
     
-    return io.writeData(filename, img[:,:,ii:ee], startIndex = si );     
+    if not filename is None and io.fileExtension(filename) in ["raw", "mhd"]:
+        return _writeSubStackToVolume(filename, img[tuple(sl)], subStack);
+    
+    if not filename is None and ("xCenters" in subStack or "yCenters" in subStack):
+        xs = subStack["xCenterIndices"][0] if "xCenters" in subStack else 0;
+        ys = subStack["yCenterIndices"][0] if "yCenters" in subStack else 0;
+        i = filename.find('\\d');
+        if i < 0:
+            i = len(filename);
+        filename = filename[:i] + ('x%04d_y%04d_' % (xs, ys)) + filename[i:];
+    
+    return io.writeData(filename, img[tuple(sl)], startIndex = subStack["zCenterIndices"][0]);     
+
 
 
+def trimPoints(result, subStack, shiftPoints = True):
+    """Restricts the points of a single sub-stack to its non-redundant region
+    
+    Points are restricted to the region between the centers of the overlaps 
+    along all axes in which the stack was split and shifted to the final 
+    coordinates as in :func:`joinPoints`.
+    
+    Arguments:
+        result (tuple): points and intensities found in the sub-stack
+        subStack (dict): sub-stack information, see :ref:`SubStack`
+        shiftPoints (bool): if True shift points to refer to origin of the image stack considered
+                            when range specification is given. If False, absolute 
+                            position in entire image stack.
+    
+    Returns:
+       tuple: trimmed points, trimmed intensities
+    """
+    
+    cts = result[0];
+    cti = result[1];
+    
+    if cts.size == 0:
+        return (cts, cti);
+    
+    split = [a + "Centers" in subStack for a in 'xyz'];
+    
+    iid = numpy.ones(cts.shape[0], dtype = bool);
+    for d,a in enumerate('xyz'):
+        if split[d]:
+            cts[:,d] += subStack[a][0];
+            c = subStack[a + "Centers"];
+            iid = numpy.logical_and(iid, numpy.logical_and(c[0] <= cts[:,d], cts[:,d] < c[1]));
+    cts = cts[iid,:];
+    if not cti is None:
+        cti = cti[iid];
+    
+    #absolute offsets are added for all split axes
+    origin = numpy.array([r[0] for r in subStack["stackRange"]]);
+    if shiftPoints:
+        cts = cts + numpy.logical_not(split) * origin;
+    else:
+        cts = cts - numpy.array(split) * origin;
+    
+    return (cts, cti);
+
 
 def joinPoints(results, subStacks = None, shiftPoints = True, **args):
     """Joins a list of points obtained from processing a stack in chunks
     
+    Points in each sub-stack are restricted to the region between the centers
+    of the overlaps along all axes in which the stack was split.
+    
     Arguments:
         results (list): list of point results from the individual sub-processes
         subStacks (list or None): list of all sub-stack information, see :ref:`SubStack`
@@ -136,44 +622,133 @@ def joinPoints(results, subStacks = None, shiftPoints = True, **args):
     
     Returns:
        tuple: joined points, joined intensities
+       
+    See Also:
+        :func:`trimPoints`, :class:`PointSink`
     """
     
     nchunks = len(results);
-    pointlist = [results[i][0] for i in range(nchunks)];
-    intensities = [results[i][1] for i in range(nchunks)]; 
     
-    results = [];
-    resultsi = [];
-    for i in range(nchunks):
-        cts = pointlist[i];
-        cti = intensities[i];
-
-        if cts.size > 0:
-            cts[:,2] += subStacks[i]["z"][0];
-            iid = numpy.logical_and(subStacks[i]["zCenters"][0] <= cts[:,2] , cts[:,2] < subStacks[i]["zCenters"][1]);
-            cts = cts[iid,:];
-            results.append(cts);
-            if not cti is None:
-                cti = cti[iid];
-                resultsi.append(cti);
+    results = [trimPoints(results[i], subStacks[i], shiftPoints = shiftPoints) for i in range(nchunks)];
+    results = [r for r in results if r[0].size > 0];
             
     if results == []:
-        if not intensities is None:
-            return (numpy.zeros((0,3)), numpy.zeros((0)));
-        else:
-            return numpy.zeros((0,3))
+        return (numpy.zeros((0,3)), numpy.zeros((0)));
     else:
-        points = numpy.concatenate(results);
+        points = numpy.concatenate([r[0] for r in results]);
+        intensities = [r[1] for r in results if not r[1] is None];
         
-        if shiftPoints:
-            points = points + io.pointShiftFromRange(io.dataSize(subStacks[0]["source"]), x = subStacks[0]["x"], y = subStacks[0]["y"], z = 0);
-        else:
-            points = points - io.pointShiftFromRange(io.dataSize(subStacks[0]["source"]), x = 0, y = 0, z = subStacks[0]["z"]); #absolute offset is added initially via zranges !
-            
-        if intensities is None:
+        if intensities == []:
             return points;
         else:
-            return (points, numpy.concatenate(resultsi));
+            return (points, numpy.concatenate(intensities));
+
+
+class PointSink(object):
+    """Streaming join of points obtained from processing a stack in chunks
+    
+    Results of the sub-stacks are appended as they are processed in any order,
+    trimmed to their non-redundant region via :func:`trimPoints` and collected.
+    If the final sink is a file the trimmed points are spooled to temporary 
+    files so that the memory of the joining process stays bounded.
+    
+    The class implements the streaming join protocol used by 
+    :func:`parallelProcessStack` and :func:`sequentiallyProcessStack`, i.e. it
+    is created via ``PointSink(sink = sink, subStacks = subStacks, **parameter)``, 
+    sub-stack results are added via :meth:`append` and the final result is
+    written and returned via :meth:`close`.
+    
+    Attributes:
+        sink (str, tuple or None): the final destination of the points
+        shiftPoints (bool): shift points as in :func:`joinPoints`
+        processingDirectory (str or None): directory for the temporary files
+    """
+    
+    def __init__(self, sink = None, subStacks = None, shiftPoints = True, processingDirectory = None, **args):
+        self.sink = sink;
+        self.shiftPoints = shiftPoints;
+        
+        self.spool = not sink is None and not sink == (None, None);
+        self.processingDirectory = processingDirectory;
+        self.spoolDirectory = None;
+        
+        self.points = [];
+        self.intensities = [];
+        self.npoints = 0;
+        self.pointsType = None;
+        self.intensitiesType = None;
+        
+    def _spoolFile(self, name):
+        if self.spoolDirectory is None:
+            self.spoolDirectory = tempfile.mkdtemp(dir = self.processingDirectory);
+        return os.path.join(self.spoolDirectory, name);
+    
+    def _spoolData(self, name, data, dtype):
+        with open(self._spoolFile(name), 'ab') as f:
+            numpy.ascontiguousarray(data, dtype = dtype[0]).tofile(f);
+    
+    def _readSpool(self, name, dtype):
+        return numpy.memmap(self._spoolFile(name), dtype = dtype[0], mode = 'r', shape = (self.npoints,) + dtype[1]);
+    
+    def append(self, result, subStack):
+        """Add the result of a sub-stack
+        
+        Arguments:
+            result (tuple): points and intensities found in the sub-stack
+            subStack (dict): sub-stack information, see :ref:`SubStack`
+        """
+        
+        cts, cti = trimPoints(result, subStack, shiftPoints = self.shiftPoints);
+        if cts.size == 0:
+            return;
+        
+        if self.pointsType is None:
+            self.pointsType = (cts.dtype, cts.shape[1:]);
+            if not cti is None:
+                self.intensitiesType = (cti.dtype, cti.shape[1:]);
+        
+        if self.spool:
+            self._spoolData('points.raw', cts, self.pointsType);
+            if not self.intensitiesType is None:
+                self._spoolData('intensities.raw', cti, self.intensitiesType);
+        else:
+            self.points.append(cts);
+            if not cti is None:
+                self.intensities.append(cti);
+        
+        self.npoints += cts.shape[0];
+    
+    def close(self):
+        """Write the joined points to the sink
+        
+        Returns:
+            str, array or tuple: the result of writing the points to the sink
+        """
+        
+        if self.npoints == 0:
+            result = (numpy.zeros((0,3)), numpy.zeros((0)));
+        elif self.spool:
+            points = self._readSpool('points.raw', self.pointsType);
+            if self.intensitiesType is None:
+                result = points;
+            else:
+                result = (points, self._readSpool('intensities.raw', self.intensitiesType));
+        else:
+            points = numpy.concatenate(self.points);
+            if self.intensities == []:
+                result = points;
+            else:
+                result = (points, numpy.concatenate(self.intensities));
+        
+        result = io.writePoints(self.sink, result);
+        
+        self.points = [];
+        self.intensities = [];
+        if not self.spoolDirectory is None:
+            shutil.rmtree(self.spoolDirectory);
+            self.spoolDirectory = None;
+        
+        return result;
 
 
 
@@ -299,18 +874,68 @@ def calculateChunkSize(size, processes = 2, chunkSizeMax = 100, chunkSizeMin = 3
     return nchunks, zranges, zcenters;
 
 
-def calculateSubStacks(source, z = all, x = all, y = all, **args):
+def _chunkParameterToAxes(value, default, zOnly = False):
+    """Helper to convert a chunk parameter to a list of values for the x,y,z axes
+    
+    A single value is used for all axes or only for the z axis if zOnly is True.
+    """
+    
+    if isinstance(value, tuple) or isinstance(value, list):
+        if len(value) != 3:
+            raise RuntimeError("calculateSubStacks: chunk parameter %s not a number or (x,y,z) tuple!" % str(value));
+        return [default if v is None else v for v in value];
+    elif zOnly:
+        return [default, default, value];
+    else:
+        return [value, value, value];
+
+
+def _axisChunks(size, r, **args):
+    """Helper to calculate ranges, centers and center indices of chunks along a single axis"""
+    
+    nchunks, ranges, centers = calculateChunkSize(size, **args);
+    
+    #adjust for the range
+    centers = [c + r[0] for c in centers];
+    ranges = [(c[0] + r[0], c[1] + r[0]) for c in ranges];
+    
+    chunks = [];
+    indexlo = r[0];
+    for i in range(nchunks):
+        
+        indexhi = int(round(centers[i+1]));
+        if indexhi > r[1] or i == nchunks - 1:
+            indexhi = r[1];
+        
+        cs = ranges[i][1] - ranges[i][0];
+        
+        chunks.append({"range" : ranges[i], "centers" : (centers[i], centers[i+1]), 
+                       "centerIndices" : (indexlo, indexhi),
+                       "subStackCenterIndices" : (indexlo - ranges[i][0], cs - (ranges[i][1] - indexhi))});
+        
+        indexlo = indexhi;
+    
+    return chunks;
+
+
+def calculateSubStacks(source, z = all, x = all, y = all, processes = 2, chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15,
+                       chunkOptimization = True, chunkOptimizationSize = all, verbose = True):
     """Calculates the chunksize and other info for parallel processing and returns a list of sub-stack objects
     
     The sub-stack information is described in :ref:`SubStack`  
     
+    The chunk parameter can be given as single numbers or as (x,y,z) tuples.
+    A single maximal chunk size splits the stack in z-direction only, a tuple
+    splits the stack into 3d blocks with overlaps in all three axes. An entry 
+    ``all`` in the chunkSizeMax tuple leaves the corresponding axis unsplit.
+    
     Arguments:
         source (str): image source
         x,y,z (tuple or all): range specifications
         processes (int): number of parallel processes
-        chunkSizeMax (int): maximal size of a sub-stack
-        chunkSizeMin (int): minial size of a sub-stack
-        chunkOverlap (int): minimal sub-stack overlap
+        chunkSizeMax (int or tuple): maximal size of a sub-stack
+        chunkSizeMin (int or tuple): minial size of a sub-stack
+        chunkOverlap (int or tuple): minimal sub-stack overlap
         chunkOptimization (bool): optimize chunck sizes to best fit number of processes
         chunkOptimizationSize (bool or all): if True only decrease the chunk size when optimizing
         verbose (bool): print information on sub-stack generation
@@ -319,43 +944,428 @@ def calculateSubStacks(source, z = all, x = all, y = all, **args):
         list: list of sub-stack objects
     """    
     
-    #determine z ranges
     fs = io.dataSize(source);
-    zs = fs[2];
-    zr = io.toDataRange(zs, r = z);
-    nz = zr[1] - zr[0];
+    ranges = [io.toDataRange(fs[d], r = r) for d,r in enumerate((x,y,z))];
+    
+    chunkSizeMax = _chunkParameterToAxes(chunkSizeMax, all, zOnly = True);
+    chunkSizeMin = _chunkParameterToAxes(chunkSizeMin, 0);
+    chunkOverlap = _chunkParameterToAxes(chunkOverlap, 0);
     
-    #calculate optimal chunk sizes
-    nchunks, zranges, zcenters = calculateChunkSize(nz, **args);
+    if chunkSizeMax[2] is all:
+        chunkSizeMax[2] = max(1, ranges[2][1] - ranges[2][0]);
+    
+    #calculate chunks in x and y, no optimization wrt to processes
+    chunks = [];
+    for d in range(2):
+        if chunkSizeMax[d] is all:
+            chunks.append(None);
+        else:
+            if verbose:
+                print "ChunkSize: Axis %s" % 'xy'[d];
+            chunks.append(_axisChunks(ranges[d][1] - ranges[d][0], ranges[d], processes = processes, 
+                                      chunkSizeMax = chunkSizeMax[d], chunkSizeMin = chunkSizeMin[d], chunkOverlap = chunkOverlap[d],
+                                      chunkOptimization = False, verbose = verbose));
     
-    #adjust for the zrange
-    zcenters = [c + zr[0] for c in zcenters];
-    zranges = [(zc[0] + zr[0], zc[1] + zr[0]) for zc in zranges];
+    #optimize the number of z chunks such that the total number of blocks fits the processes
+    nxy = numpy.prod([1 if c is None else len(c) for c in chunks]);
+    zprocesses = max(1, processes / fractions.gcd(processes, nxy));
+    
+    chunks.append(_axisChunks(ranges[2][1] - ranges[2][0], ranges[2], processes = zprocesses, 
+                              chunkSizeMax = chunkSizeMax[2], chunkSizeMin = chunkSizeMin[2], chunkOverlap = chunkOverlap[2],
+                              chunkOptimization = chunkOptimization, chunkOptimizationSize = chunkOptimizationSize, verbose = verbose));
     
     #create substacks
+    nchunks = [1 if c is None else len(c) for c in chunks];
+    nStacks = numpy.prod(nchunks);
     subStacks = [];
-    indexlo = zr[0];
     
-    for i in range(nchunks):
+    for iz in range(nchunks[2]):
+        for iy in range(nchunks[1]):
+            for ix in range(nchunks[0]):
+                sub = {"stackId" : len(subStacks), "nStacks" : nStacks, 
+                       "source" : source, "x" : x, "y" : y, "z" : z,
+                       "stackRange" : tuple(ranges)};
+                
+                for d, i in enumerate((ix, iy, iz)):
+                    if chunks[d] is None:
+                        continue;
+                    a = 'xyz'[d];
+                    c = chunks[d][i];
+                    sub[a] = c["range"];
+                    sub[a + "Centers"] = c["centers"];
+                    sub[a + "CenterIndices"] = c["centerIndices"];
+                    sub[a + "SubStackCenterIndices"] = c["subStackCenterIndices"];
+                
+                subStacks.append(sub);
+    
+    if verbose and nStacks != nchunks[2]:
+        print "SubStacks: %d x %d x %d blocks" % tuple(nchunks);
+    
+    return subStacks;
+
+
+def calculateMemoryLimits(source, x = all, y = all, z = all, processes = 2, memoryBudget = None, memoryFactor = 1,
+                          chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15, verbose = True):
+    """Calculates number of processes and maximal chunk size to keep the memory within a budget
+    
+    The memory needed to process a sub-stack is estimated as the size of the 
+    sub-stack in the source data type plus *memoryFactor* float32 copies of it
+    made by the processing function. The maximal chunk size in z and, if 
+    necessary, the number of processes are reduced such that *processes* 
+    sub-stacks fit into the budget at the same time.
+    
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        processes (int): number of parallel processes
+        memoryBudget (int or None): total memory in bytes available for processing, if None no limits are applied
+        memoryFactor (float): number of float32 copies of a sub-stack made by the processing function
+        chunkSizeMax (int or tuple): maximal size of a sub-stack, a (x,y,z) tuple splits into 3d blocks
+        chunkSizeMin (int or tuple): minial size of a sub-stack
+        chunkOverlap (int or tuple): minimal sub-stack overlap
+        verbose (bool): print information on the memory limits
         
-        indexhi = int(round(zcenters[i+1]));
-        if indexhi > zr[1] or i == nchunks - 1:
-            indexhi = zr[1];
+    Returns:
+        tuple: number of processes, maximal chunk size
+    """
+    
+    if memoryBudget is None:
+        return processes, chunkSizeMax;
+    
+    pre = "MemoryLimits: ";
+    
+    dataSize = io.dataSize(source, x = x, y = y, z = z);
+    if isinstance(source, numpy.ndarray):
+        dtype = source.dtype;
+    else:
+        zr = io.toDataRange(io.dataSize(source)[2], r = z);
+        dtype = io.readData(source, x = x, y = y, z = (zr[0], zr[0] + 1)).dtype;
+    
+    sizeMax = _chunkParameterToAxes(chunkSizeMax, all, zOnly = True);
+    sizeMin = _chunkParameterToAxes(chunkSizeMin, 0);
+    overlap = _chunkParameterToAxes(chunkOverlap, 0);
+    
+    #memory per plane of a sub-stack
+    planeSize = [dataSize[d] if sizeMax[d] is all else min(sizeMax[d], dataSize[d]) for d in range(2)];
+    planeMemory = planeSize[0] * planeSize[1] * (dtype.itemsize + 4 * memoryFactor);
+    
+    #chunk sizes may exceed the estimated size by one plane due to rounding
+    planesMin = min(max(sizeMin[2], overlap[2] + 1), dataSize[2]) + 1;
+    
+    planes = int(memoryBudget / (processes * planeMemory));
+    if planes < planesMin:
+        processes = int(memoryBudget / (planesMin * planeMemory));
+        if processes < 1:
+            raise RuntimeError("calculateMemoryLimits: memory budget of %d bytes too small for a single sub-stack of %d bytes, split in x,y or reduce chunkSizeMin!" % (memoryBudget, planesMin * planeMemory));
+        planes = int(memoryBudget / (processes * planeMemory));
+    
+    zmax = min(dataSize[2], planes - 1);
+    if sizeMax[2] is not all:
+        zmax = min(zmax, sizeMax[2]);
+    
+    if isinstance(chunkSizeMax, tuple) or isinstance(chunkSizeMax, list):
+        chunkSizeMax = tuple(chunkSizeMax[:2]) + (zmax,);
+    else:
+        chunkSizeMax = zmax;
+    
+    if verbose:
+        print pre + "source of size %s and type %s, %d bytes per sub-stack plane" % (str(dataSize), str(dtype), planeMemory);
+        print pre + "using %d processes with maximal chunk size %s for a budget of %d bytes" % (processes, str(chunkSizeMax), memoryBudget);
+    
+    return processes, chunkSizeMax;
+
+
+def calculateChunkOverlap(function, parameter, chunkSizeMax = 100, verbose = True):
+    """Calculates the minimal overlap of the sub-stacks from the spatial footprint of the processing function
+    
+    The processing function needs to provide a *footprint* attribute, a function 
+    that returns the maximal distance in pixel along x,y,z of the pixels 
+    influencing the result at a pixel given the processing parameter, see e.g.
+    :func:`~ClearMap.ImageProcessing.SpotDetection.detectSpotsFootprint`. The 
+    sub-stacks are cut in the center of their overlap, thus the overlap is 
+    twice the footprint.
+    
+    Arguments:
+        function (function): the image processing function
+        parameter (dict): the parameter passed to the processing function
+        chunkSizeMax (int or tuple): maximal size of a sub-stack, a (x,y,z) tuple splits into 3d blocks
+        verbose (bool): print information on the overlap
+    
+    Returns:
+        int or tuple: the chunk overlap, a (x,y,z) tuple if the stack is split into 3d blocks
+    """
+    
+    footprint = getattr(function, 'footprint', None);
+    if footprint is None:
+        raise RuntimeError("calculateChunkOverlap: processing function %s has no footprint, specify the chunkOverlap explicitly!" % str(function));
+    
+    overlap = tuple(2 * int(math.ceil(f)) for f in footprint(**parameter));
+    
+    if verbose:
+        print "ChunkOverlap: footprint of %s requires an overlap of %s" % (getattr(function, '__name__', str(function)), str(overlap));
+    
+    if isinstance(chunkSizeMax, tuple) or isinstance(chunkSizeMax, list):
+        return overlap;
+    else:
+        return overlap[2];
+
+
+def calculateDynamicChunkSize(source, x = all, y = all, z = all, processes = 2, chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15, 
+                              chunksPerProcess = 4, verbose = True):
+    """Calculates a maximal chunk size that splits the stack into many small sub-stacks for dynamic scheduling
+    
+    The maximal chunk size in z is reduced such that there are at least 
+    *chunksPerProcess* sub-stacks per process, but not below the minimal chunk
+    size or the overlap. Many small sub-stacks handed out to the processes as 
+    they become idle balance sub-stacks with very different processing costs.
+    
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        processes (int): number of parallel processes
+        chunkSizeMax (int or tuple): maximal size of a sub-stack, a (x,y,z) tuple splits into 3d blocks
+        chunkSizeMin (int or tuple): minial size of a sub-stack
+        chunkOverlap (int or tuple): minimal sub-stack overlap
+        chunksPerProcess (int): minimal number of sub-stacks per process
+        verbose (bool): print information on the chunk size
         
-        zs = zranges[i][1] - zranges[i][0];
+    Returns:
+        int or tuple: maximal chunk size
+    """
+    
+    dataSize = io.dataSize(source, x = x, y = y, z = z);
+    
+    sizeMax = _chunkParameterToAxes(chunkSizeMax, all, zOnly = True);
+    sizeMin = _chunkParameterToAxes(chunkSizeMin, 0);
+    overlap = _chunkParameterToAxes(chunkOverlap, 0);
+    
+    def nchunks(d, cs):
+        if cs is all or cs >= dataSize[d]:
+            return 1;
+        return int(math.ceil((dataSize[d] - cs) / (1. * (cs - overlap[d])) + 1));
+    
+    nxy = nchunks(0, sizeMax[0]) * nchunks(1, sizeMax[1]);
+    nz = int(math.ceil(chunksPerProcess * processes / (1. * nxy)));
+    if nz <= nchunks(2, sizeMax[2]):
+        return chunkSizeMax;
+    
+    zmax = int(math.ceil((dataSize[2] + (nz - 1) * overlap[2]) / (1. * nz)));
+    zmax = min(max(zmax, sizeMin[2], overlap[2] + 1), dataSize[2]);
+    if sizeMax[2] is not all:
+        zmax = min(zmax, sizeMax[2]);
+    
+    if isinstance(chunkSizeMax, tuple) or isinstance(chunkSizeMax, list):
+        chunkSizeMax = tuple(chunkSizeMax[:2]) + (zmax,);
+    else:
+        chunkSizeMax = zmax;
+    
+    if verbose:
+        print "DynamicChunkSize: using maximal chunk size %s for at least %d sub-stacks per process" % (str(chunkSizeMax), chunksPerProcess);
+    
+    return chunkSizeMax;
+
+
+def estimateSubStackCosts(subStacks, samplePlanes = 3, sampleStep = 8, costBase = 0.1):
+    """Estimates the relative processing cost of sub-stacks from a low resolution sample of the data
+    
+    A few z-planes of each sub-stack are read and subsampled in x and y. The 
+    foreground signal is the mean intensity above the median of all samples, 
+    which is dominated by the background in typical light sheet data. The cost 
+    of a sub-stack is its number of voxels times *costBase* plus its foreground 
+    signal relative to the average foreground signal, so that sub-stacks 
+    with many bright cells are estimated to be more expensive than empty ones.
+    
+    Arguments:
+        subStacks (list): list of sub-stacks, see :ref:`SubStack`
+        samplePlanes (int): number of z-planes sampled per sub-stack
+        sampleStep (int): subsampling step in x and y
+        costBase (float): relative cost of a voxel without foreground signal
+    
+    Returns:
+        list: estimated cost of each sub-stack
+    """
+    
+    samples = []; voxels = [];
+    for sub in subStacks:
+        r = subStackDataRange(sub);
+        planes = numpy.unique(numpy.linspace(r[2][0], r[2][1] - 1, samplePlanes).astype(int));
+        sample = [numpy.asarray(io.readData(sub["source"], x = r[0], y = r[1], z = (p, p + 1)))[::sampleStep, ::sampleStep] for p in planes];
+        samples.append(numpy.concatenate([smp.ravel() for smp in sample]).astype('float32'));
+        voxels.append(sample[0].shape[0] * sample[0].shape[1] * sampleStep * sampleStep * (r[2][1] - r[2][0]));
+    
+    background = numpy.median(numpy.concatenate(samples));
+    signal = numpy.array([numpy.mean(numpy.clip(smp - background, 0, None)) for smp in samples]);
+    signalMean = signal.mean();
+    if signalMean > 0:
+        signal = signal / signalMean;
+    
+    return [v * (costBase + sig) for v, sig in zip(voxels, signal)];
+
+
+def subStackDataRange(subStack):
+    """Returns the absolute x,y,z ranges of a sub-stack within the full image
+    
+    Arguments:
+        subStack (dict): sub-stack information, see :ref:`SubStack`
+    
+    Returns:
+        tuple: absolute ranges of the sub-stack along each axis
+    """
+    
+    return tuple(subStack[a] if a + "Centers" in subStack else subStack["stackRange"][d] for d,a in enumerate('xyz'));
+
+
+def createSharedSource(source, x = all, y = all, z = all, processingDirectory = None, chunkSize = 100, verbose = False):
+    """Reads the source once into a memory mapped buffer to be shared among processes
+    
+    The data is read in chunks of z-planes so that the full image never has
+    to be held in memory. Sub-stacks can then be accessed as views into the 
+    buffer without reading from the original source again.
+    
+    The buffer gets a unique file name so concurrent runs can share the
+    processing directory. If reading fails the buffer is removed again.
+    
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        processingDirectory (str or None): directory for the buffer file, if None a temporary directory is created
+        chunkSize (int): number of z-planes read at once
+        verbose (bool): print progress information
         
-        subStacks.append({"stackId" : i, "nStacks" : nchunks, 
-                          "source" : source, "x" : x, "y" : y, "z" : zranges[i], 
-                          "zCenters" : (zcenters[i], zcenters[i+1]),
-                          "zCenterIndices" : (indexlo, indexhi),
-                          "zSubStackCenterIndices" : (indexlo - zranges[i][0], zs - (zranges[i][1] - indexhi))});
+    Returns:
+        str: file name of the memory mapped buffer, see :func:`removeSharedSource`
         
-        indexlo = indexhi; # + 1;
+    Note:
+        For true shared memory the processing directory should reside on a 
+        memory backed file system, e.g. '/dev/shm' on linux.
+    """
     
-    return subStacks;
+    timer = Timer();
+    
+    temporary = processingDirectory is None;
+    if temporary:
+        processingDirectory = tempfile.mkdtemp();
+    
+    fd, filename = io.createTemporaryFile(directory = processingDirectory, prefix = 'shared_source_', suffix = '.npy');
+    os.close(fd);
+    
+    try:
+        dataSize = io.dataSize(source, x = x, y = y, z = z);
+        zr = io.toDataRange(io.dataSize(source)[2], r = z);
+        
+        dtype = io.readData(source, x = x, y = y, z = (zr[0], zr[0] + 1)).dtype;
+        
+        shared = numpy.lib.format.open_memmap(filename, mode = 'w+', dtype = dtype, shape = dataSize);
+        
+        for zlo in range(zr[0], zr[1], chunkSize):
+            zhi = min(zlo + chunkSize, zr[1]);
+            shared[:,:,zlo-zr[0]:zhi-zr[0]] = io.readData(source, x = x, y = y, z = (zlo, zhi));
+        
+        shared.flush();
+        del shared;
+    except:
+        removeSharedSource(filename, removeDirectory = temporary);
+        raise;
+    
+    if verbose:
+        print timer.elapsedTime(head = 'Shared source of size ' + str(dataSize) + ' created in ' + filename);
+    
+    return filename;
+
+
+def removeSharedSource(filename, removeDirectory = False):
+    """Removes a buffer created by :func:`createSharedSource`
+    
+    Arguments:
+        filename (str): file name of the memory mapped buffer
+        removeDirectory (bool): if True remove the temporary directory of the buffer as well
+    """
+    
+    if os.path.exists(filename):
+        os.remove(filename);
+    if removeDirectory:
+        try:
+            os.rmdir(os.path.split(filename)[0]);
+        except OSError:
+            pass;
+
 
+def _sharedSubStack(subStack, sharedSource):
+    """Helper to create the sub-stack information referring to a shared buffer"""
+
+    sub = subStack.copy();
+    sub["sharedSource"] = sharedSource;
+    
+    origin = [r[0] for r in subStack["stackRange"]];
+    sub["sharedRange"] = tuple((r[0] - o, r[1] - o) for r,o in zip(subStackDataRange(subStack), origin));
+
+    #avoid pickling array sources, the data size is sufficient for the processing routines
+    if isinstance(sub["source"], numpy.ndarray):
+        sub["source"] = sub["source"].shape;
+
+    return sub;
 
         
+def _skipSubStacks(subStacks, skipSubStack, verbose = False):
+    """Helper to remove sub-stacks that need no processing and renumber the remaining ones
+    
+    Arguments:
+        subStacks (list): list of all sub-stacks
+        skipSubStack (function or None): function returning True for sub-stacks to skip
+        verbose (bool): print information on the skipped sub-stacks
+    
+    Returns:
+        list: the sub-stacks to process
+    """
+    
+    if skipSubStack is None:
+        return subStacks;
+    
+    keep = [sub for sub in subStacks if not skipSubStack(sub)];
+    for i, sub in enumerate(keep):
+        sub["stackId"] = i;
+        sub["nStacks"] = len(keep);
+    
+    if verbose:
+        print "Skipping %d of %d sub-stacks!" % (len(subStacks) - len(keep), len(subStacks));
+    
+    return keep;
+
+
+def _profilingOptions(profile, profileMemory):
+    """Helper to determine the profiling options passed to the sub-stack processing"""
+    
+    if profile is None and not profileMemory:
+        return None;
+    else:
+        return {"memory" : profileMemory};
+
+
+def _reportProfile(profile, profileMemory, infos, start, verbose = False):
+    """Helper to write and summarize the profiling events of all sub-stacks"""
+    
+    events = [prof.event('processStack', start, time.time() - start)];
+    for info in infos:
+        events.extend(info.get("trace", []));
+    
+    if verbose:
+        prof.printSummary(events[1:]);
+    
+    if profileMemory:
+        prof.printMemorySummary(events[1:]);
+        
+        # memory factor in terms of float32 copies of the sub-stack as used by calculateMemoryLimits
+        summary = prof.summarizeMemory(events[1:]);
+        reads = [e["args"] for e in events if e["name"] == 'read' and e["args"].get("voxels", 0) > 0 and "nbytes" in e["args"]];
+        if "process" in summary and len(reads) > 0:
+            itemsize = float(reads[0]["nbytes"]) / reads[0]["voxels"];
+            factor = max(0.0, (summary["process"]["bytesPerVoxel"] - itemsize) / 4.0);
+            print "Memory: estimated memoryFactor for calculateMemoryLimits: %.1f" % factor;
+    
+    if profile is not None:
+        prof.writeTrace(profile, events);
+
+
 def noProcessing(img, **parameter):
     """Perform no image processing at all and return original image
     
@@ -371,33 +1381,121 @@ def noProcessing(img, **parameter):
 
 def parallelProcessStack(source, x = all, y = all, z = all, sink = None,
                          processes = 2, chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15,
-                         chunkOptimization = True, chunkOptimizationSize = all, 
-                         function = noProcessing, join = joinPoints, verbose = False, **parameter):
+                         chunkOptimization = True, chunkOptimizationSize = all, memoryBudget = None, memoryFactor = 1,
+                         sharedMemory = False, scheduling = 'static', chunksPerProcess = 4, skipSubStack = None,
+                         processingDirectory = None, checkpointDirectory = None, resume = False,
+                         streaming = False, executor = None, profile = None, profileMemory = False, progress = False, function = noProcessing, join = joinPoints, verbose = False, **parameter):
     """Parallel process a image stack
     
     Main routine that distributes image processing on paralllel processes.
+    
+    The sub-stacks are processed by the *executor*, by default the persistent
+    pool of local worker processes. Threads or workers on several hosts can be
+    used via a :class:`~ClearMap.Utils.Executor.ThreadExecutor` or 
+    :class:`~ClearMap.Utils.Executor.ClusterExecutor`. In the latter case
+    *processes* should be the total number of workers and all sources, sinks
+    and the *processingDirectory* need to be accessible from all hosts.
+    
+    If *profile* is a file name the duration of reading and processing each 
+    sub-stack and of the individual processing steps are recorded and written
+    to this file as a trace, see :mod:`~ClearMap.Utils.Profiler`. If *profileMemory* 
+    is set, the resident and peak memory of the workers before and after each step
+    are recorded as well and the maximal memory increase per step and per voxel 
+    is summarized after processing, e.g. to choose the *memoryFactor* for 
+    large data sets.
+    
+    If *progress* is set, the number of finished sub-stacks, the voxels processed 
+    per second, the number of points found so far and the estimated remaining 
+    time are reported as the results arrive, together with the throughput of 
+    each worker in the status file, see :mod:`~ClearMap.Utils.Progress`.
+    
+    If *skipSubStack* is given, sub-stacks for which it returns True are not
+    processed and do not contribute to the result, e.g. sub-stacks outside 
+    the tissue, see :mod:`~ClearMap.ImageProcessing.TissueDetection`.
+    
+    If *sharedMemory* is True the source is read only once into a memory mapped
+    buffer (see :func:`createSharedSource`) and the processes work on views of
+    their sub-stacks. This avoids reading overlapping regions multiple times 
+    and pickling of large array sources.
+    
+    If a *checkpointDirectory* is given the result of each sub-stack is written
+    to a checkpoint file as soon as it is processed. With *resume* set to True
+    sub-stacks with valid checkpoints are not processed again, see 
+    :func:`checkpointFileName`.
+    
+    If *streaming* is True the results are handed to the join as soon as the
+    individual sub-stacks are finished instead of collecting all of them 
+    first. In this case *join* is expected to be a class implementing the 
+    streaming join protocol, see :class:`PointSink`, which is used in place of
+    :func:`joinPoints`. This bounds the memory of the main process for large
+    numbers of sub-stacks.
+    
+    If a *memoryBudget* is given, the chunk size and number of processes are
+    reduced to keep the estimated memory use within the budget, see 
+    :func:`calculateMemoryLimits`.
+    
+    With *scheduling* set to 'dynamic' the stack is split into at least 
+    *chunksPerProcess* sub-stacks per process, see :func:`calculateDynamicChunkSize`, 
+    which are handed to the processes as they become idle in the order of 
+    their estimated processing cost, largest first, see :func:`estimateSubStackCosts`.
+    This avoids idle processes waiting for a few expensive sub-stacks at the 
+    end of the processing, e.g. when the density of cells varies strongly.
        
     Arguments:
         source (str): image source
         x,y,z (tuple or all): range specifications
         sink (str or None): destination for the result
         processes (int): number of parallel processes
-        chunkSizeMax (int): maximal size of a sub-stack
-        chunkSizeMin (int): minial size of a sub-stack
-        chunkOverlap (int): minimal sub-stack overlap
+        chunkSizeMax (int or tuple): maximal size of a sub-stack, a (x,y,z) tuple splits into 3d blocks
+        chunkSizeMin (int or tuple): minial size of a sub-stack
+        chunkOverlap (int, tuple or 'auto'): minimal sub-stack overlap, if 'auto' determined from the footprint of the processing function, see :func:`calculateChunkOverlap`
         chunkOptimization (bool): optimize chunck sizes to best fit number of processes
         chunkOptimizationSize (bool or all): if True only decrease the chunk size when optimizing
+        memoryBudget (int or None): total memory in bytes available for processing, if None no limit is applied
+        memoryFactor (float): number of float32 copies of a sub-stack made by the processing function
+        sharedMemory (bool): if True read the source once into a buffer shared by all processes
+        scheduling (str): 'static' to fit the sub-stacks to the number of processes or 'dynamic' to process many small sub-stacks largest first
+        chunksPerProcess (int): minimal number of sub-stacks per process for dynamic scheduling
+        skipSubStack (function or None): function returning True for sub-stacks that contain no data to process, e.g. :meth:`~ClearMap.ImageProcessing.TissueDetection.TissueMask.isEmpty`
+        processingDirectory (str or None): directory for the shared buffer and temporary files, if None a temporary directory is used
+        checkpointDirectory (str or None): directory to write the results of each sub-stack to, if None no checkpoints are written
+        resume (bool): if True reuse the results of valid checkpoints
+        streaming (bool): if True join the results of the sub-stacks as they are finished
+        executor (str, Executor or None): executor to process the sub-stacks, see :func:`~ClearMap.Utils.Executor.createExecutor`,
+                                          an executor passed in is not shut down, on errors its remaining tasks are cancelled
+        profile (str or None): file name to write the profiling trace to, if None no profiling is done
+        profileMemory (bool): if True record and summarize the memory used by each sub-stack and processing step
+        progress (bool or str): if True report the finished sub-stacks, throughput, points found and ETA, if a file name write the status also to this file
         function (function): the main image processing script
-        join (function): the fuction to join the results from the image processing script
+        join (function or class): the fuction to join the results from the image processing script or a streaming join class
         verbose (bool): print information on sub-stack generation
         
     Returns:
         str or array: results of the image processing
     """     
     
+    start = time.time();
+    
+    if isinstance(chunkOverlap, basestring) and chunkOverlap == 'auto':
+        chunkOverlap = calculateChunkOverlap(function, parameter, chunkSizeMax = chunkSizeMax, verbose = verbose);
+    
+    if memoryBudget is not None:
+        processes, chunkSizeMax = calculateMemoryLimits(source, x = x, y = y, z = z, processes = processes, 
+                                                        memoryBudget = memoryBudget, memoryFactor = memoryFactor,
+                                                        chunkSizeMax = chunkSizeMax, chunkSizeMin = chunkSizeMin, chunkOverlap = chunkOverlap, verbose = verbose);
+        chunkOptimizationSize = False;
+    
+    if scheduling == 'dynamic':
+        chunkSizeMax = calculateDynamicChunkSize(source, x = x, y = y, z = z, processes = processes, chunksPerProcess = chunksPerProcess,
+                                                 chunkSizeMax = chunkSizeMax, chunkSizeMin = chunkSizeMin, chunkOverlap = chunkOverlap, verbose = verbose);
+        chunkOptimization = False;
+    elif scheduling != 'static':
+        raise RuntimeError("parallelProcessStack: invalid scheduling %s, expected 'static' or 'dynamic'!" % str(scheduling));
+    
     subStacks = calculateSubStacks(source, x = x, y = y, z = z, 
                                    processes = processes, chunkSizeMax = chunkSizeMax, chunkSizeMin = chunkSizeMin, chunkOverlap = chunkOverlap,
                                    chunkOptimization = chunkOptimization, chunkOptimizationSize = chunkOptimizationSize, verbose = verbose);
+    subStacks = _skipSubStacks(subStacks, skipSubStack, verbose = verbose);
                                    
     nSubStacks = len(subStacks);
     if verbose:
@@ -406,44 +1504,92 @@ def parallelProcessStack(source, x = all, y = all, z = all, sink = None,
     #for i in range(nSubStacks):
     #    self.printSubStackInfo(subStacks[i]);
     
-    argdata = [];
-    for i in range(nSubStacks):
-        argdata.append((function, parameter, subStacks[i], verbose));    
-    #print argdata
+    checkpoints, todo = _checkpointSubStacks(subStacks, checkpointDirectory, resume, function, parameter, verbose = verbose);
+    todo = _runSubStacks(todo, checkpointDirectory, resume);
     
-    # process in parallel
-    pool = Pool(processes = processes);    
-    results = pool.map(_processSubStack, argdata);
+    if scheduling == 'dynamic' and len(todo) > 1:
+        costs = estimateSubStackCosts(todo);
+        todo = [todo[i] for i in numpy.argsort(costs)[::-1]];
+        if verbose:
+            print "Dynamic scheduling: sub-stacks ordered by estimated cost: %s" % str([sub["stackId"] for sub in todo]);
     
-    #print '=========== results';
-    #print results;
+    #executors of the caller are only cancelled on errors, not shut down
+    ownExecutor = not isinstance(executor, Executor);
+    executor = createExecutor(executor, processes = processes);
+    
+    sharedSource = None;
+    processed = None;
+    infos = [];
+    try:
+        if sharedMemory and len(todo) > 0:
+            sharedSource = createSharedSource(source, x = x, y = y, z = z, processingDirectory = processingDirectory, 
+                                              chunkSize = _chunkParameterToAxes(chunkSizeMax, all, zOnly = True)[2], verbose = verbose);
+        
+        argdata = [];
+        for sub in todo:
+            if sharedMemory:
+                sub = _sharedSubStack(sub, sharedSource);
+            argdata.append((function, parameter, sub, verbose, _profilingOptions(profile, profileMemory)));    
+        #print argdata
+        
+        # process in parallel, results are passed on in the order they are finished
+        processed = executor.imapUnordered(_processSubStack, argdata, functions = [function]);
+        processed = _reportProgress(processed, createProgress(progress, 'parallelProcessStack', nSubStacks, skipped = nSubStacks - len(todo)));
         
-    #join the results
-    results = join(results, subStacks = subStacks, **parameter);
+        results = _joinResults(processed, subStacks, checkpoints, sink, join, streaming, processingDirectory, parameter, infos = infos);
+    except:
+        #stop the remaining sub-stacks
+        if processed is not None:
+            if ownExecutor:
+                executor.shutdown(terminate = True);
+            else:
+                executor.cancel();
+        raise;
+    finally:
+        if sharedSource is not None:
+            removeSharedSource(sharedSource, removeDirectory = processingDirectory is None);
+    
+    if profile is not None or profileMemory:
+        _reportProfile(profile, profileMemory, infos, start, verbose = verbose);
     
-    #write / or return 
-    return io.writePoints(sink, results);
+    return results;
 
 
 def sequentiallyProcessStack(source, x = all, y = all, z = all, sink = None,
-                             chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15,
-                             function = noProcessing, join = joinPoints, verbose = False, **parameter):
+                             chunkSizeMax = 100, chunkSizeMin = 30, chunkOverlap = 15, memoryBudget = None, memoryFactor = 1, skipSubStack = None,
+                             processingDirectory = None, checkpointDirectory = None, resume = False,
+                             streaming = False, prefetch = 0, profile = None, profileMemory = False, progress = False, function = noProcessing, join = joinPoints, verbose = False, **parameter):
     """Sequential image processing on a stack
     
     Main routine that sequentially processes a large image on sub-stacks.
+    
+    Checkpoints, streaming joins, memory budgets, profiling and progress reports are handled as in :func:`parallelProcessStack`.
+    
+    If *prefetch* is larger than zero a background thread reads up to this
+    number of sub-stacks ahead while the current one is processed, so that
+    reading the data and processing overlap.
        
     Arguments:
         source (str): image source
         x,y,z (tuple or all): range specifications
         sink (str or None): destination for the result
         processes (int): number of parallel processes
-        chunkSizeMax (int): maximal size of a sub-stack
-        chunkSizeMin (int): minial size of a sub-stack
-        chunkOverlap (int): minimal sub-stack overlap
-        chunkOptimization (bool): optimize chunck sizes to best fit number of processes
-        chunkOptimizationSize (bool or all): if True only decrease the chunk size when optimizing
+        chunkSizeMax (int or tuple): maximal size of a sub-stack, a (x,y,z) tuple splits into 3d blocks
+        chunkSizeMin (int or tuple): minial size of a sub-stack
+        chunkOverlap (int, tuple or 'auto'): minimal sub-stack overlap, if 'auto' determined from the footprint of the processing function
+        memoryBudget (int or None): total memory in bytes available for processing, if None no limit is applied
+        memoryFactor (float): number of float32 copies of a sub-stack made by the processing function
+        skipSubStack (function or None): function returning True for sub-stacks that contain no data to process
+        processingDirectory (str or None): directory for temporary files of the streaming join, if None a temporary directory is used
+        checkpointDirectory (str or None): directory to write the results of each sub-stack to, if None no checkpoints are written
+        resume (bool): if True reuse the results of valid checkpoints
+        streaming (bool): if True join the results of the sub-stacks as they are finished
+        prefetch (int): number of sub-stacks to read ahead in a background thread, if 0 no data is read in advance
+        profile (str or None): file name to write the profiling trace to, if None no profiling is done
+        profileMemory (bool): if True record and summarize the memory used by each sub-stack and processing step
+        progress (bool or str): if True report the finished sub-stacks, throughput, points found and ETA, if a file name write the status also to this file
         function (function): the main image processing script
-        join (function): the fuction to join the results from the image processing script
+        join (function or class): the fuction to join the results from the image processing script or a streaming join class
         verbose (bool): print information on sub-stack generation
         
     Returns:
@@ -451,28 +1597,45 @@ def sequentiallyProcessStack(source, x = all, y = all, z = all, sink = None,
     """     
     #determine z ranges  
     
+    start = time.time();
+    
+    if isinstance(chunkOverlap, basestring) and chunkOverlap == 'auto':
+        chunkOverlap = calculateChunkOverlap(function, parameter, chunkSizeMax = chunkSizeMax, verbose = verbose);
+    
+    if memoryBudget is not None:
+        processes, chunkSizeMax = calculateMemoryLimits(source, x = x, y = y, z = z, processes = 1, 
+                                                        memoryBudget = memoryBudget, memoryFactor = memoryFactor,
+                                                        chunkSizeMax = chunkSizeMax, chunkSizeMin = chunkSizeMin, chunkOverlap = chunkOverlap, verbose = verbose);
+    
     subStacks = calculateSubStacks(source, x = x, y = y, z = z, 
                                    processes = 1, chunkSizeMax = chunkSizeMax, chunkSizeMin = chunkSizeMin, chunkOverlap = chunkOverlap,  
                                    chunkOptimization = False, verbose = verbose);
+    subStacks = _skipSubStacks(subStacks, skipSubStack, verbose = verbose);
     
     nSubStacks = len(subStacks);
     #print nSubStacks;    
     
+    checkpoints, todo = _checkpointSubStacks(subStacks, checkpointDirectory, resume, function, parameter, verbose = verbose);
+    todo = _runSubStacks(todo, checkpointDirectory, resume);
+    
     argdata = [];
-    for i in range(nSubStacks):
-        argdata.append((function, parameter, subStacks[i], verbose));    
+    for sub in todo:
+        argdata.append((function, parameter, sub, verbose, _profilingOptions(profile, profileMemory)));    
     
     #run sequentially
-    results = [];
-    for i in range(nSubStacks):
-        results.append(_processSubStack(argdata[i]));
+    if prefetch > 0:
+        processed = (_processSubStack(dsr, img, events) for dsr, img, events in _prefetchSubStacks(argdata, prefetch));
+    else:
+        processed = (_processSubStack(a) for a in argdata);
+    processed = _reportProgress(processed, createProgress(progress, 'sequentiallyProcessStack', nSubStacks, skipped = nSubStacks - len(todo)));
     
-    #join the results
-    results = join(results, subStacks = subStacks, **parameter);
+    infos = [];
+    results = _joinResults(processed, subStacks, checkpoints, sink, join, streaming, processingDirectory, parameter, infos = infos);
     
-    #write / or return 
-    return io.writePoints(sink, results);
-
+    if profile is not None or profileMemory:
+        _reportProfile(profile, profileMemory, infos, start, verbose = verbose);
+    
+    return results;
 
 
 
@@ -532,4 +1695,36 @@ def sequentiallyProcessStack(source, x = all, y = all, z = all, sink = None,
 #    out.write("source:         %s\n" %       slf.source);
 #    out.write("x,y,z:          %s, %s, %s\n" % (str(slf.x), str(slf.y), str(slf.z)));
 #    out.write("zCenters:       %s\n" %       str(slf.zCenters));   
-#    out.write("zCenterIndices: %s\n" %       str(slf.zCenterIndices));
\ No newline at end of file
+#    out.write("zCenterIndices: %s\n" %       str(slf.zCenterIndices));
+
+
+
+def test():
+    """Test StackProcessing module"""
+    import subprocess
+    import re
+    
+    #checkpoints of a run are found by a resumed run in a new interpreter
+    checkpointDirectory = tempfile.mkdtemp();
+    script = """
+import numpy
+import ClearMap.ImageProcessing.StackProcessing as sp
+from ClearMap.ImageProcessing.SpotDetection import detectSpots
+numpy.random.seed(0);
+img = (numpy.random.rand(60, 50, 40) * 100).astype('uint16');
+sp.parallelProcessStack(img, function = detectSpots, processes = 2, chunkSizeMax = 15, chunkSizeMin = 5, chunkOverlap = 3,
+                        checkpointDirectory = %r, resume = True, verbose = True);
+""" % checkpointDirectory;
+    
+    try:
+        for run in range(2):
+            output = subprocess.check_output([sys.executable, '-c', script], stderr = subprocess.STDOUT);
+            resumed = re.search('Checkpoints: resuming with (\\d+) of (\\d+)', output).groups();
+            print 'run %d resumed %s of %s sub-stacks' % ((run,) + resumed);
+        assert resumed[0] == resumed[1], 'checkpoints not reused';
+    finally:
+        shutil.rmtree(checkpointDirectory);
+
+
+if __name__ == "__main__":
+    test();
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of the tissue in large volumetric images
+
+A low resolution maximum projection of the image is obtained from sampled
+z-planes, reduced to the maxima of blocks in x and y. Thresholding this
+projection gives a coarse tissue mask and its bounding box.
+
+Similarly, a mask of selected regions of an annotated atlas is obtained by
+mapping a low resolution grid of the image into the atlas via the resampling 
+and alignment results and labeling the grid points, see :func:`detectRegions`.
+
+The cell detection uses these masks to restrict the processing to the tissue 
+or to the selected regions and to skip sub-stacks that contain only background, 
+e.g. agarose or empty margins, or no part of the regions,
+see :func:`~ClearMap.ImageProcessing.CellDetection.detectCells`.
+
+Example:
+    >>> import ClearMap.ImageProcessing.TissueDetection as td
+    >>> tissue = td.detectTissue(img, threshold = 100);
+    >>> print tissue.ranges
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import sys
+import math
+import numpy
+
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+
+import ClearMap.IO as io
+
+from ClearMap.ImageProcessing.StackProcessing import subStackDataRange
+
+from ClearMap.Analysis.Label import DefaultLabeledImageFile, labelPoints, labelInRegions
+
+from ClearMap.Utils.Timer import Timer
+from ClearMap.Utils.ParameterTools import getParameter, writeParameter
+
+
+def tissueProjection(source, x = all, y = all, z = all, sampleStep = (8, 8, 4)):
+    """Calculates a low resolution maximum projection of an image
+
+    Every *sampleStep[2]*-th z-plane is read and reduced to the maxima of
+    blocks of size *sampleStep[0]* x *sampleStep[1]*.
+
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        sampleStep (tuple): block size in x and y and step between the sampled z-planes
+
+    Returns:
+        tuple: low resolution image, origin of the projection in the full image
+    """
+
+    fs = io.dataSize(source);
+    ranges = [io.toDataRange(fs[d], r = r) for d,r in enumerate((x,y,z))];
+
+    sx, sy, sz = sampleStep;
+    nx = int(math.ceil((ranges[0][1] - ranges[0][0]) / float(sx)));
+    ny = int(math.ceil((ranges[1][1] - ranges[1][0]) / float(sy)));
+    planes = range(ranges[2][0], ranges[2][1], sz);
+
+    projection = None;
+    for i,p in enumerate(planes):
+        plane = numpy.asarray(io.readData(source, x = ranges[0], y = ranges[1], z = (p, p + 1)))[:,:,0];
+        plane = numpy.pad(plane, ((0, nx * sx - plane.shape[0]), (0, ny * sy - plane.shape[1])), mode = 'edge');
+        plane = plane.reshape(nx, sx, ny, sy).max(axis = (1, 3));
+
+        if projection is None:
+            projection = numpy.zeros((nx, ny, len(planes)), dtype = plane.dtype);
+        projection[:,:,i] = plane;
+
+    return projection, tuple(r[0] for r in ranges);
+
+
+class TissueMask(object):
+    """Low resolution mask of the tissue in an image
+
+    Attributes:
+        mask (array): low resolution tissue mask
+        origin (tuple): position of the first mask pixel in the full image
+        sampleStep (tuple): size of a mask pixel in the full image
+        threshold (float or None): threshold used to determine the mask
+        ranges (tuple): x,y,z ranges of the bounding box of the tissue
+    """
+
+    def __init__(self, mask, origin, sampleStep, threshold, ranges):
+        self.mask = mask;
+        self.origin = origin;
+        self.sampleStep = sampleStep;
+        self.threshold = threshold;
+        self.ranges = ranges;
+
+    def _maskRange(self, r, d):
+        """Helper to convert a range in the full image to a range in the mask"""
+
+        s = self.sampleStep[d];
+        lo = int(math.floor((r[0] - self.origin[d]) / float(s)));
+        hi = int(math.ceil((r[1] - self.origin[d]) / float(s)));
+        lo = min(max(lo, 0), self.mask.shape[d] - 1);
+        hi = min(max(hi, lo + 1), self.mask.shape[d]);
+        return (lo, hi);
+
+    def contains(self, x, y, z):
+        """Checks if a region contains tissue
+
+        Arguments:
+            x,y,z (tuple): ranges of the region in the full image
+
+        Returns:
+            bool: True if any mask pixel overlapping the region is tissue
+        """
+
+        r = [self._maskRange(rr, d) for d,rr in enumerate((x,y,z))];
+        return bool(self.mask[r[0][0]:r[0][1], r[1][0]:r[1][1], r[2][0]:r[2][1]].any());
+
+    def isEmpty(self, subStack):
+        """Checks if a sub-stack contains only background
+
+        Arguments:
+            subStack (dict): sub-stack information, see :ref:`SubStack`
+
+        Returns:
+            bool: True if the sub-stack contains no tissue
+        """
+
+        return not self.contains(*subStackDataRange(subStack));
+
+
+def detectTissue(source, x = all, y = all, z = all, detectTissueParameter = None, threshold = None, sampleStep = (8, 8, 4), margin = None,
+                 footprint = None, verbose = False, out = sys.stdout, **parameter):
+    """Detects the tissue in an image via thresholding a low resolution projection
+
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        detectTissueParameter (dict):
+            ============ =================== ===========================================================
+            Name         Type                Descritption
+            ============ =================== ===========================================================
+            *threshold*  (float or None)     pixel above this value are tissue,
+                                             if None the threshold is determined via Otsu's method
+            *sampleStep* (tuple)             block size in x and y and step between sampled z-planes
+            *margin*     (tuple or None)     margin in pixel added to the bounding box of the tissue
+                                             if None use the sample step
+            *skipEmpty*  (bool)              skip sub-stacks without tissue in the cell detection,
+                                             see :func:`~ClearMap.ImageProcessing.CellDetection.detectCells`
+            *verbose*    (bool or int)       print information about this step
+            ============ =================== ===========================================================
+        footprint (tuple or None): footprint of the subsequent processing added to the margin so that 
+                                   the border of the bounding box does not affect the results in the tissue
+        verbose (bool): print progress info
+        out (object): object to write progress info to
+
+    Returns:
+        TissueMask: the tissue mask and its bounding box
+    
+    Note:
+        If no pixel is above the threshold the full image is considered as tissue.
+    """
+
+    threshold  = getParameter(detectTissueParameter, "threshold", threshold);
+    sampleStep = getParameter(detectTissueParameter, "sampleStep", sampleStep);
+    margin     = getParameter(detectTissueParameter, "margin", margin);
+    verbose    = getParameter(detectTissueParameter, "verbose", verbose);
+
+    if verbose:
+        writeParameter(out = out, head = 'Tissue Detection:', threshold = threshold, sampleStep = sampleStep, margin = margin);
+
+    timer = Timer();
+
+    projection, origin = tissueProjection(source, x = x, y = y, z = z, sampleStep = sampleStep);
+
+    if threshold is None:
+        if projection.min() == projection.max():
+            threshold = projection.max();
+        else:
+            threshold = threshold_otsu(projection);
+
+    mask = projection > threshold;
+    if not mask.any():
+        # no information on the tissue, process the full image
+        if verbose:
+            out.write('Tissue Detection: no pixel above threshold %s, using the full image!\n' % str(threshold));
+        mask[:] = True;
+
+    ranges = _boundingBox(source, x, y, z, mask, origin, sampleStep, margin, footprint);
+
+    if verbose:
+        out.write('Tissue Detection: threshold %s, tissue in %.1f%% of the volume, bounding box %s\n' % (str(threshold), 100.0 * mask.mean(), str(ranges)));
+        out.write(timer.elapsedTime(head = 'Tissue Detection') + '\n');
+
+    return TissueMask(mask, origin, sampleStep, threshold, ranges);
+
+
+def _boundingBox(source, x, y, z, mask, origin, sampleStep, margin, footprint):
+    """Helper to calculate the bounding box of a mask including margin and footprint"""
+
+    if margin is None:
+        margin = sampleStep;
+    if footprint is not None:
+        margin = tuple(m + int(math.ceil(f)) for m,f in zip(margin, footprint));
+
+    fs = io.dataSize(source);
+    full = [io.toDataRange(fs[d], r = r) for d,r in enumerate((x,y,z))];
+
+    ranges = [];
+    for d in range(3):
+        axes = tuple(a for a in range(3) if a != d);
+        ids = numpy.where(mask.any(axis = axes))[0];
+        lo = origin[d] + ids[0] * sampleStep[d] - margin[d];
+        hi = origin[d] + (ids[-1] + 1) * sampleStep[d] + margin[d];
+        ranges.append((max(lo, full[d][0]), min(hi, full[d][1])));
+    return tuple(ranges);
+
+
+def transformGridPoints(points, transformation):
+    """Transforms points from the image to the atlas coordinates
+    
+    Arguments:
+        points (array): points in image coordinates
+        transformation (callable or list): function mapping image points to atlas points or a list of 
+                                           (function, parameter) steps applied in order as
+                                           ``points = function(points, **parameter)``, e.g. 
+                                           :func:`~ClearMap.Alignment.Resampling.resamplePoints` and
+                                           :func:`~ClearMap.Alignment.Elastix.transformPoints`
+    
+    Returns:
+        array: points in atlas coordinates
+    """
+    
+    if transformation is None:
+        return points;
+    
+    if callable(transformation):
+        return transformation(points);
+    
+    for function, parameter in transformation:
+        parameter = dict(parameter);
+        for key in ("pointSource", "pointSink", "source", "sink"):
+            parameter.pop(key, None);
+        points = function(points, **parameter);
+    
+    return points;
+
+
+def detectRegions(source, x = all, y = all, z = all, detectRegionsParameter = None, regions = None, labeledImage = DefaultLabeledImageFile, 
+                  transformation = None, sampleStep = (16, 16, 16), margin = None, footprint = None, verbose = False, out = sys.stdout, **parameter):
+    """Detects regions of an annotated atlas in an image
+    
+    The centers of blocks of size *sampleStep* are mapped to the atlas via
+    the transformation and labeled with the annotation. Blocks whose center is
+    in one of the regions or their sub-regions form the mask, which is
+    dilated by one block to include blocks only partly in the regions.
+
+    Arguments:
+        source (str or array): image source
+        x,y,z (tuple or all): range specifications
+        detectRegionsParameter (dict):
+            ================ =================== ===========================================================
+            Name             Type                Descritption
+            ================ =================== ===========================================================
+            *regions*        (list)              ids of the regions in the annotation, sub-regions are included
+            *labeledImage*   (str or array)      annotated atlas image, see :func:`~ClearMap.Analysis.Label.labelPoints`
+            *transformation* (callable or list)  mapping from image to atlas coordinates, see :func:`transformGridPoints`
+            *sampleStep*     (tuple)             size of the blocks of the mask
+            *margin*         (tuple or None)     margin in pixel added to the bounding box of the regions
+                                                 if None use the sample step
+            *skipEmpty*      (bool)              skip sub-stacks without the regions in the cell detection,
+                                                 see :func:`~ClearMap.ImageProcessing.CellDetection.detectCells`
+            *verbose*        (bool or int)       print information about this step
+            ================ =================== ===========================================================
+        footprint (tuple or None): footprint of the subsequent processing added to the margin so that 
+                                   the border of the bounding box does not affect the results in the regions
+        verbose (bool): print progress info
+        out (object): object to write progress info to
+
+    Returns:
+        TissueMask: the mask of the regions and its bounding box
+    """
+
+    regions        = getParameter(detectRegionsParameter, "regions", regions);
+    labeledImage   = getParameter(detectRegionsParameter, "labeledImage", labeledImage);
+    transformation = getParameter(detectRegionsParameter, "transformation", transformation);
+    sampleStep     = getParameter(detectRegionsParameter, "sampleStep", sampleStep);
+    margin         = getParameter(detectRegionsParameter, "margin", margin);
+    verbose        = getParameter(detectRegionsParameter, "verbose", verbose);
+
+    if regions is None:
+        raise RuntimeError("detectRegions: no regions specified!");
+    if isinstance(regions, int):
+        regions = [regions];
+
+    if verbose:
+        writeParameter(out = out, head = 'Region Detection:', regions = regions, sampleStep = sampleStep, margin = margin,
+                       labeledImage = labeledImage if isinstance(labeledImage, basestring) else 'array');
+
+    timer = Timer();
+
+    fs = io.dataSize(source);
+    full = [io.toDataRange(fs[d], r = r) for d,r in enumerate((x,y,z))];
+    origin = tuple(r[0] for r in full);
+    shape = tuple(int(math.ceil((full[d][1] - full[d][0]) / float(sampleStep[d]))) for d in range(3));
+
+    # block centers in image coordinates
+    grid = numpy.indices(shape).reshape(3, -1).T;
+    points = grid * numpy.array(sampleStep, dtype = float) + numpy.array(origin, dtype = float) + 0.5 * numpy.array(sampleStep, dtype = float);
+    
+    points = transformGridPoints(points, transformation);
+    
+    labels = numpy.asarray(labelPoints(points, labeledImage = labeledImage));
+    ids, inverse = numpy.unique(labels, return_inverse = True);
+    mask = labelInRegions(ids, regions)[inverse].reshape(shape);
+    
+    if not mask.any():
+        raise RuntimeError("detectRegions: the regions %s are not in the image!" % str(regions));
+    
+    mask = ndimage.binary_dilation(mask, structure = numpy.ones((3,3,3), dtype = bool));
+
+    ranges = _boundingBox(source, x, y, z, mask, origin, sampleStep, margin, footprint);
+
+    if verbose:
+        out.write('Region Detection: regions in %.1f%% of the volume, bounding box %s\n' % (100.0 * mask.mean(), str(ranges)));
+        out.write(timer.elapsedTime(head = 'Region Detection') + '\n');
+
+    return TissueMask(mask, origin, sampleStep, None, ranges);
+
+
+
+def test():
+    """Test TissueDetection module"""
+    import ClearMap.ImageProcessing.TissueDetection as self
+    reload(self)
+
+    img = numpy.zeros((100, 80, 40), dtype = 'uint16');
+    img[20:60, 30:50, 10:30] = 100;
+
+    tissue = self.detectTissue(img, verbose = True);
+    print tissue.ranges
+    print tissue.contains((0,10), (0,10), (0,10)), tissue.contains((30,40), (30,40), (15,20))
+    
+    # atlas at half resolution with a region 375 in its center
+    atlas = numpy.zeros((50, 40, 20), dtype = 'int32');
+    atlas[20:30, 15:25, 5:15] = 375;
+    regions = self.detectRegions(img, regions = [1080], labeledImage = atlas, sampleStep = (4,4,4),
+                                 transformation = lambda p: p / 2.0, verbose = True);
+    print regions.ranges
+
+
+if __name__ == "__main__":
+    test();
@@ -54,6 +54,9 @@ AnnotationFile = os.path.join(PathReg, 'annotation_25_right_fullWD.tif');
 
 ######################### Cell Detection Parameters using custom filters
 
+#Intermediate results ("save" entries) are written as a list of tif files, e.g. os.path.join(BaseDirectory, 'background\d{4}.tif'),
+#or into a single raw volume, e.g. os.path.join(BaseDirectory, 'background.mhd'), which avoids many small files for whole brains
+
 #Spot detection method: faster, but optimised for spherical objects.
 #You can also use "Ilastik" for more complex objects
 ImageProcessingMethod = "SpotDetection";
@@ -70,6 +73,8 @@ correctIlluminationParameter = {
 #Remove the background with morphological opening (optimised for spherical objects)
 removeBackgroundParameter = {
     "size"    : (7,7),  # size in pixels (x,y) for the structure element of the morphological opening
+    "method"  : 'disk', # 'disk' for an exact disk or 'lines' for a fast octagon, faster for sizes above about (31,31)
+    "downsample" : None,  # (int, tuple or None) estimate smooth backgrounds on slices downsampled by this factor (x,y), if None use full resolution
     "save"    : None,     # file name to save result of this operation
     "verbose" : True  # print / plot information about this step       
 }
@@ -79,6 +84,7 @@ filterDoGParameter = {
     "size"    : None,        # (tuple or None)      size for the DoG filter in pixels (x,y,z) if None, do not correct for any background
     "sigma"   : None,        # (tuple or None)      std of outer Gaussian, if None automatically determined from size
     "sigma2"  : None,        # (tuple or None)      std of inner Gaussian, if None automatically determined from size
+    "separable" : True,      # (bool)               filter as the difference of two separable Gaussians, much faster than the dense 3d kernel
     "save"    : None,        # (str or None)        file name to save result of this operation if None dont save to file 
     "verbose" : True      # (bool or int)        print / plot information about this step
 }
@@ -102,6 +108,7 @@ findIntensityParameter = {
 detectCellShapeParameter = {
     "threshold" : 700,     # (float or None)      threshold to determine mask. Pixels below this are background if None no mask is generated
     "save"      : None,        # (str or None)        file name to save result of this operation if None dont save to file 
+    "extent"    : (5,5,5),     # (tuple)              maximal radius of a cell, used to determine the chunk overlap for "chunkOverlap" : "auto"
     "verbose"   : True      # (bool or int)        print / plot information about this step if None take intensities at the given pixels
 }
 
@@ -113,7 +120,19 @@ detectSpotsParameter = {
     "filterDoGParameter"           : filterDoGParameter,
     "findExtendedMaximaParameter"  : findExtendedMaximaParameter,
     "findIntensityParameter"       : findIntensityParameter,
-    "detectCellShapeParameter"     : detectCellShapeParameter
+    "detectCellShapeParameter"     : detectCellShapeParameter,
+    "inPlace"                      : False,  # (bool) process each sub-stack in a single float32 working buffer to reduce memory, same results
+    "dtype"                        : None,   # (str or None) data type policy, e.g. 'uint16' for the integer morphology path or 'float32', None = default of each step
+    "threads"                      : None    # (int or None) threads processing the slices of a sub-stack in the illumination correction and background removal, None = all cpus if the sub-stacks are processed sequentially, otherwise 1
+}
+
+#Restrict the cell detection to the bounding box of the tissue and skip sub-stacks without tissue
+detectTissueParameter = {
+    "threshold"  : None,      # (float or None)      pixels above this value are tissue, if None determined automatically
+    "sampleStep" : (8,8,4),   # (tuple)              block size in x,y and step between sampled z-planes of the low resolution projection
+    "margin"     : None,      # (tuple or None)      margin in pixel added to the bounding box of the tissue, if None the sample step
+    "skipEmpty"  : True,      # (bool)               skip sub-stacks without tissue
+    "verbose"    : True       # (bool or int)        print information about this step
 }
 
 
@@ -155,8 +174,10 @@ StackProcessingParameter = {
     "processes" : 6,
    
     #chunk sizes: number of planes processed at once
+    #use (x,y,z) tuples, e.g. "chunkSizeMax" : (500, 500, 100), to split into 3d blocks and reduce the memory per process
     "chunkSizeMax" : 100,
     "chunkSizeMin" : 50,
+    #overlap of the chunks, "auto" determines the minimal overlap from the filter and cell sizes of the spot detection
     "chunkOverlap" : 32,
 
     #optimize chunk size and number to number of processes to limit the number of cycles
@@ -164,7 +185,47 @@ StackProcessingParameter = {
     
     #increase chunk size for optimization (True, False or all = automatic)
     "chunkOptimizationSize" : all,
+    
+    #total memory in bytes available for cell detection, e.g. 32 * 1024**3; if set the chunk size and 
+    #number of processes are reduced to fit into this budget (None = no limit)
+    "memoryBudget" : None,
+    
+    #read the data only once into a memory mapped buffer shared by all processes (e.g. for data on network storage)
+    "sharedMemory" : False,
+    
+    #write the result of each sub-stack to this directory and reuse valid results when resuming an interrupted run
+    "checkpointDirectory" : None,
+    "resume" : False,
+    
+    #join the results of the sub-stacks as soon as they are finished to bound the memory of the main process
+    "streaming" : False,
+    
+    #"static" splits the stack to fit the number of processes, "dynamic" processes at least chunksPerProcess smaller sub-stacks per 
+    #process ordered by their estimated cost, largest first, to balance regions with many cells against empty regions
+    "scheduling" : "static",
+    "chunksPerProcess" : 4,
+    
+    #executor processing the sub-stacks in parallel: None or "processes" for local processes, "threads" or a
+    #ClearMap.Utils.Executor.ClusterExecutor to distribute the sub-stacks to workers on several hosts
+    "executor" : None,
+    
+    #number of sub-stacks read ahead in a background thread in sequential processing (0 = no read-ahead)
+    "prefetch" : 0,
+    
+    #file name to write a trace of the time spent in each processing step to, e.g. os.path.join(BaseDirectory, 'profile.json')
+    #the trace can be inspected via chrome://tracing (None = no profiling)
+    "profile" : None,
+    
+    #record and summarize the memory used by each sub-stack and processing step, the summary estimates the
+    #memoryFactor to use with memoryBudget for the chosen processing parameter
+    "profileMemory" : False,
+    
+    #report finished sub-stacks, throughput, cells found and ETA; if a file name, e.g. os.path.join(BaseDirectory, 'status.json'),
+    #the status including the throughput of each worker is also written to this file to be polled by job monitors
+    "progress" : False,
    
+    #"parallel", "sequential" or "threads"; threads share the memory of the main process and avoid copying 
+    #the sub-stacks between processes, the image processing steps of the spot detection release the GIL
     "processMethod" : "parallel"
    };
 
@@ -241,7 +302,9 @@ RegistrationAlignmentParameter["bSplineParameterFile"] = os.path.join(PathReg, '
 SpotDetectionParameter = {
     "source" : cFosFile,
     "sink"   : (os.path.join(BaseDirectory, 'cells-allpoints.npy'),  os.path.join(BaseDirectory,  'intensities-allpoints.npy')),
-    "detectSpotsParameter" : detectSpotsParameter
+    "detectSpotsParameter" : detectSpotsParameter,
+    "detectTissueParameter" : None,  # set to detectTissueParameter to skip the background around the tissue
+    "detectRegionsParameter" : None  # set to detectRegionsParameter (see below) to detect cells only in selected atlas regions
 };
 SpotDetectionParameter = joinParameter(SpotDetectionParameter, cFosFileRange)
 
@@ -271,3 +334,20 @@ RegistrationResamplingPointParameter = RegistrationResamplingParameter.copy();
 RegistrationResamplingPointParameter["dataSizeSource"] = cFosFile;
 RegistrationResamplingPointParameter["pointSink"]  = None;
 
+
+#Restrict the cell detection to regions of the atlas, requires the alignments to be done before the cell detection
+detectRegionsParameter = {
+    "regions"        : [1089],         # (list)              ids of the atlas regions including their sub-regions, e.g. 1089 hippocampal formation
+    "labeledImage"   : AnnotationFile, # (str)               annotated atlas image
+    "transformation" : [(resamplePoints, CorrectionResamplingPointsParameter),                                                            # (list) steps mapping points
+                        (transformPoints, {"transformDirectory" : CorrectionAlignmentParameter["resultDirectory"], "indices" : False}),    # from the image to the atlas
+                        (resamplePointsInverse, CorrectionResamplingPointsInverseParameter),                                              # as for the cells below
+                        (resamplePoints, RegistrationResamplingPointParameter),
+                        (transformPoints, {"transformDirectory" : RegistrationAlignmentParameter["resultDirectory"], "indices" : False})],
+    "sampleStep"     : (16,16,16),     # (tuple)             block size of the region mask
+    "margin"         : None,           # (tuple or None)     margin in pixel added to the bounding box of the regions, if None the sample step
+    "skipEmpty"      : True,           # (bool)              skip sub-stacks without the regions
+    "verbose"        : True            # (bool or int)       print information about this step
+}
+#ImageProcessingParameter["detectRegionsParameter"] = detectRegionsParameter;
+
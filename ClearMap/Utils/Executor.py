@@ -0,0 +1,928 @@
+# -*- coding: utf-8 -*-
+"""
+Provides a persistent pool of worker processes shared by the parallel routines
+
+Creating a new :class:`multiprocessing.Pool` for each processing step forks
+and initializes the workers every time and leaves the pools alive until they
+are garbage collected. Instead, the parallel routines in ClearMap, e.g.
+:func:`~ClearMap.ImageProcessing.StackProcessing.parallelProcessStack` and
+:func:`~ClearMap.Alignment.Resampling.resampleData`, obtain their workers via
+:func:`getPool`. The pool is created once and is shut down via :func:`shutdown`, 
+at the end of an :class:`Executor` context or when the interpreter exits.
+
+Steps requesting different numbers of processes share the pool: it grows to
+the largest number requested so far and :func:`imapUnordered` runs at most the
+requested number of tasks at once, so changing the number of processes between
+steps does not fork and initialize the workers again.
+
+The workers import the modules in :const:`WarmImports` and load constant
+data such as the default flat field line once when they are started.
+
+Note:
+    Workers only know the functions that existed when they were started. 
+    Functions defined interactively in ``__main__`` after that are detected
+    by :func:`getPool` if passed via *functions* and the pool is restarted.
+
+Executors
+---------
+
+The parallel routines hand their tasks to an executor that runs them and 
+returns the results. The following executors are available:
+
+=================== ==========================================================
+Executor            Description
+=================== ==========================================================
+``ProcessExecutor`` persistent pool of local worker processes (default)
+``ThreadExecutor``  pool of threads sharing the address space of the caller,
+                    useful for steps that release the GIL
+``ClusterExecutor`` scheduler distributing the tasks via TCP to worker 
+                    processes on several hosts started via :func:`runWorker`
+=================== ==========================================================
+
+A :class:`ClusterExecutor` generates a random authentication key, see 
+:attr:`ClusterExecutor.authkey`, unless one is given. The key is passed to the
+workers via the environment variable :const:`AuthKeyVariable` or a file 
+readable only by the user, see :meth:`ClusterExecutor.writeAuthKey`, and not 
+on the command line where it is visible to other users. Workers are started 
+on each node via::
+
+    CLEARMAP_AUTHKEY=key python -m ClearMap.Utils.Executor scheduler-host port
+
+or::
+
+    python -m ClearMap.Utils.Executor scheduler-host port keyfile
+
+Each worker processes one sub-stack at a time with a single slice thread, see
+:const:`SliceThreads`. To use several threads per worker, e.g. when starting 
+one worker per node, set the environment variable :const:`SliceThreadsVariable`::
+
+    CLEARMAP_SLICE_THREADS=8 python -m ClearMap.Utils.Executor scheduler-host port keyfile
+
+All hosts need access to ClearMap and to the data sources and sinks, e.g. via a
+shared file system.
+
+Slice threads
+-------------
+
+Image processing steps that work slice by slice, e.g. the background removal,
+process the slices of a sub-stack in parallel threads via :func:`mapSlices`. 
+The number of threads is set via :const:`SliceThreads` or the *threads* 
+parameter of the steps. By default all cpus are used when the sub-stacks are
+processed sequentially in the main process and a single thread in worker 
+processes and threads to not oversubscribe the cpus. Workers of a 
+:class:`ClusterExecutor` use a single thread unless set otherwise, see 
+:func:`runWorker`.
+
+Example:
+    >>> from ClearMap.Utils.Executor import ProcessExecutor
+    >>> with ProcessExecutor(processes = 4) as executor:
+    >>>     print executor.map(abs, [-1, -2, 3]);
+    [1, 2, 3]
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import os
+import sys
+import atexit
+import binascii
+import importlib
+import time
+import threading
+import traceback
+import Queue
+import cPickle as pickle
+import multiprocessing
+import multiprocessing.pool
+
+from multiprocessing.connection import Listener, Client
+
+
+WarmImports = ['numpy', 'scipy.ndimage', 'cv2', 'ClearMap.IO', 'ClearMap.ImageProcessing.SpotDetection'];
+"""list: modules imported by the worker processes at start up"""
+
+
+AuthKeyVariable = 'CLEARMAP_AUTHKEY';
+"""str: environment variable with the authentication key for the workers of a :class:`ClusterExecutor`"""
+
+AuthKeyFileVariable = 'CLEARMAP_AUTHKEY_FILE';
+"""str: environment variable with the name of a file containing the authentication key for the workers"""
+
+SliceThreadsVariable = 'CLEARMAP_SLICE_THREADS';
+"""str: environment variable with the number of slice threads of the workers of a :class:`ClusterExecutor`"""
+
+
+_pool = None;
+_processes = None;
+_mainObjects = {};
+
+SliceThreads = None;
+"""int or None: number of threads of the slice loops of the image processing steps, 
+if None all cpus in the main thread of the main process and one thread otherwise
+
+See Also:
+    :func:`mapSlices`
+"""
+
+
+_threadPool = None;
+_threads = None;
+
+_slicePool = None;
+_sliceThreads = None;
+_slicePoolPid = None;
+_slicePoolLock = threading.Lock();
+
+
+def initializeWorker():
+    """Import modules and load constant data in a worker process"""
+
+    for m in WarmImports:
+        try:
+            importlib.import_module(m);
+        except ImportError:
+            pass;
+
+    try:
+        import ClearMap.ImageProcessing.IlluminationCorrection as ic
+        ic.flatfieldLine(ic.DefaultFlatFieldLineFile);
+    except Exception:
+        pass;
+
+
+def _isKnownToWorkers(function):
+    """Helper to check if a function can be unpickled in the current workers"""
+    
+    if getattr(function, '__module__', None) != '__main__':
+        return True;
+    
+    return _mainObjects.get(function.__name__, None) is function;
+
+
+def getPool(processes = None, functions = None):
+    """Returns the persistent pool of worker processes
+
+    The pool is created on the first call and reused afterwards. A new pool is
+    created if more processes are requested than the pool has, the pool was 
+    terminated or one of the *functions* was defined in ``__main__`` after the 
+    workers were started. The pool may have more workers than requested, use 
+    :func:`imapUnordered` to limit the number of tasks running at once.
+
+    Arguments:
+        processes (int or None): minimal number of worker processes, if None the number of cpus
+        functions (list or None): functions that will be passed to the workers
+
+    Returns:
+        object: the :class:`multiprocessing.Pool` of workers
+    """
+
+    global _pool, _processes, _mainObjects;
+
+    if processes is None:
+        processes = multiprocessing.cpu_count();
+    
+    if functions is None:
+        functions = [];
+
+    if _pool is not None:
+        if _processes < processes or _pool._state != multiprocessing.pool.RUN or not all(_isKnownToWorkers(f) for f in functions):
+            processes = max(processes, _processes);
+            shutdown();
+
+    if _pool is None:
+        main = sys.modules.get('__main__', None);
+        _mainObjects = dict(vars(main)) if main is not None else {};
+        _pool = multiprocessing.Pool(processes = processes, initializer = initializeWorker);
+        _processes = processes;
+
+    return _pool;
+
+
+def imapUnordered(function, argdata, processes = None, functions = None):
+    """Apply a function to each argument in the persistent pool of worker processes
+    
+    Arguments:
+        function (function): the function to apply
+        argdata (list): list of arguments
+        processes (int or None): maximal number of tasks running at once, if None the number of cpus
+        functions (list or None): further functions referred to in the arguments
+    
+    Returns:
+        iterator: the results in the order they are finished
+    """
+    
+    if processes is None:
+        processes = multiprocessing.cpu_count();
+    
+    pool = getPool(processes, functions = [function] + (functions or []));
+    return _imapSubmitted(pool.apply_async, function, argdata, processes, lambda: False);
+
+
+def shutdown(terminate = False):
+    """Shut down the persistent pool of worker processes
+
+    Arguments:
+        terminate (bool): if True stop the workers immediately, otherwise wait for running tasks to finish
+    """
+
+    global _pool, _processes, _mainObjects;
+
+    if _pool is None:
+        return;
+
+    if terminate:
+        _pool.terminate();
+    else:
+        _pool.close();
+    _pool.join();
+
+    _pool = None;
+    _processes = None;
+    _mainObjects = {};
+
+
+def _getThreadPool(threads = None):
+    """Helper returning the persistent pool of threads"""
+    
+    global _threadPool, _threads;
+    
+    if threads is None:
+        threads = multiprocessing.cpu_count();
+    
+    if _threadPool is not None and (_threads != threads or _threadPool._state != multiprocessing.pool.RUN):
+        _shutdownThreadPool();
+    
+    if _threadPool is None:
+        _threadPool = multiprocessing.pool.ThreadPool(processes = threads);
+        _threads = threads;
+    
+    return _threadPool;
+
+
+def _shutdownThreadPool(terminate = False):
+    """Helper to shut down the persistent pool of threads"""
+    
+    global _threadPool, _threads;
+    
+    if _threadPool is None:
+        return;
+    
+    if terminate:
+        _threadPool.terminate();
+    else:
+        _threadPool.close();
+    _threadPool.join();
+    
+    _threadPool = None;
+    _threads = None;
+
+
+def sliceThreads(threads = None):
+    """Returns the number of threads for the slice loops
+    
+    Arguments:
+        threads (int or None): number of threads, if None use :const:`SliceThreads`
+    
+    Returns:
+        int: number of threads
+    """
+    
+    if threads is None:
+        threads = SliceThreads;
+    
+    if threads is None:
+        if multiprocessing.current_process().name == 'MainProcess' and isinstance(threading.current_thread(), threading._MainThread):
+            threads = multiprocessing.cpu_count();
+        else:
+            threads = 1;
+    
+    return max(1, int(threads));
+
+
+def _getSlicePool(threads):
+    """Helper returning the persistent pool of threads for the slice loops"""
+    
+    global _slicePool, _sliceThreads, _slicePoolPid;
+    
+    with _slicePoolLock:
+        if _slicePool is not None and _slicePoolPid != os.getpid():
+            #the threads of the parent are not running in a forked process
+            _slicePool = None;
+        
+        if _slicePool is not None and _sliceThreads != threads:
+            _shutdownSlicePool();
+        
+        if _slicePool is None:
+            _slicePool = multiprocessing.pool.ThreadPool(processes = threads);
+            _sliceThreads = threads;
+            _slicePoolPid = os.getpid();
+        
+        return _slicePool;
+
+
+def _shutdownSlicePool(terminate = False):
+    """Helper to shut down the persistent pool of threads for the slice loops"""
+    
+    global _slicePool, _sliceThreads, _slicePoolPid;
+    
+    if _slicePool is None or _slicePoolPid != os.getpid():
+        return;
+    
+    if terminate:
+        _slicePool.terminate();
+    else:
+        _slicePool.close();
+    _slicePool.join();
+    
+    _slicePool = None;
+    _sliceThreads = None;
+    _slicePoolPid = None;
+
+
+def mapSlices(function, nslices, threads = None):
+    """Apply a function to the indices of the slices of an image in parallel threads
+    
+    The function is called once for each slice index and should release the 
+    GIL for most of its work, e.g. via cv2 or numpy, to run in parallel.
+    
+    Arguments:
+        function (function): function called with the slice index
+        nslices (int): number of slices
+        threads (int or None): number of threads, see :func:`sliceThreads`
+    
+    Returns:
+        list: the results of the function in the order of the slices
+    """
+    
+    threads = sliceThreads(threads);
+    
+    if threads == 1 or nslices <= 1:
+        return [function(z) for z in range(nslices)];
+    
+    return _getSlicePool(threads).map(function, range(nslices), chunksize = 1);
+
+
+atexit.register(shutdown, terminate = True);
+atexit.register(_shutdownThreadPool, terminate = True);
+atexit.register(_shutdownSlicePool, terminate = True);
+
+
+def _callIndexed(arg):
+    """Helper to call a function returning the index of the task with the result"""
+    
+    return (arg[1], arg[0](arg[2]));
+
+
+def _callCaptured(arg):
+    """Helper to call a function returning the result or the exception"""
+    
+    try:
+        return ('result', arg[0](arg[1]));
+    except Exception as error:
+        try:
+            pickle.dumps(error, pickle.HIGHEST_PROTOCOL);
+        except Exception:
+            error = RuntimeError(traceback.format_exc());
+        return ('error', error);
+
+
+def _imapSubmitted(submit, function, argdata, inflight, cancelled):
+    """Helper to apply a function to the arguments via a pool submitting at most *inflight* tasks at once
+    
+    Arguments:
+        submit (function): submits a task to the pool, e.g. :meth:`multiprocessing.pool.Pool.apply_async`
+        function (function): the function to apply
+        argdata (list): list of arguments
+        inflight (int): maximal number of submitted tasks that are not finished
+        cancelled (function): returns True if the remaining tasks are cancelled
+    
+    Returns:
+        iterator: the results in the order they are finished
+    """
+    
+    results = Queue.Queue();
+    argdata = iter(argdata);
+    running = 0;
+    while True:
+        while running < inflight and not cancelled():
+            try:
+                arg = next(argdata);
+            except StopIteration:
+                break;
+            submit(_callCaptured, ((function, arg),), callback = results.put);
+            running += 1;
+        
+        if running == 0:
+            break;
+        
+        #wait with a timeout to stay interruptible
+        while True:
+            try:
+                status, value = results.get(timeout = 1.0);
+                break;
+            except Queue.Empty:
+                pass;
+        running -= 1;
+        
+        if status == 'error':
+            raise value;
+        yield value;
+
+
+class Executor(object):
+    """Base class of the executors running the tasks of the parallel routines
+
+    Executors are context managers that are shut down on exit.
+    
+    Attributes:
+        processes (int or None): number of workers
+    """
+
+    def __init__(self, processes = None):
+        self.processes = processes;
+        self.cancellations = 0;
+    
+    def imapUnordered(self, function, argdata, functions = None):
+        """Apply a function to each argument returning the results as they are finished
+        
+        Arguments:
+            function (function): the function to apply
+            argdata (list): list of arguments
+            functions (list or None): further functions referred to in the arguments
+        
+        Returns:
+            iterator: the results in the order they are finished
+        """
+        raise NotImplementedError('imapUnordered not implemented for %s!' % self.__class__.__name__);
+    
+    def map(self, function, argdata, functions = None):
+        """Apply a function to each argument
+        
+        Arguments:
+            function (function): the function to apply
+            argdata (list): list of arguments
+            functions (list or None): further functions referred to in the arguments
+        
+        Returns:
+            list: the results in the order of the arguments
+        """
+        
+        results = [None] * len(argdata);
+        for i, result in self.imapUnordered(_callIndexed, [(function, i, a) for i,a in enumerate(argdata)], functions = [function] + (functions or [])):
+            results[i] = result;
+        return results;
+    
+    def cancel(self):
+        """Cancel the tasks that are not started yet, the executor stays usable"""
+        self.cancellations += 1;
+    
+    def _cancelled(self):
+        """Returns a function checking if the tasks submitted from now on are cancelled"""
+        cancellations = self.cancellations;
+        return lambda: self.cancellations != cancellations;
+    
+    def shutdown(self, terminate = False):
+        """Shut down the workers
+        
+        Arguments:
+            terminate (bool): if True stop the workers immediately, otherwise wait for running tasks to finish
+        """
+        pass;
+    
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(terminate = exc_type is not None);
+        return False;
+
+
+class ProcessExecutor(Executor):
+    """Executor using the persistent pool of local worker processes, see :func:`getPool`"""
+    
+    def imapUnordered(self, function, argdata, functions = None):
+        processes = self.processes;
+        if processes is None:
+            processes = multiprocessing.cpu_count();
+        pool = getPool(processes, functions = [function] + (functions or []));
+        return _imapSubmitted(pool.apply_async, function, argdata, processes, self._cancelled());
+    
+    def shutdown(self, terminate = False):
+        shutdown(terminate = terminate);
+
+
+class ThreadExecutor(Executor):
+    """Executor using a persistent pool of threads in the calling process
+    
+    Threads share the data of the caller so arguments and results are not 
+    copied, but only run in parallel when the processing releases the GIL.
+    """
+    
+    def imapUnordered(self, function, argdata, functions = None):
+        pool = _getThreadPool(self.processes);
+        return _imapSubmitted(pool.apply_async, function, argdata, _threads, self._cancelled());
+    
+    def map(self, function, argdata, functions = None):
+        return _getThreadPool(self.processes).map(function, argdata);
+    
+    def shutdown(self, terminate = False):
+        _shutdownThreadPool(terminate = terminate);
+
+
+def generateAuthKey():
+    """Generate a random authentication key for a :class:`ClusterExecutor`
+    
+    Returns:
+        str: the key
+    """
+    
+    return binascii.hexlify(os.urandom(32));
+
+
+def readAuthKey(filename = None):
+    """Read the authentication key for the workers of a :class:`ClusterExecutor`
+    
+    Arguments:
+        filename (str or None): file containing the key, if None use the file 
+                                in :const:`AuthKeyFileVariable` or the key in 
+                                :const:`AuthKeyVariable`
+    
+    Returns:
+        str: the key
+    """
+    
+    if filename is None:
+        filename = os.environ.get(AuthKeyFileVariable, None);
+        if filename is None:
+            authkey = os.environ.get(AuthKeyVariable, None);
+            if not authkey:
+                raise RuntimeError('readAuthKey: no authentication key, set %s or %s!' % (AuthKeyVariable, AuthKeyFileVariable));
+            return authkey;
+    
+    with open(filename, 'r') as f:
+        authkey = f.read().strip();
+    if not authkey:
+        raise RuntimeError('readAuthKey: no authentication key in %s!' % filename);
+    return authkey;
+
+
+def runWorker(address, authkey, sliceThreads = None):
+    """Run a worker process for a :class:`ClusterExecutor`
+    
+    The worker connects to the scheduler, processes tasks until the scheduler
+    shuts down and sends back the results or the traceback of errors.
+    
+    Workers started from the command line run in the main thread of the main
+    process and would use all cpus for the slice loops, thus :const:`SliceThreads`
+    is set to *sliceThreads*.
+    
+    Arguments:
+        address (tuple): (host, port) address of the scheduler
+        authkey (str): authentication key of the scheduler, see :func:`readAuthKey`
+        sliceThreads (int or None): number of slice threads, if None 1
+    """
+    
+    global SliceThreads;
+    
+    if not authkey:
+        raise RuntimeError('runWorker: no authentication key!');
+    
+    if sliceThreads is None:
+        sliceThreads = 1;
+    SliceThreads = sliceThreads;
+    
+    initializeWorker();
+    
+    connection = Client(tuple(address), authkey = authkey);
+    try:
+        while True:
+            try:
+                task = connection.recv();
+            except (EOFError, IOError):
+                break;
+            except Exception:
+                connection.send(('error', traceback.format_exc()));
+                continue;
+            
+            if task is None:
+                break;
+            
+            function, arg = task;
+            try:
+                result = ('result', function(arg));
+            except Exception:
+                result = ('error', traceback.format_exc());
+            
+            try:
+                connection.send(result);
+            except (EOFError, IOError):
+                break;
+            except Exception:
+                connection.send(('error', traceback.format_exc()));
+    finally:
+        connection.close();
+
+
+def _runLocalWorker(listener, address, authkey):
+    """Helper to run a worker forked from the scheduler process"""
+    
+    #close the inherited socket of the scheduler to not block workers connecting after shut down
+    listener.close();
+    try:
+        runWorker(address, authkey);
+    except (EOFError, IOError):
+        #scheduler shut down before the worker connected
+        pass;
+
+
+class ClusterExecutor(Executor):
+    """Executor distributing tasks via TCP to workers on several hosts
+    
+    The scheduler listens on *address* for workers started via 
+    :func:`runWorker` on the compute nodes. Each connected worker receives one 
+    task at a time. Tasks of workers that disconnect are given to the 
+    remaining workers. A task that was lost with its worker *maxAttempts* 
+    times, e.g. as it exhausts the memory of the workers, fails. When all 
+    workers are lost and none connects within *timeout* seconds the remaining
+    tasks fail. For testing or to include the local machine *localWorkers* 
+    worker processes are started on the scheduler host.
+    
+    Attributes:
+        address (tuple): (host, port) address the scheduler listens on
+        authkey (str): authentication key for the workers, random if not given
+        processes (int or None): total number of expected workers
+        maxAttempts (int): number of workers a task is given to before it fails
+        timeout (float): time in seconds to wait for new workers after all workers are lost
+    """
+    
+    def __init__(self, address = ('localhost', 0), authkey = None, localWorkers = 0, processes = None, maxAttempts = 3, timeout = 60):
+        if authkey is None:
+            authkey = generateAuthKey();
+        self.authkey = authkey;
+        self.maxAttempts = maxAttempts;
+        self.timeout = timeout;
+        
+        self.lock = threading.Lock();
+        self.liveWorkers = 0;
+        self.lostWorkers = 0;
+        self.listener = Listener(tuple(address), authkey = authkey);
+        self.address = self.listener.address;
+        
+        self.tasks = Queue.Queue();
+        self.connections = [];
+        self.closed = False;
+        
+        #fork local workers before starting threads, their connections wait in the backlog of the listener
+        self.workers = [];
+        for i in range(localWorkers):
+            w = multiprocessing.Process(target = _runLocalWorker, args = (self.listener, self._connectAddress(), authkey));
+            w.daemon = True;
+            w.start();
+            self.workers.append(w);
+        
+        self.accepter = threading.Thread(target = self._accept, name = 'ClusterExecutorAccept');
+        self.accepter.daemon = True;
+        self.accepter.start();
+        
+        if processes is None:
+            processes = max(1, localWorkers);
+        self.processes = processes;
+    
+    def writeAuthKey(self, filename):
+        """Write the authentication key to a file readable only by the user
+        
+        Arguments:
+            filename (str): file name, e.g. on a shared file system
+        
+        Returns:
+            str: the file name
+        """
+        
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600);
+        try:
+            os.fchmod(fd, 0600);
+            os.write(fd, self.authkey);
+        finally:
+            os.close(fd);
+        
+        return filename;
+    
+    def _connectAddress(self):
+        host, port = self.address[:2];
+        if host in ('', '0.0.0.0'):
+            host = 'localhost';
+        return (host, port);
+    
+    def _accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept();
+            except Exception:
+                if self.closed:
+                    break;
+                continue;
+            if self.closed:
+                #stop workers connecting during shut down
+                try:
+                    connection.send(None);
+                except Exception:
+                    pass;
+                connection.close();
+                break;
+            
+            t = threading.Thread(target = self._serve, args = (connection,), name = 'ClusterExecutorWorker');
+            t.daemon = True;
+            self.connections.append((connection, t));
+            t.start();
+    
+    def _wake(self):
+        try:
+            connection = Client(self._connectAddress(), authkey = self.authkey);
+            connection.close();
+        except Exception:
+            pass;
+    
+    def _serve(self, connection):
+        with self.lock:
+            self.liveWorkers += 1;
+        
+        lost = False;
+        while True:
+            task = self.tasks.get();
+            if task is None:
+                #stop the worker
+                try:
+                    connection.send(None);
+                except Exception:
+                    pass;
+                break;
+            
+            index, function, arg, results, attempts = task;
+            try:
+                connection.send((function, arg));
+                status, value = connection.recv();
+            except (EOFError, IOError):
+                #worker lost, reschedule the task unless it was lost too often
+                lost = True;
+                attempts += 1;
+                if attempts < self.maxAttempts:
+                    self.tasks.put((index, function, arg, results, attempts));
+                else:
+                    results.put((index, 'error', 'worker lost %d times while processing the task' % attempts));
+                break;
+            except Exception:
+                status, value = ('error', traceback.format_exc());
+            
+            results.put((index, status, value));
+        
+        with self.lock:
+            self.liveWorkers -= 1;
+            if lost:
+                self.lostWorkers += 1;
+        
+        connection.close();
+    
+    def _workersLost(self):
+        """Checks if all workers are lost"""
+        
+        with self.lock:
+            if self.liveWorkers > 0:
+                return False;
+            if self.lostWorkers > 0:
+                return True;
+        
+        #local workers that died before connecting
+        return len(self.workers) > 0 and not any(w.is_alive() for w in self.workers);
+    
+    def imapUnordered(self, function, argdata, functions = None):
+        if self.closed:
+            raise RuntimeError('ClusterExecutor: executor is shut down!');
+        
+        results = Queue.Queue();
+        n = 0;
+        for i, arg in enumerate(argdata):
+            self.tasks.put((i, function, arg, results, 0));
+            n += 1;
+        
+        return self._results(results, n);
+    
+    def cancel(self):
+        tasks = [];
+        try:
+            while True:
+                tasks.append(self.tasks.get_nowait());
+        except Queue.Empty:
+            pass;
+        for t in tasks:
+            if t is None:
+                #keep the requests to stop workers
+                self.tasks.put(None);
+            else:
+                t[3].put((t[0], 'cancelled', None));
+    
+    def _results(self, results, n):
+        lost = None;
+        for i in range(n):
+            while True:
+                try:
+                    index, status, value = results.get(timeout = 1.0);
+                    break;
+                except Queue.Empty:
+                    if not self._workersLost():
+                        lost = None;
+                    elif lost is None:
+                        lost = time.time();
+                    elif time.time() - lost > self.timeout:
+                        raise RuntimeError('ClusterExecutor: all workers lost, %d of %d tasks not processed!' % (n - i, n));
+            
+            if status == 'error':
+                raise RuntimeError('ClusterExecutor: task %d failed on worker:\n%s' % (index, value));
+            elif status == 'cancelled':
+                continue;
+            yield value;
+    
+    def shutdown(self, terminate = False):
+        if self.closed:
+            return;
+        self.closed = True;
+        
+        if terminate:
+            try:
+                while True:
+                    self.tasks.get_nowait();
+            except Queue.Empty:
+                pass;
+        
+        #wake up the accepting thread, the connection is dropped when the listener is closed if a worker came first
+        waker = threading.Thread(target = self._wake, name = 'ClusterExecutorWake');
+        waker.daemon = True;
+        waker.start();
+        self.accepter.join();
+        self.listener.close();
+        
+        for c in self.connections:
+            self.tasks.put(None);
+        for c, t in self.connections:
+            if terminate:
+                c.close();
+            else:
+                t.join();
+        
+        #all tasks are done, local workers that did not connect yet are not needed
+        for w in self.workers:
+            if w.is_alive():
+                w.terminate();
+            w.join();
+
+
+def createExecutor(executor = None, processes = None):
+    """Create an executor from its specification
+    
+    Arguments:
+        executor (str, Executor or None): 'processes' or None for a 
+                                          :class:`ProcessExecutor`, 'threads' for a
+                                          :class:`ThreadExecutor` or an executor
+        processes (int or None): number of workers
+    
+    Returns:
+        Executor: the executor
+    """
+    
+    if executor is None or executor == 'processes':
+        return ProcessExecutor(processes = processes);
+    elif executor == 'threads':
+        return ThreadExecutor(processes = processes);
+    elif isinstance(executor, Executor):
+        return executor;
+    else:
+        raise RuntimeError('createExecutor: invalid executor %r!' % (executor,));
+
+
+def test():
+    """Test Executor module"""
+    import ClearMap.Utils.Executor as self
+    reload(self)
+
+    with self.ProcessExecutor(processes = 2) as executor:
+        print executor.map(abs, [-1, -2, 3]);
+        print self.getPool(2) is self.getPool(2);
+    print self._pool;
+    
+    with self.ThreadExecutor(processes = 2) as executor:
+        print sorted(executor.imapUnordered(abs, [-1, -2, 3]));
+    
+    print self.mapSlices(lambda z: z * z, 5, threads = 2);
+    
+    with self.ClusterExecutor(localWorkers = 2) as executor:
+        print executor.map(abs, range(-5, 5));
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        #run via the imported module for the settings to apply to the processing steps
+        import ClearMap.Utils.Executor as executor
+        threads = os.environ.get(SliceThreadsVariable, None);
+        executor.runWorker((sys.argv[1], int(sys.argv[2])), readAuthKey(sys.argv[3] if len(sys.argv) > 3 else None),
+                           sliceThreads = int(threads) if threads else None);
+    else:
+        test();
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Provides tools to profile the processing steps and export them as traces
+
+Processing steps are instrumented via :func:`span` blocks. When the calling
+thread records, see :func:`startRecording`, each block creates an event
+with its name, duration, process id, thread id and further arguments such as
+the sub-stack id and number of voxels processed. Otherwise the blocks do
+nothing.
+
+When recording with *memory* set, each block in addition records the resident
+memory of the process at its start and end and the peak resident memory of the
+process during the block, as well as the size of the arrays passed to
+:meth:`span.track`. The memory is measured for the whole process, i.e. when
+processing sub-stacks in several threads the memory of the other threads is
+included.
+
+The peak memory during a block is measured by resetting the peak resident
+memory of the process at the start of the block, see :func:`resetPeakMemoryUsage`,
+thus steps are not charged with the peak memory of earlier steps. On systems
+without this reset the peak is only taken into account if the block itself
+raised the peak memory of the process.
+
+The events of all sub-stacks are collected by the stack processing routines
+and can be written via :func:`writeTrace` into a file in the Chrome trace
+event format that can be inspected e.g. via chrome://tracing.
+
+Example:
+    >>> import ClearMap.Utils.Profiler as prof
+    >>> prof.startRecording(stackId = 0);
+    >>> with prof.span('filter', voxels = 1000):
+    >>>     pass;
+    >>> events = prof.stopRecording();
+    >>> prof.writeTrace('trace.json', events);
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import os
+import sys
+import time
+import json
+import threading
+import resource
+
+
+_local = threading.local();
+
+_activeSpans = [];
+_activeSpansLock = threading.Lock();
+
+
+def memoryUsage():
+    """Returns the current resident memory of this process
+    
+    Returns:
+        int: resident memory in bytes
+    """
+    
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE');
+    except (IOError, OSError, ValueError, IndexError):
+        return peakMemoryUsage();
+
+
+def peakMemoryUsage():
+    """Returns the peak resident memory of this process
+    
+    Returns:
+        int: peak resident memory in bytes
+    """
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+    if sys.platform == 'darwin':
+        return peak;
+    else:
+        return peak * 1024;
+
+
+def resetPeakMemoryUsage():
+    """Resets the peak resident memory of this process to the current resident memory
+    
+    Returns:
+        bool: True if the reset is supported, i.e. on Linux
+    """
+    
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5');
+        return True;
+    except (IOError, OSError):
+        return False;
+
+
+def _resetablePeakMemoryUsage():
+    """Returns the peak resident memory since the last reset or None if not available"""
+    
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024;
+    except (IOError, OSError, ValueError, IndexError):
+        pass;
+    return None;
+
+
+def isRecording():
+    """Checks if the calling thread records events
+
+    Returns:
+        bool: True if events are recorded
+    """
+
+    return getattr(_local, 'events', None) is not None;
+
+
+def isRecordingMemory():
+    """Checks if the calling thread records the memory usage with the events
+
+    Returns:
+        bool: True if memory usage is recorded
+    """
+
+    return isRecording() and _local.memory;
+
+
+def startRecording(memory = False, **args):
+    """Start recording events in the calling thread
+
+    Arguments:
+        memory (bool): if True record the memory usage with the events
+        **args: arguments added to all recorded events, e.g. the sub-stack id
+    """
+
+    _local.events = [];
+    _local.memory = memory;
+    _local.args = args;
+
+
+def stopRecording():
+    """Stop recording events in the calling thread
+
+    Returns:
+        list: the recorded events
+    """
+
+    events = getattr(_local, 'events', None);
+    _local.events = None;
+    _local.args = None;
+
+    if events is None:
+        return [];
+    else:
+        return events;
+
+
+def event(name, start, duration, **args):
+    """Create an event
+
+    Arguments:
+        name (str): name of the event
+        start (float): start time in seconds since the epoch
+        duration (float): duration in seconds
+        **args: further information on the event
+
+    Returns:
+        dict: the event in Chrome trace event format
+    """
+
+    return {"name" : name, "ph" : "X", "ts" : start * 1e6, "dur" : duration * 1e6,
+            "pid" : os.getpid(), "tid" : threading.current_thread().ident, "args" : args};
+
+
+def addEvent(name, start, duration, **args):
+    """Add an event to the events recorded in the calling thread
+
+    Arguments:
+        name (str): name of the event
+        start (float): start time in seconds since the epoch
+        duration (float): duration in seconds
+        **args: further information on the event
+    """
+
+    if not isRecording():
+        return;
+
+    a = _local.args.copy();
+    a.update(args);
+    _local.events.append(event(name, start, duration, **a));
+
+
+class span(object):
+    """Context manager recording the duration of a processing step
+
+    Attributes:
+        name (str): name of the step
+        args (dict): further information on the step, e.g. number of voxels
+    """
+
+    def __init__(self, name, **args):
+        self.name = name;
+        self.args = args;
+
+    def __enter__(self):
+        self.memory = isRecordingMemory();
+        if self.memory:
+            with _activeSpansLock:
+                # the peak is shared by the process, keep the peak of the enclosing and concurrent steps before resetting it
+                self._updatePeaks();
+                self.args["rssStart"] = memoryUsage();
+                self.peakStart = peakMemoryUsage();
+                self.peak = self.args["rssStart"];
+                self.reset = resetPeakMemoryUsage();
+                _activeSpans.append(self);
+        self.start = time.time();
+        return self;
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.memory:
+            with _activeSpansLock:
+                self._updatePeaks();
+                _activeSpans.remove(self);
+                self.args["rss"] = memoryUsage();
+                self.args["peak"] = max(self.peak, self.args["rss"]);
+        if isRecording():
+            duration = time.time() - self.start;
+            addEvent(self.name, self.start, duration, **self.args);
+        return False;
+    
+    @staticmethod
+    def _updatePeaks():
+        """Update the peak memory of the active steps"""
+        if not _activeSpans:
+            return;
+        peak = _resetablePeakMemoryUsage();
+        total = peakMemoryUsage();
+        for s in _activeSpans:
+            if s.reset and not peak is None:
+                s.peak = max(s.peak, peak);
+            elif total > s.peakStart:
+                # the step raised the peak memory of the process
+                s.peak = max(s.peak, total);
+    
+    def track(self, *arrays):
+        """Add the size of arrays allocated in this step to the recorded memory
+        
+        Arguments:
+            *arrays: the arrays allocated in this step
+        """
+        
+        if isRecordingMemory():
+            self.args["nbytes"] = self.args.get("nbytes", 0) + sum(a.nbytes for a in arrays if hasattr(a, 'nbytes'));
+
+
+def writeTrace(filename, events):
+    """Write events to a file in Chrome trace event format
+
+    Arguments:
+        filename (str): file name of the trace
+        events (list): list of events
+
+    Returns:
+        str: file name of the trace
+    """
+
+    with open(filename, 'w') as f:
+        json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f);
+
+    return filename;
+
+
+def summarizeTrace(events):
+    """Summarize the time spent in each processing step
+
+    Arguments:
+        events (list): list of events
+
+    Returns:
+        dict: number of calls, total time and voxels processed per second for each step name
+    """
+
+    summary = {};
+    for e in events:
+        s = summary.setdefault(e["name"], {"calls" : 0, "time" : 0.0, "voxels" : 0});
+        s["calls"] += 1;
+        s["time"] += e["dur"] / 1e6;
+        s["voxels"] += e["args"].get("voxels", 0);
+
+    for s in summary.values():
+        s["rate"] = s["voxels"] / s["time"] if s["time"] > 0 else 0.0;
+
+    return summary;
+
+
+def printSummary(events, out = sys.stdout):
+    """Print the time spent in each processing step
+
+    Arguments:
+        events (list): list of events
+        out (object): object to write the summary to
+    """
+
+    summary = summarizeTrace(events);
+    total = sum(s["time"] for s in summary.values());
+
+    out.write("Profile: %-24s %8s %12s %8s %14s\n" % ("step", "calls", "time [s]", "[%]", "voxels / s"));
+    for name, s in sorted(summary.items(), key = lambda x: -x[1]["time"]):
+        out.write("Profile: %-24s %8d %12.3f %8.1f %14.0f\n" % (name, s["calls"], s["time"], 100.0 * s["time"] / total if total > 0 else 0, s["rate"]));
+
+
+
+def summarizeMemory(events):
+    """Summarize the memory used in each processing step
+    
+    The increase of the memory of a step is estimated by the difference of the
+    peak memory during and the resident memory before the step.
+
+    Arguments:
+        events (list): list of events with memory information
+
+    Returns:
+        dict: maximal resident memory change, peak memory increase, peak memory,
+              size of the allocated arrays and memory increase per voxel for each step name
+    """
+
+    summary = {};
+    for e in events:
+        a = e["args"];
+        if not "rssStart" in a:
+            continue;
+        s = summary.setdefault(e["name"], {"calls" : 0, "rssDelta" : 0, "peakDelta" : 0, "peak" : 0, "nbytes" : 0, "bytesPerVoxel" : 0.0});
+        s["calls"] += 1;
+        s["rssDelta"] = max(s["rssDelta"], a["rss"] - a["rssStart"]);
+        s["peakDelta"] = max(s["peakDelta"], a["peak"] - a["rssStart"]);
+        s["peak"] = max(s["peak"], a["peak"]);
+        s["nbytes"] = max(s["nbytes"], a.get("nbytes", 0));
+        if a.get("voxels", 0) > 0:
+            s["bytesPerVoxel"] = max(s["bytesPerVoxel"], float(a["peak"] - a["rssStart"]) / a["voxels"]);
+
+    return summary;
+
+
+def printMemorySummary(events, out = sys.stdout):
+    """Print the memory used in each processing step
+
+    Arguments:
+        events (list): list of events with memory information
+        out (object): object to write the summary to
+    """
+
+    summary = summarizeMemory(events);
+    mb = 1024.0 * 1024.0;
+
+    out.write("Memory: %-24s %8s %12s %12s %12s %12s %10s\n" % ("step", "calls", "rss [MB]", "+peak [MB]", "peak [MB]", "arrays [MB]", "B / voxel"));
+    for name, s in sorted(summary.items(), key = lambda x: -x[1]["peakDelta"]):
+        out.write("Memory: %-24s %8d %12.1f %12.1f %12.1f %12.1f %10.1f\n" % (name, s["calls"], s["rssDelta"] / mb, s["peakDelta"] / mb, s["peak"] / mb, s["nbytes"] / mb, s["bytesPerVoxel"]));
+
+
+def test():
+    """Test Profiler module"""
+    import ClearMap.Utils.Profiler as self
+    reload(self)
+
+    import numpy
+    
+    self.startRecording(stackId = 0, memory = True);
+    with self.span('sleep', voxels = 100):
+        time.sleep(0.1);
+    with self.span('allocate', voxels = 10**6) as s:
+        x = numpy.ones(10**6);
+        s.track(x);
+    del x;
+    with self.span('small', voxels = 10):
+        x = numpy.ones(10);
+    events = self.stopRecording();
+
+    print events;
+    self.printSummary(events);
+    self.printMemorySummary(events);
+
+
+if __name__ == "__main__":
+    test();
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Provides tools to report the progress of long running processing steps
+
+A :class:`Progress` object is updated by the main process each time a unit of
+work, e.g. a sub-stack, is finished by one of the workers. It reports the
+number of finished units, the processing rate in voxels per second, the number
+of items found so far, e.g. cells, and the estimated time to finish.
+
+The progress is printed in regular intervals and optionally written as a JSON
+status file that can be polled by job monitors. The status file is replaced
+atomically and also contains the throughput of each worker, to identify slow
+hosts or processes while the job is still running.
+
+Example:
+    >>> import ClearMap.Utils.Progress as prg
+    >>> p = prg.Progress('detectCells', total = 10, statusFile = 'status.json');
+    >>> for i in range(10):
+    >>>     p.update(voxels = 1000, items = 5, worker = 'host:1');
+    >>> p.finish();
+"""
+#:copyright: Copyright 2015 by Christoph Kirst, The Rockefeller University, New York City
+#:license: GNU, see LICENSE.txt for details.
+
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import threading
+
+import ClearMap.IO as io
+from ClearMap.Utils.Timer import Timer
+
+
+def workerName():
+    """Returns a name identifying the calling worker
+
+    Returns:
+        str: host name and process id, and thread name if not called from the main thread
+    """
+
+    name = "%s:%d" % (socket.gethostname(), os.getpid());
+    thread = threading.current_thread();
+    if not isinstance(thread, threading._MainThread):
+        name += ":" + thread.name;
+    return name;
+
+
+def writeStatus(filename, status):
+    """Atomically write a status to a JSON file
+
+    Arguments:
+        filename (str): file name of the status file
+        status (dict): the status
+
+    Returns:
+        str: file name of the status file
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename));
+    fd, tmp = io.createTemporaryFile(directory = directory, prefix = '.' + os.path.basename(filename));
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f, indent = 1);
+        os.rename(tmp, filename);
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp);
+        raise;
+
+    return filename;
+
+
+def readStatus(filename):
+    """Read a status from a JSON file
+
+    Arguments:
+        filename (str): file name of the status file
+
+    Returns:
+        dict: the status
+    """
+
+    with open(filename, 'r') as f:
+        return json.load(f);
+
+
+class Progress(object):
+    """Class to report the progress of a processing step
+
+    Attributes:
+        name (str): name of the processing step
+        total (int): total number of units to process
+        done (int): number of units finished
+        skipped (int): number of units finished before the start, e.g. from checkpoints
+        voxels (int): number of voxels processed
+        items (int): number of items found, e.g. cells
+        unit (str): name of the units
+        statusFile (str or None): file to write the status to
+        out (object or None): object to write the progress to
+        interval (float): minimal time in seconds between two progress reports
+        workers (dict): number of units, voxels and processing time of each worker
+    """
+
+    def __init__(self, name, total, skipped = 0, unit = 'sub-stacks', statusFile = None, out = sys.stdout, interval = 5):
+        self.name = name;
+        self.total = total;
+        self.skipped = skipped;
+        self.done = skipped;
+        self.voxels = 0;
+        self.items = 0;
+        self.unit = unit;
+        self.statusFile = statusFile;
+        self.out = out;
+        self.interval = interval;
+        self.workers = {};
+        self.timer = Timer();
+        self.reported = 0;
+
+        self.report(force = True);
+
+    def update(self, count = 1, voxels = 0, items = 0, worker = None, duration = None):
+        """Update the progress after units are finished
+
+        Arguments:
+            count (int): number of finished units
+            voxels (int): number of voxels processed in these units
+            items (int): number of items found in these units
+            worker (str or None): name of the worker that processed the units
+            duration (float or None): processing time of the worker
+        """
+
+        self.done += count;
+        self.voxels += voxels;
+        self.items += items;
+
+        if worker is not None:
+            w = self.workers.setdefault(worker, {"done" : 0, "voxels" : 0, "time" : 0.0});
+            w["done"] += count;
+            w["voxels"] += voxels;
+            if duration is not None:
+                w["time"] += duration;
+
+        self.report();
+
+    def finish(self):
+        """Report the final progress"""
+
+        self.report(force = True, finished = True);
+
+    def elapsedTime(self):
+        """Returns the time since the start
+
+        Returns:
+            float: elapsed time in seconds
+        """
+
+        return self.timer.elapsedTime(asstring = False);
+
+    def eta(self):
+        """Estimates the remaining time
+
+        Returns:
+            float or None: remaining time in seconds, None if no unit was processed yet
+        """
+
+        processed = self.done - self.skipped;
+        if processed <= 0:
+            return None;
+
+        return self.elapsedTime() / processed * max(0, self.total - self.done);
+
+    def status(self, finished = False):
+        """Returns the status of the processing
+
+        Arguments:
+            finished (bool): the processing is finished
+
+        Returns:
+            dict: the status
+        """
+
+        elapsed = self.elapsedTime();
+
+        workers = {};
+        for name, w in self.workers.items():
+            workers[name] = dict(w);
+            workers[name]["voxelRate"] = w["voxels"] / w["time"] if w["time"] > 0 else None;
+
+        return {"name" : self.name, "unit" : self.unit, "done" : self.done, "total" : self.total,
+                "voxels" : self.voxels, "items" : self.items, "elapsed" : elapsed,
+                "rate" : (self.done - self.skipped) / elapsed if elapsed > 0 else None,
+                "voxelRate" : self.voxels / elapsed if elapsed > 0 else None,
+                "eta" : 0 if finished else self.eta(), "finished" : finished,
+                "workers" : workers, "updated" : time.time()};
+
+    def report(self, force = False, finished = False):
+        """Print and write the status if the report interval has passed
+
+        Arguments:
+            force (bool): report independent of the interval
+            finished (bool): the processing is finished
+        """
+
+        if not force and time.time() - self.reported < self.interval:
+            return;
+        self.reported = time.time();
+
+        status = self.status(finished = finished);
+
+        if self.out is not None:
+            text = "%s: %d / %d %s" % (self.name, status["done"], status["total"], self.unit);
+            if status["voxelRate"]:
+                text += ", %.2e voxels / s" % status["voxelRate"];
+            if status["items"] > 0:
+                text += ", %d found" % status["items"];
+            if finished:
+                text += ", elapsed time: " + self.timer.formatElapsedTime(status["elapsed"]);
+            elif status["eta"] is not None:
+                text += ", ETA: " + self.timer.formatElapsedTime(status["eta"]);
+            self.out.write(text + '\n');
+            self.out.flush();
+
+        if self.statusFile is not None:
+            writeStatus(self.statusFile, status);
+
+
+def createProgress(progress, name, total, **args):
+    """Create a progress report from a processing parameter
+
+    Arguments:
+        progress (bool, str or Progress): if True print the progress, if a file name print
+                                          the progress and write the status to this file,
+                                          if False only count the progress
+        name (str): name of the processing step
+        total (int): total number of units to process
+        **args: further arguments for :class:`Progress`
+
+    Returns:
+        Progress: the progress object
+    """
+
+    if isinstance(progress, Progress):
+        return progress;
+    elif isinstance(progress, basestring):
+        return Progress(name, total, statusFile = progress, **args);
+    elif progress:
+        return Progress(name, total, **args);
+    else:
+        args["out"] = None;
+        return Progress(name, total, **args);
+
+
+
+def test():
+    """Test Progress module"""
+    import ClearMap.Utils.Progress as self
+    reload(self)
+
+    fn = os.path.join(tempfile.gettempdir(), 'progress_status.json');
+    p = self.Progress('test', total = 5, statusFile = fn, interval = 0);
+    for i in range(5):
+        time.sleep(0.05);
+        p.update(voxels = 1000, items = 3, worker = self.workerName(), duration = 0.05);
+    p.finish();
+
+    print self.readStatus(fn);
+    os.remove(fn);
+
+
+if __name__ == "__main__":
+    test();